@@ -2,16 +2,185 @@
 
 from __future__ import division
 from six.moves import map, zip
+import os
 import numpy as np
 from scipy import stats
 from scipy import optimize
-from scipy.misc import derivative
+from scipy import sparse
+from scipy import special
 import inspect
+import threading
+from collections import namedtuple, OrderedDict
 from warnings import warn
 
-# Use this function/object for parallelization where possible
+# Map function used by the default `SerialExecutor`.
+# Replacing it is the old way of parallelising the hypothesis tests,
+# the executors below offer more control.
 mapper = map
 
+def _is_full_slice(index):
+    """Check whether an index selects everything."""
+    return isinstance(index, slice) and index == slice(None)
+
+def _as_float_array(array):
+    """Convert to an array of floats, keeping floating point types like ``numpy.float32``."""
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating):
+        array = array.astype(float)
+    return array
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+CacheInfo.__doc__ = """Statistics of a cache, like those of :func:`functools.lru_cache`."""
+
+class _LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries.
+
+    Cached arrays and results are copied, so the callers can modify them.
+    Keys may contain objects, which are compared by identity. The cache keeps
+    references to them, so their ids cannot be reused by new objects while
+    the entry exists.
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _copy(value):
+        if isinstance(value, tuple):
+            return tuple(_LRUCache._copy(v) for v in value)
+        if isinstance(value, np.ndarray):
+            return value.copy()
+        if isinstance(value, dict):
+            # E.g. OptimizeResult
+            return type(value)((k, _LRUCache._copy(v)) for k, v in value.items())
+        return value
+
+    def get(self, key, function):
+        """Return the cached value of `key` or calculate it with `function`."""
+        with self._lock:
+            if key in self._data:
+                # Move to the most recently used position
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return self._copy(value)
+            self.misses += 1
+        value = function()
+        with self._lock:
+            self._data[key] = self._copy(value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def info(self):
+        """Return the hit and miss statistics."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __getstate__(self):
+        # Do not send the cached values to other processes
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+def _cache_key(*args, **kwargs):
+    """Turn the arguments of a likelihood evaluation into a hashable key."""
+    key = []
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            key.append((arg.dtype.str, arg.shape, arg.tobytes()))
+        else:
+            key.append(repr(arg))
+    key.append(repr(sorted(kwargs.items())))
+    return tuple(key)
+
+class _SharedArrayReference(object):
+    """Picklable reference to an array in shared memory."""
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def attach(self):
+        """Return the referenced array."""
+        try:
+            shm = _attached_shared_memory[self.name]
+        except KeyError:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(name=self.name)
+            # Keep the memory attached for further tasks in this process
+            _attached_shared_memory[self.name] = shm
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        return array
+
+# Shared memory blocks that have been attached by this process
+_attached_shared_memory = {}
+
+def _share_attributes(obj, names):
+    """Move the array attributes `names` of `obj` into shared memory."""
+
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("Shared memory requires Python 3.8 or newer!")
+
+    shared = obj.__dict__.setdefault('_shared_memory', {})
+    for name in names:
+        if name in shared:
+            continue
+        array = np.ascontiguousarray(obj.__dict__[name])
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared_array[...] = array
+        shared_array.flags.writeable = False
+        obj.__dict__[name] = shared_array
+        shared[name] = shm
+
+def _release_shared_attributes(obj):
+    """Move the shared array attributes of `obj` back to private memory."""
+
+    shared = obj.__dict__.pop('_shared_memory', {})
+    for name, shm in shared.items():
+        obj.__dict__[name] = np.array(obj.__dict__[name])
+        try:
+            shm.close()
+        except BufferError:
+            # Still referenced somewhere else, will be closed when that is gone
+            pass
+        shm.unlink()
+
+def _get_shared_state(obj):
+    """Get the pickle state of `obj`, replacing shared arrays with references."""
+
+    state = obj.__dict__.copy()
+    shared = state.pop('_shared_memory', {})
+    for name, shm in shared.items():
+        array = state[name]
+        state[name] = _SharedArrayReference(shm.name, array.shape, array.dtype)
+    return state
+
+def _set_shared_state(obj, state):
+    """Set the pickle state of `obj`, attaching to referenced shared arrays."""
+
+    for name, value in state.items():
+        if isinstance(value, _SharedArrayReference):
+            state[name] = value.attach()
+    obj.__dict__.update(state)
+
 class JeffreysPrior(object):
     """Universal non-informative prior for use in Bayesian MCMC analysis.
 
@@ -53,6 +222,16 @@ class JeffreysPrior(object):
         be used to make priors proper in a consistent way, since the limit is
         defined in the truth space, rather than the prior parameter space.
 
+    jacobian : function or array like, optional
+        The derivatives of the truth vector by the parameters, shape
+        ``(n_truth_bins, n_parameters)``. For linear translation functions this
+        is a constant array. Otherwise a function that translates arrays of
+        parameter vectors into arrays of Jacobian matrices::
+
+            [jacobian_matrix, ...] = jacobian([parameter_vector, ...])
+
+        Default: Numerical differentiation with step sizes `dx`.
+
     Notes
     -----
 
@@ -61,6 +240,11 @@ class JeffreysPrior(object):
 
         prior_likelihood = jeffreys_prior(parameter_vector)
 
+    It also accepts arrays of parameter vectors and evaluates them in one
+    batch::
+
+        [prior_likelihood, ...] = jeffreys_prior([parameter_vector, ...])
+
     If the prior was constructed with more than one response matrix,
     the matrix to be used for the calculation can be chosen with the
     `toy_index` argument::
@@ -91,15 +275,8 @@ class JeffreysPrior(object):
 
     """
 
-    def __init__(self, response_matrix, translation_function, parameter_limits, default_values, dx=None, total_truth_limit=None):
-        try:
-            # Load response matrix and necessary arguments from file
-            matrix, args = LikelihoodMachine._args_from_matrix_file(response_matrix)
-        except (TypeError, AttributeError):
-            pass
-        else:
-            response_matrix = matrix
-
+    def __init__(self, response_matrix, translation_function, parameter_limits, default_values, dx=None, total_truth_limit=None, jacobian=None):
+        response_matrix = np.asarray(response_matrix)
         old_shape = response_matrix.shape
         new_shape = (int(np.prod(old_shape[:-2])), old_shape[-2], old_shape[-1])
         self.response_matrix = response_matrix.reshape(new_shape)
@@ -116,8 +293,16 @@ class JeffreysPrior(object):
 
         self._npar = len(parameter_limits)
         self._nreco = response_matrix.shape[-2]
-        self._i_diag = np.diag_indices(self._npar)
-        self.dx = dx or np.full(self._npar, 1e-3)
+        if dx is None:
+            dx = np.full(self._npar, 1e-3)
+        self.dx = np.asarray(dx)
+
+        self._jacobian = jacobian
+        if jacobian is not None and not callable(jacobian):
+            # Linear translation -> constant derivatives of the reco expectation values
+            self._reco_jacobian = np.einsum('trs,sp->tpr', self.response_matrix, np.asarray(jacobian))
+        else:
+            self._reco_jacobian = None
 
     def translate(self, parameters):
         """Translate the parameter vector to a truth vector.
@@ -137,6 +322,32 @@ class JeffreysPrior(object):
         """
         return self._translate(parameters)
 
+    def _translate_batch(self, parameters):
+        """Translate an arbitrarily shaped array of parameter vectors."""
+        shape = parameters.shape[:-1]
+        truth = np.asarray(self.translate(parameters.reshape((-1, self._npar))))
+        return truth.reshape(shape + truth.shape[-1:])
+
+    def _reco_derivatives(self, parameters, resp):
+        """Derivatives of the reco expectation values by the parameters.
+
+        Returns an array of shape ``(..., n_parameters, n_reco)``.
+
+        """
+
+        if self._jacobian is not None:
+            jac = np.asarray(self._jacobian(parameters.reshape((-1, self._npar))))
+            jac = jac.reshape(parameters.shape[:-1] + jac.shape[-2:])
+            return np.einsum('rs,...sp->...pr', resp, jac)
+
+        # Central differences of all parameters in one batched translation
+        npar = self._npar
+        step = np.eye(npar) * self.dx
+        parameters = parameters[...,np.newaxis,:]
+        diff = (self._translate_batch(parameters + step) - self._translate_batch(parameters - step))
+        diff /= 2. * self.dx[:,np.newaxis]
+        return np.tensordot(diff, resp, axes=((-1,),(-1,)))
+
     def fisher_matrix(self, parameters, toy_index=0):
         """Calculate the Fisher information matrix for the given parameters.
 
@@ -145,6 +356,7 @@ class JeffreysPrior(object):
 
         parameters : array like
             The parameters of the translation function.
+            Shape: ``([a,b,...,]n_parameters)``
         toy_index : int, optional
             The index of the response matrix to be used for the calculation
 
@@ -153,55 +365,65 @@ class JeffreysPrior(object):
 
         ndarray
             The Fisher information matrix.
+            Shape: ``([a,b,...,]n_parameters,n_parameters)``
 
-        """
-
-        resp = self.response_matrix[toy_index]
-        npar = self._npar
-        nreco = self._nreco
-        par_mat = np.array(np.broadcast_to(parameters, (npar, npar)))
-        i_diag = self._i_diag
+        Notes
+        -----
 
-        # list of parameter sets -> list of reco values
-        def reco_expectation(theta):
-            ret = np.tensordot(self.translate(theta), resp, [[-1], [-1]])
-            return ret
+        The Fisher information is calculated as ``J^T R^T diag(1/mu) R J``,
+        with the response matrix ``R``, the reco expectation values ``mu``, and
+        the Jacobian ``J`` of the translation function. If no `jacobian` was
+        provided, it is calculated numerically with central differences.
 
-        # npar by npar matrix of reco values
-        expect = np.broadcast_to(reco_expectation(par_mat), (npar, npar, nreco))
+        """
 
-        # Diff expects the last axis to be the parameters, not the reco values!
-        # varied parameter set -> transposed list of reco values
-        def curried(x):
-            par_mat[i_diag] = x
-            return reco_expectation(par_mat).T
+        parameters = np.asfarray(parameters)
+        resp = self.response_matrix[toy_index]
 
-        diff = derivative(curried, x0=parameters, dx=self.dx).T
+        expect = np.tensordot(self._translate_batch(parameters), resp, axes=((-1,),(-1,)))
+        if self._reco_jacobian is not None:
+            diff = self._reco_jacobian[toy_index]
+        else:
+            diff = self._reco_derivatives(parameters, resp)
+        diff = np.broadcast_to(diff, expect.shape[:-1] + diff.shape[-2:])
 
-        diff_i = np.broadcast_to(diff, (npar, npar, nreco))
-        diff_j = np.swapaxes(diff_i, 0, 1)
+        if np.all(expect > 0.):
+            return np.einsum('...ir,...jr->...ij', diff, diff / expect[...,np.newaxis,:])
 
         # Nansum to ignore 0. * 0. / 0.
         # Equivalent to ignoring those reco bins
-        fish = np.nansum(diff_i * diff_j / expect, axis=-1)
-        return fish
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fish = diff[...,:,np.newaxis,:] * diff[...,np.newaxis,:,:] / expect[...,np.newaxis,np.newaxis,:]
+        return np.nansum(fish, axis=-1)
 
     def __call__(self, value, toy_index=0):
-        """Calculate the prior probability of the given parameter set."""
+        """Calculate the prior probability of the given parameter set.
+
+        Supports arrays of parameter sets of shape
+        ``([a,b,...,]n_parameters)``.
+
+        """
+
+        value = np.asfarray(value)
+        shape = value.shape[:-1]
+        value = value.reshape((-1, self._npar))
+        log_prior = np.full(len(value), -np.inf)
 
         # Out of bounds?
-        if np.any(value < self.lower_limits) or np.any(value > self.upper_limits):
-            return -np.inf
+        valid = np.all((value >= self.lower_limits) & (value <= self.upper_limits), axis=-1)
 
         # Out of total truth bound?
-        if np.sum(self.translate(value)) > self.total_truth_limit:
-            return -np.inf
+        if np.isfinite(self.total_truth_limit) and np.any(valid):
+            truth = np.sum(self._translate_batch(value[valid]), axis=-1)
+            valid[valid] = truth <= self.total_truth_limit
 
-        fish = self.fisher_matrix(value, toy_index)
-        with np.errstate(under='ignore'):
-            sign, log_det = np.linalg.slogdet(fish)
+        if np.any(valid):
+            fish = self.fisher_matrix(value[valid], toy_index)
+            with np.errstate(under='ignore', divide='ignore'):
+                sign, log_det = np.linalg.slogdet(fish)
+            log_prior[valid] = 0.5*log_det
 
-        return 0.5*log_det
+        return log_prior.reshape(shape)[()]
 
 class DataModel(object):
     """Base class for representation of data statistical models.
@@ -224,16 +446,65 @@ class DataModel(object):
 
     """
 
+    # Array attributes that are moved to shared memory by `share_memory`
+    _shared_attributes = ('data_vector',)
+
+    # Whether `log_likelihood_gradient` is implemented
+    has_gradient = False
+
     def __init__(self, data_vector):
         self.data_vector = np.asarray(data_vector)
 
-    def log_likelihood(self, reco_vector):
+    def share_memory(self):
+        """Move the data arrays into shared memory.
+
+        When the object is pickled afterwards, e.g. to be sent to a worker of
+        a :class:`multiprocessing.Pool`, only references to the shared memory
+        are transferred instead of the arrays themselves. Workers on the same
+        machine access the same memory without copying it.
+
+        The shared memory is freed with :meth:`release_shared_memory`. This
+        must be done by the process that called this method. Requires Python
+        3.8 or newer.
+
+        """
+        _share_attributes(self, self._shared_attributes)
+
+    def release_shared_memory(self):
+        """Move the shared arrays back to private memory and free the shared memory."""
+        _release_shared_attributes(self)
+
+    def __getstate__(self):
+        return _get_shared_state(self)
+
+    def __setstate__(self, state):
+        _set_shared_state(self, state)
+
+    def log_likelihood(self, reco_vector, paired=False):
         """Calculate the likelihood of the provided expectation values.
 
         The reco vector can have a shape ``([c,d,]n_reco_bins,)``. Assuming the
         data is of shape ``([a,b,...,]n_reco_bins,)``, the output will be of
         shape ``([a,b,...,][c,d,...,])``.
 
+        If `paired` is ``True``, each data set is only compared to its own
+        expectation values instead. The reco vector must then have a shape
+        ``([a,b,...,][c,d,...,]n_reco_bins,)`` and the output will be of shape
+        ``([a,b,...,][c,d,...,])``.
+
+        """
+
+        raise NotImplementedError("Must be implemented in a subclass!")
+
+    def log_likelihood_gradient(self, reco_vector, paired=False):
+        """Calculate the derivatives of the log likelihood by the expectation values.
+
+        The reco vector can have a shape ``([c,d,]n_reco_bins,)``. Assuming the
+        data is of shape ``([a,b,...,]n_reco_bins,)``, the output will be of
+        shape ``([a,b,...,][c,d,...,]n_reco_bins,)``.
+
+        See :meth:`log_likelihood` for the meaning of `paired`.
+
         """
 
         raise NotImplementedError("Must be implemented in a subclass!")
@@ -286,6 +557,13 @@ class PoissonData(DataModel):
         ln(p(k, mu)) = k*ln(mu) - mu - ln(k!)
         ln(k!) = -ln(p(k,mu)) + k*ln(mu) - mu = -ln(p(k,1.)) - 1.
 
+    The terms of all data sets and predictions are calculated in place in a
+    single work array of the floating point type of the predictions, e.g.
+    ``numpy.float32``, with :func:`scipy.special.xlogy` for ``k*ln(mu)``. The
+    sum over the reco bins is always accumulated in double precision. Bins
+    with ``k == 0`` do not depend on ``ln(mu)``, so ``mu == 0`` is allowed
+    there.
+
     Attributes
     ----------
 
@@ -306,44 +584,109 @@ class PoissonData(DataModel):
             self.k0 = (k == 0)
             self.ln_k_factorial = -(
                 stats.poisson.logpmf(k, np.ones_like(k, dtype=float)) + 1.)
-
-    @staticmethod
-    def _poisson_logpmf(k, k0, ln_k_factorial, mu):
-        with np.errstate(divide='ignore', invalid='ignore'):
-            pmf = k*np.log(mu) - ln_k_factorial - mu
-        # Need to take care of special case mu=0:  k=0 -> logpmf=0,  k>=1 -> logpmf=-inf
-        mu0 = (mu==0)
-        pmf[mu0 & k0] = 0
-        pmf[mu0 & ~k0] = -np.inf
-        pmf[~np.isfinite(pmf)] = -np.inf
-        pmf = np.sum(pmf, axis=-1)
-        return pmf
-
-    def log_likelihood(self, reco_vector):
+        self._typed_constants = {}
+
+    _shared_attributes = ('data_vector', 'k0', 'ln_k_factorial')
+
+    has_gradient = True
+
+    def __getstate__(self):
+        state = DataModel.__getstate__(self)
+        # Derived arrays can be re-created by the receiving process
+        state['_typed_constants'] = {}
+        return state
+
+    def _get_typed_constants(self, dtype):
+        """Return ``k`` and ``ln(k!)`` in the given floating point type."""
+        if dtype not in self._typed_constants:
+            self._typed_constants[dtype] = (self.data_vector.astype(dtype),
+                                            self.ln_k_factorial.astype(dtype, copy=False))
+        return self._typed_constants[dtype]
+
+    def _poisson_logpmf(self, mu, paired):
+        """Calculate the log PMF summed over the reco bins."""
+        data_index, reco_index = self._get_indices(mu.shape, paired)
+        # Negative, infinite or NaN predictions are impossible
+        with np.errstate(invalid='ignore'):
+            invalid = ~(np.min(mu, axis=-1) >= 0.) | ~(np.max(mu, axis=-1) < np.inf)
+        k, ln_k_factorial = self._get_typed_constants(mu.dtype)
+        k, mu_reco = k[data_index], mu[reco_index]
+        # The only temporary array of the full size, in the type of the predictions
+        work = np.empty(np.broadcast(k, mu_reco).shape, dtype=mu.dtype)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # k*ln(mu) is 0 for k=0 and -inf for k>=1 and mu=0
+            special.xlogy(k, mu_reco, out=work)
+            np.subtract(work, ln_k_factorial[data_index], out=work)
+            np.subtract(work, mu_reco, out=work)
+            # Accumulate in double precision, even if the terms are single precision
+            pmf = np.asarray(np.sum(work, axis=-1, dtype=np.float64))
+        pmf[np.broadcast_to(invalid[reco_index[:-1]], pmf.shape)] = -np.inf
+        return pmf[()]
+
+    def _get_indices(self, reco_shape, paired):
+        """Get the indices to cast data and reco vectors to a common shape."""
+        data_shape = self.data_vector.shape # = ([a,b,...,]n_reco_bins,)
+        if paired:
+            # reco_shape = ([a,b,...,][c,d,...,]n_reco_bins,)
+            data_index = ((slice(None),)*(len(data_shape)-1)
+                        + (np.newaxis,)*(len(reco_shape)-len(data_shape)) + (slice(None),))
+            reco_index = (Ellipsis,)
+        else:
+            # reco_shape = ([c,d,...,]n_reco_bins,)
+            data_index = ((slice(None),)*(len(data_shape)-1)
+                        + (np.newaxis,)*(len(reco_shape)-1) + (slice(None),))
+            reco_index = ((np.newaxis,)*(len(data_shape)-1)
+                        + (slice(None),)*(len(reco_shape)-1) + (slice(None),))
+        return data_index, reco_index
+
+    def log_likelihood(self, reco_vector, paired=False):
         """Calculate the likelihood of the provided expectation values.
 
         The reco vector can have a shape ``([c,d,]n_reco_bins,)``. Assuming the
         data is of shape ``([a,b,...,]n_reco_bins,)``, the output will be of
         shape ``([a,b,...,][c,d,...,])``.
 
+        If `paired` is ``True``, each data set is only compared to its own
+        expectation values instead. The reco vector must then have a shape
+        ``([a,b,...,][c,d,...,]n_reco_bins,)`` and the output will be of shape
+        ``([a,b,...,][c,d,...,])``.
+
         """
 
-        reco_vector = np.asfarray(reco_vector)
+        reco_vector = _as_float_array(reco_vector)
 
-        data_shape = self.data_vector.shape # = ([a,b,...,]n_reco_bins,)
-        reco_shape = reco_vector.shape # = ([c,d,...,]n_reco_bins,)
+        # Calculate the log probabilities of shape ([a,b,...,][c,d,...,]).
+        return self._poisson_logpmf(reco_vector, paired)
 
-        # Cast vectors to the shape ([a,b,...,][c,d,...,]n_reco_bins,)
-        data_index = ((slice(None),)*(len(data_shape)-1)
-                    + (np.newaxis,)*(len(reco_shape)-1) + (slice(None),))
-        reco_index = ((np.newaxis,)*(len(data_shape)-1)
-                    + (slice(None),)*(len(reco_shape)-1) + (slice(None),))
+    def log_likelihood_gradient(self, reco_vector, paired=False):
+        """Calculate the derivatives of the log likelihood by the expectation values.
 
-        # Calculate the log probabilities of shape ([a,b,...,][c,d,...,]).
-        return self._poisson_logpmf(self.data_vector[data_index],
-                                    self.k0[data_index],
-                                    self.ln_k_factorial[data_index],
-                                    reco_vector[reco_index])
+        The reco vector can have a shape ``([c,d,]n_reco_bins,)``. Assuming the
+        data is of shape ``([a,b,...,]n_reco_bins,)``, the output will be of
+        shape ``([a,b,...,][c,d,...,]n_reco_bins,)``.
+
+        See :meth:`log_likelihood` for the meaning of `paired`.
+
+        Notes
+        -----
+
+        ::
+
+            d ln(p(k, mu)) / d mu = k/mu - 1
+
+        """
+
+        reco_vector = _as_float_array(reco_vector)
+
+        data_index, reco_index = self._get_indices(reco_vector.shape, paired)
+
+        k, _ = self._get_typed_constants(reco_vector.dtype)
+        mu = reco_vector[reco_index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gradient = k[data_index] / mu - 1.
+        # Special case mu=0, k=0: Only the -mu term remains
+        gradient[self.k0[data_index] & (mu == 0)] = -1.
+        return gradient
 
     @classmethod
     def generate_toy_data(cls, reco_vector, size=None):
@@ -371,33 +714,114 @@ class PoissonData(DataModel):
 class SystematicsConsumer(object):
     """Class that consumes the systematics axis on an array of log likelihoods."""
 
+    # Whether `consume_gradient` is implemented
+    has_gradient = False
+
     @staticmethod
     def consume_axis(log_likelihood, weights=None):
         """Collapse the systematic axes according to the systematics mode."""
         raise NotImplementedError("Must be implemented in a subclass!")
 
+    @staticmethod
+    def consume_gradient(log_likelihood, gradient, weights=None):
+        """Calculate the gradient of the collapsed log likelihood.
+
+        Parameters
+        ----------
+
+        log_likelihood : ndarray
+            The log likelihoods before consuming the systematics axis.
+            Shape: ``(...,n_systematics)``
+        gradient : ndarray
+            The gradients of the log likelihoods.
+            Shape: ``(...,n_systematics,n_parameters)``
+        weights : ndarray, optional
+            The weights of the systematics.
+
+        Returns
+        -------
+
+        gradient : ndarray
+            Shape: ``(...,n_parameters)``
+
+        """
+        raise NotImplementedError("Must be implemented in a subclass!")
+
+    @classmethod
+    def consume_axis_chunks(cls, chunks):
+        """Collapse the systematic axes of log likelihoods calculated in chunks.
+
+        Parameters
+        ----------
+
+        chunks : iterable of (log_likelihood, weights)
+            Consecutive parts of the systematics axis with their weights.
+
+        Notes
+        -----
+
+        The default implementation concatenates all chunks. Subclasses
+        can reduce the chunks one after the other instead, so only one chunk
+        is held in memory at a time.
+
+        """
+        log_likelihood, weights = zip(*chunks)
+        log_likelihood = np.concatenate(log_likelihood, axis=-1)
+        weights = np.concatenate(weights, axis=-1)
+        return cls.consume_axis(log_likelihood, weights)
+
     def __call__(self, *args, **kwargs):
         return self.consume_axis(*args, **kwargs)
 
 class NoSystematics(SystematicsConsumer):
     """SystematicsConsumer that does nothing."""
 
+    has_gradient = True
+
     @staticmethod
     def consume_axis(log_likelihood, weights=None):
         return log_likelihood
 
+    @staticmethod
+    def consume_gradient(log_likelihood, gradient, weights=None):
+        return gradient
+
+def _compact_weights(weights):
+    """Remove the broadcast axes of weights, keeping them with length 1.
+
+    The last (systematics) axis is never compacted, since its length is
+    needed for the normalisation.
+
+    """
+    weights = np.asarray(weights)
+    index = tuple(slice(0, 1) if stride == 0 else slice(None) for stride in weights.strides[:-1])
+    return weights[index + (Ellipsis,)]
+
 class MarginalLikelihoodSystematics(SystematicsConsumer):
     """SystematicsConsumer that averages over the systematic axis.
 
-    Optionally applies weights.
+    Optionally applies weights. Without weights, all systematics have the
+    same weight.
 
     """
 
+    has_gradient = True
+
     @staticmethod
-    def consume_axis(log_likelihood, weights=None):
+    def _log_weights(log_likelihood, weights):
+        """Get the normalised log weights."""
         if weights is None:
-            weights = np.ones_like(log_likelihood)
-        log_weights = np.log(weights / np.sum(weights, axis=-1, keepdims=True))
+            # Uniform weights
+            return -np.log(log_likelihood.shape[-1])
+        # Calculate the weights only once for broadcast dimensions
+        weights = _compact_weights(weights)
+        with np.errstate(divide='ignore'):
+            # Variations with zero weight do not contribute
+            return np.log(weights / np.sum(weights, axis=-1, keepdims=True))
+
+    @staticmethod
+    def consume_axis(log_likelihood, weights=None):
+        log_weights = MarginalLikelihoodSystematics._log_weights(log_likelihood, weights)
         weighted = log_likelihood + log_weights
         # Avoid numerical problems by using this "trick"
         max_weighted = np.max(weighted, axis=-1, keepdims=True)
@@ -408,13 +832,64 @@ class MarginalLikelihoodSystematics(SystematicsConsumer):
             ret = max_weighted[...,0] + np.logaddexp.reduce(weighted, axis=-1)
         return ret
 
+    @staticmethod
+    def consume_gradient(log_likelihood, gradient, weights=None):
+        # The gradient of the log of the weighted mean is the mean of the
+        # gradients, weighted with the posterior probabilities of the systematics
+        log_weights = MarginalLikelihoodSystematics._log_weights(log_likelihood, weights)
+        weighted = log_likelihood + log_weights
+        max_weighted = np.max(weighted, axis=-1, keepdims=True)
+        max_weighted[~np.isfinite(max_weighted)] = 0.
+        with np.errstate(under='ignore'):
+            probabilities = np.exp(weighted - max_weighted)
+        norm = np.sum(probabilities, axis=-1, keepdims=True)
+        norm[norm == 0] = 1.
+        probabilities /= norm
+        if not np.all(np.isfinite(gradient)):
+            # Variations with infinitely bad likelihoods do not contribute
+            gradient = np.where(probabilities[...,np.newaxis] > 0, gradient, 0.)
+        return np.matmul(probabilities[...,np.newaxis,:], gradient)[...,0,:]
+
+    @classmethod
+    def consume_axis_chunks(cls, chunks):
+        # Streaming log-sum-exp of the weighted likelihoods
+        total = -np.inf
+        weight_sum = 0.
+        for log_likelihood, weights in chunks:
+            weights = _compact_weights(weights)
+            with np.errstate(divide='ignore'):
+                weighted = log_likelihood + np.log(weights)
+            max_weighted = np.max(weighted, axis=-1, keepdims=True)
+            max_weighted[~np.isfinite(max_weighted)] = 0.
+            with np.errstate(under='ignore', divide='ignore'):
+                partial = max_weighted[...,0] + np.log(np.sum(np.exp(weighted - max_weighted), axis=-1))
+            total = np.logaddexp(total, partial)
+            weight_sum = weight_sum + np.sum(weights, axis=-1)
+        return total - np.log(weight_sum)
+
 class ProfileLikelihoodSystematics(SystematicsConsumer):
     """SystematicsConsumer that maximises over the systematic axes."""
 
+    has_gradient = True
+
     @staticmethod
     def consume_axis(log_likelihood, weights=None):
         return np.max(log_likelihood, axis=-1)
 
+    @classmethod
+    def consume_axis_chunks(cls, chunks):
+        # Running maximum
+        ret = -np.inf
+        for log_likelihood, weights in chunks:
+            ret = np.maximum(ret, np.max(log_likelihood, axis=-1))
+        return ret
+
+    @staticmethod
+    def consume_gradient(log_likelihood, gradient, weights=None):
+        # The gradient of the maximum is the gradient of the maximal element
+        i_max = np.argmax(log_likelihood, axis=-1)[...,np.newaxis,np.newaxis]
+        return np.take_along_axis(gradient, i_max, axis=-2)[...,0,:]
+
 class Predictor(object):
     """Base class for objects that turn sets of parameters to predictions.
 
@@ -436,6 +911,9 @@ class Predictor(object):
 
     """
 
+    # Whether `vector_jacobian_product` is implemented
+    has_jacobian = False
+
     def __init__(self, bounds, defaults):
         self.bounds = np.asarray(bounds)
         self.defaults = np.asarray(defaults)
@@ -486,6 +964,37 @@ class Predictor(object):
 
         raise NotImplementedError("This function must be implemented in a subclass!")
 
+    def vector_jacobian_product(self, parameters, vector, systematics_index=slice(None)):
+        """Multiply a vector with the Jacobian matrix of the prediction.
+
+        This is the gradient of ``sum(vector * prediction)`` with respect to the
+        parameters, calculated separately for each systematic variation.
+
+        Parameters
+        ----------
+
+        parameters : ndarray
+            Shape: ``([c,d,...,]n_parameters,)``
+        vector : ndarray
+            Shape: ``([a,b,...,][c,d,...,]n_systematics,n_predictions,)``
+        systematics_index : int, optional
+
+        Returns
+        -------
+
+        product : ndarray
+            Shape: ``([a,b,...,][c,d,...,]n_systematics,n_parameters,)``
+
+        Notes
+        -----
+
+        If the `systematics_index` is specified, the `vector` and the
+        product do not have a systematics axis.
+
+        """
+
+        raise NotImplementedError("This function must be implemented in a subclass!")
+
     def fix_parameters(self, fix_values):
         """Return a new Predictor with fewer free parameters.
 
@@ -498,6 +1007,59 @@ class Predictor(object):
 
         return FixedParameterPredictor(self, fix_values)
 
+    def compile(self):
+        """Return an equivalent Predictor that is faster to evaluate.
+
+        Chains of linear predictors are collapsed into a single matrix, fixed
+        parameters are turned into constants and the `sparse_indices` of
+        linear predictors are folded into their matrices. Every prediction
+        then needs only one matrix product.
+
+        The compiled predictor might need more memory than the original one,
+        e.g. the product of composed matrices can have more non-zero elements
+        than its factors.
+
+        """
+
+        return self
+
+    def _get_wrapped_predictors(self):
+        """Return the list of predictors this predictor is based on."""
+        ret = []
+        if 'predictor' in self.__dict__:
+            ret.append(self.predictor)
+        ret.extend(self.__dict__.get('predictors', []))
+        return ret
+
+    def share_memory(self):
+        """Move the large arrays of the predictor into shared memory.
+
+        When the predictor is pickled afterwards, e.g. to be sent to a worker
+        of a :class:`multiprocessing.Pool`, only references to the shared
+        memory are transferred instead of the arrays themselves. Workers on
+        the same machine access the same memory without copying it. This
+        includes all predictors that this predictor is based on.
+
+        The shared memory is freed with :meth:`release_shared_memory`. This
+        must be done by the process that called this method. Requires Python
+        3.8 or newer.
+
+        """
+        for pred in self._get_wrapped_predictors():
+            pred.share_memory()
+
+    def release_shared_memory(self):
+        """Move the shared arrays back to private memory and free the shared memory."""
+        _release_shared_attributes(self)
+        for pred in self._get_wrapped_predictors():
+            pred.release_shared_memory()
+
+    def __getstate__(self):
+        return _get_shared_state(self)
+
+    def __setstate__(self, state):
+        _set_shared_state(self, state)
+
     def compose(self, other):
         """Return a new Predictor that is a composition with `other`.
 
@@ -584,6 +1146,19 @@ class ComposedPredictor(Predictor):
 
         return parameters, weights
 
+    def compile(self):
+        """Return an equivalent Predictor that is faster to evaluate.
+
+        See :meth:`Predictor.compile`.
+
+        """
+
+        predictors = [ pred.compile() for pred in self.predictors ]
+        if all(isinstance(pred, LinearPredictor) for pred in predictors):
+            return ComposedLinearPredictor(predictors)
+        else:
+            return ComposedPredictor(predictors)
+
 class FixedParameterPredictor(Predictor):
     """Wrapper class that fixes parameters of another predictor."""
 
@@ -595,6 +1170,9 @@ class FixedParameterPredictor(Predictor):
         self.insert_values = self.fix_values[insert_indices]
         # Indices must be provided as indices on the array with the missing values
         self.insert_indices = insert_indices - np.arange(insert_indices.size)
+        # Scatter indices to fill the full parameter vectors directly
+        self._fixed_indices = insert_indices
+        self._free_indices = np.argwhere(~insert_mask).flatten()
 
         self.bounds = predictor.bounds[~insert_mask]
         self.defaults = predictor.defaults[~insert_mask]
@@ -602,7 +1180,11 @@ class FixedParameterPredictor(Predictor):
     def insert_fixed_parameters(self, parameters):
         """Insert the fixed parameters into a vector of free parameters."""
         parameters = np.asarray(parameters)
-        return np.insert(parameters, self.insert_indices, self.insert_values, axis=-1)
+        dtype = np.result_type(parameters, self.fix_values)
+        full = np.empty(parameters.shape[:-1] + self.fix_values.shape, dtype=dtype)
+        full[...,self._fixed_indices] = self.insert_values
+        full[...,self._free_indices] = parameters
+        return full
 
     def prediction(self, parameters, systematics_index=slice(None)):
         """Turn a set of parameters into an ndarray of predictions.
@@ -623,6 +1205,30 @@ class FixedParameterPredictor(Predictor):
         parameters = self.insert_fixed_parameters(parameters)
         return self.predictor(parameters, systematics_index)
 
+    @property
+    def has_jacobian(self):
+        return self.predictor.has_jacobian
+
+    def vector_jacobian_product(self, parameters, vector, systematics_index=slice(None)):
+        """Multiply a vector with the Jacobian matrix of the prediction.
+
+        See :meth:`Predictor.vector_jacobian_product`.
+
+        """
+
+        parameters = self.insert_fixed_parameters(parameters)
+        product = self.predictor.vector_jacobian_product(parameters, vector, systematics_index)
+        return product[...,self._free_indices]
+
+    def compile(self):
+        """Return an equivalent Predictor that is faster to evaluate.
+
+        See :meth:`Predictor.compile`.
+
+        """
+
+        return self.predictor.compile().fix_parameters(self.fix_values)
+
 class LinearPredictor(Predictor):
     """Predictor that uses a matrix to fold parameters into reco space.
 
@@ -633,8 +1239,11 @@ class LinearPredictor(Predictor):
     Parameters
     ----------
 
-    matrices : ndarray
+    matrices : ndarray or list of scipy.sparse matrices
         Shape: ``([n_systematics,]n_reco_bins,n_parameters)``
+        If a list of :mod:`scipy.sparse` matrices is provided, one for each
+        systematic variation, the predictions are calculated without ever
+        creating the dense matrices.
     constants : ndarray, optional
         Shape: ``([n_systematics,]n_reco_bins)``
     weights : ndarray, optional
@@ -647,15 +1256,55 @@ class LinearPredictor(Predictor):
         Used with sparse matrices that provide only the specified columns.
         All other columns are assumed to be 0, i.e. the parameters corresponding
         to these have no effect.
+    dtype : numpy.dtype, optional
+        The data type of the matrices and constants. The predictions are
+        calculated in this type, e.g. ``numpy.float32`` halves the memory
+        bandwidth needed for the matrix products.
+        Default: The type of `matrices` if it is a floating point type,
+        otherwise ``float``.
+    low_rank : float or tuple of ndarray, optional
+        Store the systematic variations of the matrices as a low-rank
+        decomposition. If this is a float, the matrices are decomposed with
+        :meth:`decompose_systematics` using it as tolerance. Alternatively,
+        this can be the tuple ``(mean, basis, coefficients)`` of an earlier
+        decomposition, in which case `matrices` is ignored.
 
     See also
     --------
 
     Predictor
 
+    Notes
+    -----
+
+    The systematic variations of the matrices are often highly correlated,
+    e.g. statistical variations of the same response matrix. With the
+    `low_rank` option, each matrix is represented as the mean matrix plus a
+    linear combination of a few basis matrices::
+
+        matrices[i] = mean + sum_j coefficients[i,j] * basis[j]
+
+    The predictions are then calculated as::
+
+        prediction[i] = mean X parameters + coefficients[i] X (basis X parameters)
+
+    This is much faster than the product with the full stack of matrices if
+    the rank is much smaller than the number of systematic variations. The
+    vector-Jacobian products of the gradient calculation are factorized the
+    same way. Fixing parameters and composing the predictor with other
+    linear predictors keep the decomposition, so the full matrices are never
+    reconstructed, unless :attr:`matrices` is accessed.
+
     Attributes
     ----------
 
+    matrices : ndarray
+        The dense matrices. If the predictor was created from sparse
+        matrices or uses a low-rank decomposition, they are reconstructed
+        every time this is accessed and not stored.
+    sparse_matrix : scipy.sparse.csr_matrix or None
+        The sparse matrices of all systematics stacked on top of each other.
+        Shape: ``(n_systematics*n_reco_bins,n_parameters)``
     bounds : ndarray
         Lower and upper bounds for all parameters. Can be ``+/- np.inf``.
     defaults : ndarray
@@ -664,29 +1313,206 @@ class LinearPredictor(Predictor):
         Used with sparse matrices that provide only the specified columns.
         All other columns are assumed to be 0, i.e. the parameters corresponding
         to these have no effect.
+    dtype : numpy.dtype
+        The data type used for the predictions.
+    low_rank_mean, low_rank_basis, low_rank_coefficients : ndarray or None
+        The low-rank decomposition of the matrices, if it is used.
+        Shapes: ``(n_reco_bins,n_parameters)``,
+        ``(rank,n_reco_bins,n_parameters)`` and ``(n_systematics,rank)``
 
     """
 
-    def __init__(self, matrices, constants=0., weights=1., bounds=None, defaults=None, sparse_indices=None):
-        self.matrices = np.asfarray(matrices)
-        while self.matrices.ndim < 3:
-            self.matrices = self.matrices[np.newaxis,...]
-        self.constants = np.asfarray(constants)
+    has_jacobian = True
+
+    def __init__(self, matrices, constants=0., weights=1., bounds=None, defaults=None, sparse_indices=None, dtype=None, low_rank=None):
+        self.low_rank_mean = self.low_rank_basis = self.low_rank_coefficients = None
+        if low_rank is not None and not np.isscalar(low_rank):
+            self._set_low_rank(low_rank, dtype)
+        elif isinstance(matrices, (list, tuple)) and len(matrices) > 0 and sparse.issparse(matrices[0]):
+            if dtype is None:
+                dtype = matrices[0].dtype
+                if not np.issubdtype(dtype, np.floating):
+                    dtype = float
+            self.sparse_matrix = sparse.vstack(matrices, format='csr', dtype=dtype)
+            self._matrices_shape = (len(matrices),) + matrices[0].shape
+            self._matrices = None
+            # Map systematics indices to rows of the stacked sparse matrix
+            self._sparse_rows = np.arange(self.sparse_matrix.shape[0]).reshape(self._matrices_shape[:2])
+        else:
+            self.sparse_matrix = None
+            self.matrices = np.asarray(matrices, dtype=dtype)
+            if not np.issubdtype(self.matrices.dtype, np.floating):
+                self.matrices = self.matrices.astype(float)
+            while self.matrices.ndim < 3:
+                self.matrices = self.matrices[np.newaxis,...]
+            self._matrices_shape = self.matrices.shape
+        if self.low_rank_basis is not None:
+            self.dtype = self.low_rank_basis.dtype
+        elif self.sparse_matrix is None:
+            self.dtype = self.matrices.dtype
+        else:
+            self.dtype = self.sparse_matrix.dtype
+        if np.isscalar(low_rank):
+            self._set_low_rank(self.decompose_systematics(self.matrices, low_rank), self.dtype)
+        self.constants = np.asarray(constants, dtype=self.dtype)
         while self.constants.ndim < 2:
             self.constants = self.constants[np.newaxis,...]
         self.weights = np.asfarray(weights)
         while self.weights.ndim < 1:
             self.weights = self.weights[np.newaxis,...]
+        # Make sure systematics indices also work for shared constants and weights
+        n_syst = self._matrices_shape[0]
+        if self.constants.shape[0] == 1:
+            self.constants = np.broadcast_to(self.constants, (n_syst,) + self.constants.shape[1:])
+        if self.weights.shape[0] == 1:
+            self.weights = np.broadcast_to(self.weights, (n_syst,) + self.weights.shape[1:])
         if bounds is None:
-            bounds = np.array([(-np.inf, np.inf)] * self.matrices.shape[-1])
+            bounds = np.array([(-np.inf, np.inf)] * self._matrices_shape[-1])
         if defaults is None:
-            defaults = np.array([1.] * self.matrices.shape[-1])
+            defaults = np.array([1.] * self._matrices_shape[-1])
         if sparse_indices is None:
             self.sparse_indices = slice(None)
         else:
             self.sparse_indices = sparse_indices
         Predictor.__init__(self, bounds, defaults)
 
+    @staticmethod
+    def decompose_systematics(matrices, tolerance=1e-3):
+        """Decompose the systematic variations of matrices into a low-rank form.
+
+        Parameters
+        ----------
+
+        matrices : ndarray
+            Shape: ``(n_systematics,n_reco_bins,n_parameters)``
+        tolerance : float, optional
+            The maximum allowed Frobenius norm of the difference between the
+            original and the decomposed matrices, relative to the norm of the
+            deviations of the matrices from their mean.
+
+        Returns
+        -------
+
+        mean : ndarray
+            Shape: ``(n_reco_bins,n_parameters)``
+        basis : ndarray
+            Shape: ``(rank,n_reco_bins,n_parameters)``
+        coefficients : ndarray
+            Shape: ``(n_systematics,rank)``
+
+        Notes
+        -----
+
+        The decomposition is a truncated singular value decomposition of the
+        deviations from the mean matrix, i.e. a principal component analysis
+        of the systematic variations.
+
+        """
+
+        matrices = np.asfarray(matrices)
+        n_syst = matrices.shape[0]
+        mean = np.mean(matrices, axis=0)
+        deviations = (matrices - mean).reshape((n_syst, -1))
+        U, S, Vt = np.linalg.svd(deviations, full_matrices=False)
+        # Norm of the residuals when keeping only the first i components
+        residuals = np.sqrt(np.cumsum(S[::-1]**2)[::-1])
+        rank = np.count_nonzero(residuals > tolerance * np.linalg.norm(S))
+        basis = Vt[:rank].reshape((rank,) + mean.shape)
+        coefficients = U[:,:rank] * S[:rank]
+        return mean, basis, coefficients
+
+    def _set_low_rank(self, low_rank, dtype):
+        """Use a low-rank decomposition instead of the full matrices."""
+        mean, basis, coefficients = ( np.asarray(x, dtype=dtype) for x in low_rank )
+        if not np.issubdtype(basis.dtype, np.floating):
+            mean, basis, coefficients = ( x.astype(float) for x in (mean, basis, coefficients) )
+        self.low_rank_mean = mean
+        self.low_rank_basis = basis
+        self.low_rank_coefficients = coefficients
+        self.sparse_matrix = None
+        self._matrices = None
+        self._matrices_shape = coefficients.shape[:1] + mean.shape
+
+    def share_memory(self):
+        """Move the matrices and constants into shared memory.
+
+        See :meth:`Predictor.share_memory`.
+
+        """
+        if self.low_rank_basis is not None:
+            _share_attributes(self, ['low_rank_mean', 'low_rank_basis', 'low_rank_coefficients', 'constants'])
+        elif self.sparse_matrix is None:
+            _share_attributes(self, ['_matrices', 'constants'])
+        else:
+            M = self.sparse_matrix
+            self._sparse_data = M.data
+            self._sparse_indices = M.indices
+            self._sparse_indptr = M.indptr
+            _share_attributes(self, ['_sparse_data', '_sparse_indices', '_sparse_indptr', 'constants'])
+            self._build_sparse_matrix()
+        Predictor.share_memory(self)
+
+    def release_shared_memory(self):
+        """Move the shared arrays back to private memory and free the shared memory."""
+        is_shared_sparse = '_sparse_data' in self.__dict__
+        if is_shared_sparse:
+            # Drop the references to the shared buffers before releasing them
+            self.sparse_matrix = None
+        Predictor.release_shared_memory(self)
+        if is_shared_sparse:
+            self._build_sparse_matrix()
+            del self._sparse_data, self._sparse_indices, self._sparse_indptr
+
+    def _build_sparse_matrix(self):
+        """Re-create the sparse matrix from its (shared) component arrays."""
+        shape = (self._matrices_shape[0]*self._matrices_shape[1], self._matrices_shape[2])
+        self.sparse_matrix = sparse.csr_matrix((self._sparse_data, self._sparse_indices, self._sparse_indptr), shape=shape, copy=False)
+
+    def __getstate__(self):
+        state = Predictor.__getstate__(self)
+        if '_sparse_data' in state:
+            # Matrix is re-created from the shared components
+            state['sparse_matrix'] = None
+        return state
+
+    def __setstate__(self, state):
+        Predictor.__setstate__(self, state)
+        if '_sparse_data' in state:
+            self._build_sparse_matrix()
+
+    @property
+    def matrices(self):
+        if self._matrices is not None:
+            return self._matrices
+        if self.low_rank_basis is not None:
+            return self.low_rank_mean + np.tensordot(self.low_rank_coefficients, self.low_rank_basis, axes=1)
+        return self.sparse_matrix.toarray().reshape(self._matrices_shape)
+
+    @matrices.setter
+    def matrices(self, value):
+        self._matrices = value
+
+    def _sparse_prediction(self, parameters, systematics_index):
+        """Calculate the prediction with the sparse matrix."""
+        rows = self._sparse_rows[systematics_index]
+        if _is_full_slice(systematics_index):
+            matrix = self.sparse_matrix
+        else:
+            matrix = self.sparse_matrix[rows.flatten()]
+        flat = parameters.reshape((-1, parameters.shape[-1]))
+        prediction = np.asarray(matrix.dot(flat.T).T)
+        return prediction.reshape(parameters.shape[:-1] + rows.shape)
+
+    def _low_rank_prediction(self, parameters, systematics_index):
+        """Calculate the prediction with the low-rank decomposition."""
+        coefficients = self.low_rank_coefficients[systematics_index]
+        mean = np.tensordot(parameters, self.low_rank_mean, axes=((-1,),(-1,)))
+        projections = np.tensordot(parameters, self.low_rank_basis, axes=((-1,),(-1,)))
+        prediction = np.matmul(coefficients, projections)
+        if coefficients.ndim > 1:
+            mean = mean[...,np.newaxis,:]
+        return prediction + mean
+
     def prediction(self, parameters, systematics_index=slice(None)):
         """Turn a set of parameters into a reco prediction.
 
@@ -697,16 +1523,100 @@ class LinearPredictor(Predictor):
         weights : ndarray
 
         """
-        matrix = self.matrices[systematics_index]
         weights = self.weights[systematics_index]
         constants = self.constants[systematics_index]
 
-        parameters = np.asarray(parameters)[...,self.sparse_indices]
-        prediction = np.tensordot(parameters, matrix, axes=((-1,),(-1,)))
+        parameters = np.asarray(parameters, dtype=self.dtype)
+        if not _is_full_slice(self.sparse_indices):
+            parameters = parameters[...,self.sparse_indices]
+        if self.low_rank_basis is not None:
+            prediction = self._low_rank_prediction(parameters, systematics_index)
+        elif self.sparse_matrix is None:
+            matrix = self.matrices[systematics_index]
+            prediction = np.tensordot(parameters, matrix, axes=((-1,),(-1,)))
+        else:
+            prediction = self._sparse_prediction(parameters, systematics_index)
         prediction += constants
         weights = np.broadcast_to(weights, prediction.shape[:-1])
         return prediction, weights
 
+    def is_non_negative(self):
+        """Check whether all matrix elements and constants are non-negative.
+
+        The result is cached.
+
+        """
+        if getattr(self, '_non_negative', None) is None:
+            if self.low_rank_basis is not None:
+                non_negative = self._low_rank_non_negative()
+            elif self.sparse_matrix is None:
+                non_negative = np.all(self.matrices >= 0)
+            else:
+                non_negative = np.all(self.sparse_matrix.data >= 0)
+            self._non_negative = bool(non_negative and np.all(self.constants >= 0))
+        return self._non_negative
+
+    def _low_rank_non_negative(self, chunk_size=64):
+        """Check the reconstructed matrices chunk by chunk, without storing them."""
+        coefficients = self.low_rank_coefficients
+        for i in range(0, len(coefficients), chunk_size):
+            matrices = self.low_rank_mean + np.tensordot(coefficients[i:i+chunk_size], self.low_rank_basis, axes=1)
+            if not np.all(matrices >= 0):
+                return False
+        return True
+
+    def _low_rank_vector_product(self, vector, systematics_index):
+        """Multiply a vector with the low-rank matrices from the left."""
+        coefficients = self.low_rank_coefficients[systematics_index]
+        product = np.tensordot(vector, self.low_rank_mean, axes=((-1,),(0,)))
+        # Product with each basis matrix, then weighted with the coefficients
+        projections = np.tensordot(vector, self.low_rank_basis, axes=((-1,),(1,)))
+        product += np.matmul(coefficients[...,np.newaxis,:], projections)[...,0,:]
+        return product
+
+    def _sparse_vector_product(self, vector, systematics_index):
+        """Multiply a vector with the sparse matrix from the left."""
+        rows = self._sparse_rows[systematics_index]
+        rows = rows.reshape((-1, rows.shape[-1]))
+        n_syst, n_reco = rows.shape
+        flat = vector.reshape((-1, n_syst*n_reco))
+        n_vec = flat.shape[0]
+        # Block diagonal matrix that multiplies each systematic's vector with its rows
+        blocks = sparse.csr_matrix((flat.flatten(), np.tile(rows.flatten(), n_vec), np.arange(n_vec*n_syst+1)*n_reco),
+                shape=(n_vec*n_syst, self.sparse_matrix.shape[0]))
+        product = blocks.dot(self.sparse_matrix).toarray()
+        return product.reshape(vector.shape[:-1] + (product.shape[-1],))
+
+    def vector_jacobian_product(self, parameters, vector, systematics_index=slice(None)):
+        """Multiply a vector with the Jacobian matrix of the prediction.
+
+        For a linear predictor, this is simply the product with the matrix.
+        See :meth:`Predictor.vector_jacobian_product`.
+
+        """
+        parameters = np.asarray(parameters)
+        vector = np.asarray(vector, dtype=self.dtype)
+        if self.low_rank_basis is not None:
+            product = self._low_rank_vector_product(vector, systematics_index)
+        elif self.sparse_matrix is None:
+            matrix = self.matrices[systematics_index]
+            if matrix.ndim == 2:
+                product = np.dot(vector, matrix)
+            else:
+                # One matrix product per systematic variation
+                n_syst, n_reco = vector.shape[-2:]
+                flat = np.moveaxis(vector.reshape((-1, n_syst, n_reco)), 1, 0)
+                product = np.matmul(flat, matrix)
+                product = np.moveaxis(product, 0, 1).reshape(vector.shape[:-1] + matrix.shape[-1:])
+        else:
+            product = self._sparse_vector_product(vector, systematics_index)
+        if _is_full_slice(self.sparse_indices):
+            return product
+        # Parameters that are not in the sparse matrix have no influence
+        ret = np.zeros(product.shape[:-1] + parameters.shape[-1:], dtype=product.dtype)
+        ret[...,self.sparse_indices] = product
+        return ret
+
     def compose(self, other):
         """Return a new Predictor that is a composition with `other`.
 
@@ -733,11 +1643,161 @@ class LinearPredictor(Predictor):
 
         return FixedParameterLinearPredictor(self, fix_values)
 
-class ComposedLinearPredictor(LinearPredictor, ComposedPredictor):
-    """Composition of LinearPredictors.
+    def select_systematics(self, indices, weights=None):
+        """Return a new LinearPredictor with only some of the systematic variations.
 
-    Parameters
-    ----------
+        Parameters
+        ----------
+
+        indices : array like of int
+            The indices of the selected variations on the systematics axis.
+        weights : array like, optional
+            The new weights of the selected variations.
+            Default: Their original weights.
+
+        """
+
+        indices = np.asarray(indices, dtype=int)
+        if weights is None:
+            weights = self.weights[indices]
+        kwargs = dict(constants=self.constants[indices], weights=weights, bounds=self.bounds,
+                      defaults=self.defaults, sparse_indices=self.sparse_indices, dtype=self.dtype)
+        if self.low_rank_basis is not None:
+            low_rank = (self.low_rank_mean, self.low_rank_basis, self.low_rank_coefficients[indices])
+            return LinearPredictor(None, low_rank=low_rank, **kwargs)
+        elif self.sparse_matrix is None:
+            return LinearPredictor(self.matrices[indices], **kwargs)
+        else:
+            n_reco = self._matrices_shape[1]
+            matrices = [ self.sparse_matrix[i*n_reco:(i+1)*n_reco] for i in indices ]
+            return LinearPredictor(matrices, **kwargs)
+
+    def _split_sparse_matrix(self, matrix):
+        """Split a stacked sparse matrix into one matrix per systematic."""
+        n_syst, n_reco = self._matrices_shape[:2]
+        return [ matrix[i*n_reco:(i+1)*n_reco] for i in range(n_syst) ]
+
+    def _folded_low_rank(self):
+        """Return the low-rank decomposition with the `sparse_indices` folded in."""
+        mean, basis, coefficients = self.low_rank_mean, self.low_rank_basis, self.low_rank_coefficients
+        if not _is_full_slice(self.sparse_indices):
+            n_parameters = len(self.bounds)
+            folded_mean = np.zeros(mean.shape[:-1] + (n_parameters,), dtype=self.dtype)
+            folded_mean[...,self.sparse_indices] = mean
+            folded_basis = np.zeros(basis.shape[:-1] + (n_parameters,), dtype=self.dtype)
+            folded_basis[...,self.sparse_indices] = basis
+            mean, basis = folded_mean, folded_basis
+        return mean, basis, coefficients
+
+    def _low_rank_factors(self):
+        """Return the folded matrices as low-rank decomposition.
+
+        Predictors without a decomposition are expressed as a trivial one.
+        The returned mean is ``None`` if it is zero.
+
+        """
+
+        if self.low_rank_basis is not None:
+            return self._folded_low_rank()
+        matrices = self._folded_matrices()
+        if not isinstance(matrices, np.ndarray):
+            matrices = np.array([ M.toarray() for M in matrices ])
+        if len(matrices) == 1:
+            return matrices[0], matrices[:0], np.zeros((1, 0), dtype=matrices.dtype)
+        return None, matrices, np.eye(len(matrices), dtype=matrices.dtype)
+
+    def _folded_matrices(self):
+        """Return the matrices with the `sparse_indices` folded in.
+
+        Sparse matrices are returned as list of sparse matrices, one for each
+        systematic variation.
+
+        """
+
+        n_parameters = len(self.bounds)
+        if self.sparse_matrix is None:
+            if _is_full_slice(self.sparse_indices):
+                return self.matrices
+            matrices = np.zeros(self._matrices_shape[:2] + (n_parameters,), dtype=self.dtype)
+            matrices[...,self.sparse_indices] = self.matrices
+            return matrices
+        else:
+            M = self.sparse_matrix
+            columns = np.arange(n_parameters)[self.sparse_indices]
+            M = sparse.csr_matrix((M.data, columns[M.indices], M.indptr), shape=(M.shape[0], n_parameters))
+            return self._split_sparse_matrix(M)
+
+    def compile(self):
+        """Return an equivalent Predictor that is faster to evaluate.
+
+        See :meth:`Predictor.compile`.
+
+        """
+
+        if _is_full_slice(self.sparse_indices):
+            return self
+        if self.low_rank_basis is not None:
+            return LinearPredictor(None, constants=self.constants, weights=self.weights,
+                    bounds=self.bounds, defaults=self.defaults, low_rank=self._folded_low_rank())
+        return LinearPredictor(self._folded_matrices(), constants=self.constants, weights=self.weights,
+                bounds=self.bounds, defaults=self.defaults, dtype=self.dtype)
+
+def _compose_low_rank(first, second):
+    """Multiply each matrix of one low-rank decomposition with each of another.
+
+    The decompositions are tuples ``(mean, basis, coefficients)`` like the
+    ones of :meth:`LinearPredictor._low_rank_factors`. The systematics of the
+    first one vary slowest in the result.
+
+    """
+
+    mean0, basis0, coefficients0 = first
+    mean1, basis1, coefficients1 = second
+    n0, n1 = len(coefficients0), len(coefficients1)
+    rank0, rank1 = len(basis0), len(basis1)
+    shape = basis0.shape[1:-1] + basis1.shape[-1:]
+    # (mean0 + sum_k c0[i,k] basis0[k]) X (mean1 + sum_l c1[j,l] basis1[l])
+    bases = [ np.matmul(basis0[:,np.newaxis], basis1[np.newaxis,:]).reshape((rank0*rank1,) + shape) ]
+    coefficients = [ (coefficients0[:,np.newaxis,:,np.newaxis] * coefficients1[np.newaxis,:,np.newaxis,:]).reshape((n0*n1, rank0*rank1)) ]
+    if mean1 is not None:
+        bases.append(np.matmul(basis0, mean1))
+        coefficients.append(np.repeat(coefficients0, n1, axis=0))
+    if mean0 is not None:
+        bases.append(np.matmul(mean0, basis1))
+        coefficients.append(np.tile(coefficients1, (n0, 1)))
+    if mean0 is None or mean1 is None:
+        mean = None
+    else:
+        mean = np.dot(mean0, mean1)
+    return mean, np.concatenate(bases), np.concatenate(coefficients, axis=1)
+
+def _low_rank_dot(decomposition, vectors):
+    """Multiply each matrix of a low-rank decomposition with each vector.
+
+    Returns an array of shape ``(n_matrices, n_vectors, n_rows)``.
+
+    """
+
+    mean, basis, coefficients = decomposition
+    projections = np.tensordot(basis, vectors, axes=((-1,),(-1,)))
+    product = np.einsum('ik,krv->ivr', coefficients, projections)
+    if mean is not None:
+        product += np.dot(vectors, mean.T)
+    return product
+
+def _sparse_nbytes(matrices):
+    """Memory used by a list of sparse matrices."""
+    return sum(M.data.nbytes + M.indices.nbytes + M.indptr.nbytes for M in matrices)
+
+def _dense_nbytes(matrices):
+    """Memory needed by a list of sparse matrices when they are densified."""
+    return sum(np.prod(M.shape, dtype=int) * M.dtype.itemsize for M in matrices)
+
+class ComposedLinearPredictor(LinearPredictor, ComposedPredictor):
+    """Composition of LinearPredictors.
+
+    Parameters
+    ----------
 
     predictors : list of Predictor
         The Predictors will be composed in turn. The second must predict
@@ -745,6 +1805,17 @@ class ComposedLinearPredictor(LinearPredictor, ComposedPredictor):
         Predictor defines what parameters will be accepted by the resulting
         Predictor.
 
+    Notes
+    -----
+
+    The matrices of the predictors are multiplied when the composition is
+    created. The result has the data type of the first predictor, which
+    calculates the final predictions. If any of them uses a low-rank
+    decomposition, the result is
+    decomposed as well. If any of them is sparse, the matrices are multiplied
+    as sparse matrices, and the result is kept sparse if that needs less
+    memory than dense matrices.
+
     """
 
     def __init__(self, predictors):
@@ -755,18 +1826,55 @@ class ComposedLinearPredictor(LinearPredictor, ComposedPredictor):
         self.bounds = predictors[-1].bounds
         self.defaults = predictors[-1].defaults
 
-        # Use methods of regular ComposedPredictor to calculate everything
-        constants, weights = ComposedPredictor.prediction(self, np.zeros_like(self.defaults))
-        columns = []
-        for i in range(len(self.defaults)):
-            par = np.zeros_like(self.defaults)
-            par[i] = 1.
-            col, _ = ComposedPredictor.prediction(self, par)
-            col -= constants
-            columns.append(col[...,np.newaxis])
-        matrices = np.concatenate(columns, axis=-1)
-
-        LinearPredictor.__init__(self, matrices, constants=constants, weights=weights, bounds=self.bounds, defaults=self.defaults, sparse_indices=None)
+        # Fold the matrices of the chain together, keeping the order of the
+        # systematics of ComposedPredictor: the first predictor's varies slowest.
+        # Low-rank decompositions are folded without reconstructing the matrices.
+        low_rank = any(pred.low_rank_basis is not None for pred in predictors)
+        is_sparse = not low_rank and any(pred.sparse_matrix is not None for pred in predictors)
+        matrices = None
+        for pred in predictors:
+            if low_rank:
+                pred_matrices = pred._low_rank_factors()
+            elif is_sparse:
+                pred_matrices = [ sparse.csr_matrix(M) for M in pred._folded_matrices() ]
+            else:
+                pred_matrices = pred._folded_matrices()
+            pred_constants = np.broadcast_to(pred.constants, pred._matrices_shape[:2])
+            if matrices is None:
+                matrices = pred_matrices
+                constants = pred_constants
+                weights = pred.weights
+                continue
+            n_syst = len(constants) * len(pred_constants)
+            if low_rank:
+                products = _low_rank_dot(matrices, pred_constants)
+                matrices = _compose_low_rank(matrices, pred_matrices)
+            elif is_sparse:
+                # One sparse product per pair of systematics
+                products = np.array([ [ M.dot(c) for c in pred_constants ] for M in matrices ])
+                matrices = [ M.dot(N) for M in matrices for N in pred_matrices ]
+            else:
+                products = np.matmul(matrices[:,np.newaxis], pred_constants[np.newaxis,:,:,np.newaxis])[...,0]
+                matrices = np.matmul(matrices[:,np.newaxis], pred_matrices[np.newaxis,:])
+                matrices = matrices.reshape((n_syst,) + matrices.shape[2:])
+            constants = (products + constants[:,np.newaxis]).reshape((n_syst,) + constants.shape[1:])
+            weights = (weights[:,np.newaxis] * pred.weights[np.newaxis,:]).reshape(n_syst)
+
+        kwargs = dict(constants=constants, weights=weights, bounds=self.bounds, defaults=self.defaults,
+                      sparse_indices=None, dtype=predictors[0].dtype)
+        if low_rank:
+            mean, basis, coefficients = matrices
+            if mean is None:
+                mean = np.zeros(basis.shape[1:], dtype=basis.dtype)
+            if len(basis) < len(coefficients):
+                LinearPredictor.__init__(self, None, low_rank=(mean, basis, coefficients), **kwargs)
+            else:
+                # The decomposition is not smaller than the full matrices
+                LinearPredictor.__init__(self, mean + np.tensordot(coefficients, basis, axes=1), **kwargs)
+        else:
+            if is_sparse and _sparse_nbytes(matrices) >= _dense_nbytes(matrices):
+                matrices = np.array([ M.toarray() for M in matrices ])
+            LinearPredictor.__init__(self, matrices, **kwargs)
 
 class FixedParameterLinearPredictor(LinearPredictor, FixedParameterPredictor):
     """Wrapper class that fixes parameters of a linear predictor."""
@@ -774,13 +1882,21 @@ class FixedParameterLinearPredictor(LinearPredictor, FixedParameterPredictor):
     def __init__(self, predictor, fix_values):
         FixedParameterPredictor.__init__(self, predictor, fix_values)
 
-        matrices = self.predictor.matrices[...,np.isnan(self.fix_values)]
+        matrices = low_rank = None
+        if predictor.low_rank_basis is not None:
+            # Keep the decomposition
+            mean, basis, coefficients = predictor._folded_low_rank()
+            low_rank = (mean[...,self._free_indices], basis[...,self._free_indices], coefficients)
+        elif predictor.sparse_matrix is None:
+            matrices = predictor._folded_matrices()[...,self._free_indices]
+        else:
+            # Keep sparse matrices sparse
+            matrices = [ M[:,self._free_indices] for M in predictor._folded_matrices() ]
 
-        const_par = self.fix_values
-        const_par[np.isnan(self.fix_values)] = 0.
+        const_par = np.where(np.isnan(self.fix_values), 0., self.fix_values)
         constants, weights = self.predictor(const_par)
 
-        LinearPredictor.__init__(self, matrices, constants=constants, weights=weights, bounds=self.bounds, defaults=self.defaults, sparse_indices=None)
+        LinearPredictor.__init__(self, matrices, constants=constants, weights=weights, bounds=self.bounds, defaults=self.defaults, sparse_indices=None, dtype=predictor.dtype, low_rank=low_rank)
 
 class ResponseMatrixPredictor(LinearPredictor):
     """Event rate predictor from ResponseMatrix objects.
@@ -791,12 +1907,44 @@ class ResponseMatrixPredictor(LinearPredictor):
     filename : str or file object
         The exported information of a ResponseMatrix or
         ResponseMatrixArrayBuilder.
+    dtype : numpy.dtype, optional
+        The data type to use for the predictions.
+        Default: The type of the stored matrices.
+    mmap_mode : {None, 'r', 'c'}, optional
+        How to memory map the arrays of a directory export. See
+        :func:`numpy.load`.
+        Default: ``'r'``
+    low_rank : float, optional
+        Decompose the systematic variations of the matrices with this
+        tolerance when loading them. See :class:`LinearPredictor`.
+        Default: Use the full matrices, unless the export already contains
+        a low-rank decomposition.
+
+    Notes
+    -----
+
+    Matrices that were exported in the CSC format are kept as sparse
+    matrices. The predictions are calculated without densifying them.
+    Matrices that were exported with a low-rank decomposition are kept in
+    that form.
+
+    Matrices that were exported as a directory of ``.npy`` files are memory
+    mapped by default. Processes on the same machine that load the same files
+    then share the pages of the operating system's file cache, instead of each
+    holding its own copy of the matrices. This only works if no type
+    conversion is requested with `dtype`.
 
     """
 
-    def __init__(self, filename):
-        data = np.load(filename)
-        matrices = data['matrices']
+    def __init__(self, filename, dtype=None, mmap_mode='r', low_rank=None):
+        data = self._load_arrays(filename, mmap_mode)
+        matrices = None
+        if 'low_rank_basis' in data:
+            low_rank = (data['low_rank_mean'], data['low_rank_basis'], data['low_rank_coefficients'])
+        elif 'csc_data' in data:
+            matrices = self._csc_to_matrices(data)
+        else:
+            matrices = data['matrices']
         constants = 0.
         weights = data.get('weights', 1.)
         if data.get('is_sparse', False):
@@ -806,7 +1954,31 @@ class ResponseMatrixPredictor(LinearPredictor):
         eps = np.finfo(float).eps # Add epsilon so there is a very small allowed range for empty bins
         bounds = [ (0., x+eps) for x in data['truth_entries'] ]
         defaults = data['truth_entries'] / 2.
-        LinearPredictor.__init__(self, matrices, constants=constants, weights=weights, bounds=bounds, defaults=defaults, sparse_indices=sparse_indices)
+        LinearPredictor.__init__(self, matrices, constants=constants, weights=weights, bounds=bounds, defaults=defaults, sparse_indices=sparse_indices, dtype=dtype, low_rank=low_rank)
+
+    @staticmethod
+    def _load_arrays(filename, mmap_mode):
+        """Load the exported arrays from a ``.npz`` archive or a directory."""
+        try:
+            is_directory = os.path.isdir(filename)
+        except TypeError:
+            # File object
+            is_directory = False
+        if not is_directory:
+            return np.load(filename)
+        data = {}
+        for name in os.listdir(filename):
+            key, ext = os.path.splitext(name)
+            if ext == '.npy':
+                data[key] = np.load(os.path.join(filename, name), mmap_mode=mmap_mode)
+        return data
+
+    @staticmethod
+    def _csc_to_matrices(data):
+        """Turn the arrays of the CSC export format into a list of sparse matrices."""
+        n_syst, n_reco, n_truth = data['csc_shape']
+        csc = sparse.csc_matrix((data['csc_data'], data['csc_indices'], data['csc_indptr']), shape=(n_reco, n_syst*n_truth))
+        return [ csc[:,i*n_truth:(i+1)*n_truth] for i in range(n_syst) ]
 
 class TemplatePredictor(LinearPredictor):
     """LinearPredictor from templates.
@@ -845,6 +2017,19 @@ class LikelihoodCalculator(object):
     systematics : {'marginal', 'profile'} or SystematicsConsumer, optional
         Specifies how to handle systematic prediction uncertainties, i.e. multiple
         predictions from a single parameter set.
+    max_memory : int, optional
+        Approximate maximum number of bytes to use for the intermediate
+        arrays of :meth:`log_likelihood`. Larger batches of parameters and
+        the systematics axis of :class:`LinearPredictor` objects are then
+        evaluated in chunks.
+        Default: Evaluate everything at once.
+    cache_size : int, optional
+        Remember the results of this many evaluations of :meth:`log_likelihood`
+        and :meth:`log_likelihood_and_gradient`. Repeated evaluations with the
+        same parameters, e.g. by maximizers that revisit points, then return
+        the stored results. The least recently used results are dropped
+        first. See :meth:`cache_info`.
+        Default: Do not cache anything.
 
     Notes
     -----
@@ -853,9 +2038,19 @@ class LikelihoodCalculator(object):
 
     """
 
-    def __init__(self, data_model, predictor, systematics='marginal'):
+    def __init__(self, data_model, predictor, systematics='marginal', max_memory=None, cache_size=None):
         self.data_model = data_model
         self.predictor = predictor
+        self.max_memory = max_memory
+        self.cache_size = cache_size
+        # The systematics consumers are faster without uniform weights
+        weights = getattr(predictor, 'weights', None)
+        self._uniform_weights = (isinstance(predictor, LinearPredictor)
+                                 and bool(np.all(weights == weights[0])))
+        if cache_size is None:
+            self._cache = None
+        else:
+            self._cache = _LRUCache(cache_size)
         if systematics == 'marginal' or systematics == 'average':
             self.systematics = MarginalLikelihoodSystematics
         elif systematics == 'profile' or systematics == 'maximum':
@@ -870,17 +2065,202 @@ class LikelihoodCalculator(object):
 
         """
 
+        if self._cache is not None:
+            key = self._evaluation_key('log_likelihood', *args, **kwargs)
+            return self._cache.get(key, lambda: self._log_likelihood(*args, **kwargs))
+        return self._log_likelihood(*args, **kwargs)
+
+    def _evaluation_key(self, method, *args, **kwargs):
+        """Get the cache key of an evaluation."""
+        args = tuple(np.asarray(arg) if isinstance(arg, (list, tuple)) else arg for arg in args)
+        # The calculator could be given a different data model or predictor.
+        # The objects themselves are part of the key, so they stay alive.
+        return (method, self.data_model, self.predictor) + _cache_key(*args, **kwargs)
+
+    def cache_info(self):
+        """Return the statistics of the evaluation cache.
+
+        Returns
+        -------
+
+        info : CacheInfo
+            Named tuple with the number of ``hits`` and ``misses``, the
+            ``maxsize`` of the cache and its current size ``currsize``.
+
+        """
+
+        if self._cache is None:
+            return CacheInfo(0, 0, 0, 0)
+        return self._cache.info()
+
+    def clear_cache(self):
+        """Remove all results from the evaluation cache and reset its statistics."""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _log_likelihood(self, *args, **kwargs):
+        """Calculate the log likelihood without using the cache."""
+        if self.max_memory is not None:
+            return self._chunked_log_likelihood(*args, **kwargs)
         prediction, weights = self.predictor.prediction(*args, **kwargs)
         log_likelihood = self.data_model.log_likelihood(prediction)
+        log_likelihood = self.systematics.consume_axis(log_likelihood, self._consumer_weights(weights))
+        return self._fix_out_of_bounds(log_likelihood, args[0])
+
+    def _consumer_weights(self, weights):
+        """Get the weights to pass to the systematics consumer."""
+        if self._uniform_weights:
+            return None
+        return weights
+
+    def _fix_out_of_bounds(self, log_likelihood, parameters):
+        """Set the log likelihood of out of bounds parameters to -inf."""
+        check = self.predictor.check_bounds(parameters)
+        if check.ndim == 0:
+            if not check:
+                log_likelihood = -np.inf
+        else:
+            log_likelihood[...,~check] = -np.inf
+        return log_likelihood
+
+    def _chunk_sizes(self, parameters, systematics_index):
+        """Determine how many parameter sets and systematics to evaluate at once."""
+        if isinstance(self.predictor, LinearPredictor) and _is_full_slice(systematics_index):
+            n_systematics, n_reco = self.predictor._matrices_shape[:2]
+            syst_chunkable = True
+        else:
+            # Probe the prediction shape with a single parameter set
+            prediction, _ = self.predictor.prediction(parameters[0], systematics_index)
+            n_systematics = int(np.prod(prediction.shape[:-1]))
+            n_reco = prediction.shape[-1]
+            syst_chunkable = False
+        n_data = int(np.prod(np.shape(self.data_model.data_vector)[:-1]))
+        # Prediction plus the log PMF and temporary arrays for each data set
+        bytes_per_prediction = 8 * n_reco * (1 + 2*n_data)
+        n_predictions = max(1, int(self.max_memory // bytes_per_prediction))
+        if syst_chunkable and n_systematics > n_predictions:
+            return 1, n_predictions
+        return max(1, n_predictions // n_systematics), None
+
+    def _systematics_chunks(self, parameters, syst_chunk):
+        """Yield the log likelihoods and weights of chunks of the systematics axis."""
+        n_systematics = self.predictor._matrices_shape[0]
+        for i in range(0, n_systematics, syst_chunk):
+            prediction, weights = self.predictor.prediction(parameters, slice(i, i+syst_chunk))
+            yield self.data_model.log_likelihood(prediction), weights
+
+    def _chunked_log_likelihood(self, parameters, systematics_index=slice(None)):
+        """Calculate the log likelihood in chunks of limited size."""
+        parameters = np.asarray(parameters)
+        flat = parameters.reshape((-1, parameters.shape[-1]))
+        par_chunk, syst_chunk = self._chunk_sizes(flat, systematics_index)
+        log_likelihood = []
+        for i in range(0, flat.shape[0], par_chunk):
+            par = flat[i:i+par_chunk]
+            if syst_chunk is None:
+                prediction, weights = self.predictor.prediction(par, systematics_index)
+                ll = self.data_model.log_likelihood(prediction)
+                ll = self.systematics.consume_axis(ll, self._consumer_weights(weights))
+            else:
+                ll = self.systematics.consume_axis_chunks(self._systematics_chunks(par, syst_chunk))
+            log_likelihood.append(self._fix_out_of_bounds(ll, par))
+        log_likelihood = np.concatenate(log_likelihood, axis=-1)
+        return log_likelihood.reshape(log_likelihood.shape[:-1] + parameters.shape[:-1])[()]
+
+    @property
+    def has_gradient(self):
+        """Whether the analytic gradient of the log likelihood is available."""
+        return (getattr(self.predictor, 'has_jacobian', False)
+                and getattr(self.data_model, 'has_gradient', False)
+                and getattr(self.systematics, 'has_gradient', False))
+
+    def log_likelihood_and_gradient(self, parameters, systematics_index=slice(None), paired=False):
+        """Calculate the log likelihood and its gradient.
+
+        Parameters
+        ----------
+
+        parameters : ndarray
+            Shape: ``([c,d,...,]n_parameters,)``
+        systematics_index : int, optional
+        paired : bool, optional
+            Evaluate each data set only with its own parameter set. The
+            parameters must then have the shape ``([a,b,...,]n_parameters,)``
+            of the data sets. See :meth:`DataModel.log_likelihood`.
+
+        Returns
+        -------
+
+        log_likelihood : ndarray
+            Shape: ``([a,b,...,][c,d,...,])``
+        gradient : ndarray
+            Shape: ``([a,b,...,][c,d,...,]n_parameters,)``
+
+        Notes
+        -----
+
+        Requires a predictor, data model and systematics treatment that
+        support analytic derivatives, e.g. a :class:`LinearPredictor` with
+        :class:`PoissonData`. Parameters that are out of bounds get a log
+        likelihood of ``-inf`` and a gradient of 0.
+
+        """
+
+        parameters = np.asarray(parameters)
+        if self._cache is not None:
+            key = self._evaluation_key('log_likelihood_and_gradient', parameters, systematics_index, paired)
+            return self._cache.get(key, lambda: self._log_likelihood_and_gradient(parameters, systematics_index, paired))
+        return self._log_likelihood_and_gradient(parameters, systematics_index, paired)
+
+    def _log_likelihood_and_gradient(self, parameters, systematics_index, paired):
+        """Calculate the log likelihood and gradient without using the cache."""
+        prediction, weights = self.predictor.prediction(parameters, systematics_index)
+        log_likelihood = self.data_model.log_likelihood(prediction, paired=paired)
+        gradient = self.data_model.log_likelihood_gradient(prediction, paired=paired)
+        with np.errstate(invalid='ignore'):
+            # Infinite derivatives where the likelihood is 0 can turn into NaN
+            gradient = self.predictor.vector_jacobian_product(parameters, gradient, systematics_index)
+            weights = self._consumer_weights(weights)
+            gradient = self.systematics.consume_gradient(log_likelihood, gradient, weights)
         log_likelihood = self.systematics.consume_axis(log_likelihood, weights)
         # Fix out of bounds to -inf
-        check = self.predictor.check_bounds(*args)
+        check = self.predictor.check_bounds(parameters)
         if check.ndim == 0:
             if not check:
                 log_likelihood = -np.inf
+                gradient = np.zeros_like(gradient)
         else:
             log_likelihood[...,~check] = -np.inf
-        return log_likelihood
+            gradient[...,~check,:] = 0.
+        return log_likelihood, gradient
+
+    def gradient(self, parameters, systematics_index=slice(None)):
+        """Calculate the gradient of the log likelihood.
+
+        See :meth:`log_likelihood_and_gradient`.
+
+        """
+
+        return self.log_likelihood_and_gradient(parameters, systematics_index)[1]
+
+    def share_memory(self):
+        """Move the arrays of the data model and predictor into shared memory.
+
+        See also
+        --------
+
+        Predictor.share_memory
+        DataModel.share_memory
+
+        """
+
+        self.data_model.share_memory()
+        self.predictor.share_memory()
+
+    def release_shared_memory(self):
+        """Free the shared memory of the data model and predictor."""
+        self.data_model.release_shared_memory()
+        self.predictor.release_shared_memory()
 
     def generate_toy_likelihood_calculators(self, parameters, N=1, **kwargs):
         """Generate LikelihoodCalculator objects with randomly varied data.
@@ -894,23 +2274,45 @@ class LikelihoodCalculator(object):
 
         """
 
+        return [ self.with_data(data) for data in self.generate_toy_data(parameters, N=N, **kwargs) ]
+
+    def generate_toy_data(self, parameters, N=1, **kwargs):
+        """Generate random toy data vectors.
+
+        For each toy, a systematic variation of the prediction is chosen
+        randomly according to the systematics weights. Then the data is
+        varied according to the statistical model.
+
+        Accepts only single set of parameters.
+
+        Returns
+        -------
+
+        toy_data : ndarray
+            Shape: ``(N, n_reco_bins)``
+
+        """
+
         parameters = np.asarray(parameters)
         if parameters.ndim != 1:
             raise ValueError("Parameters must be 1D array!")
 
-        predictor = self.predictor
-        systematics = self.systematics
-
-        prediction, weights = predictor(parameters, **kwargs)
+        prediction, weights = self.predictor(parameters, **kwargs)
         weights = weights / np.sum(weights, axis=-1)
 
-        toys = []
-        for i in range(N):
-            j = np.random.choice(len(weights), p=weights)
-            data_model = self.data_model.generate_toy_data_model(prediction[j])
-            toys.append(LikelihoodCalculator(data_model, predictor, systematics))
+        j = np.random.choice(len(weights), size=N, p=weights)
+        return self.data_model.generate_toy_data(prediction[j])
+
+    def with_data(self, data_vector):
+        """Return a new LikelihoodCalculator with different data.
+
+        The new calculator uses the same predictor and systematics treatment
+        and the same type of data model as this one.
+
+        """
 
-        return toys
+        data_model = type(self.data_model)(data_vector)
+        return LikelihoodCalculator(data_model, self.predictor, self.systematics, self.max_memory, self.cache_size)
 
     def fix_parameters(self, fix_values):
         """Return a new LikelihoodCalculator with fewer free parameters.
@@ -925,7 +2327,7 @@ class LikelihoodCalculator(object):
         data = self.data_model
         pred = self.predictor.fix_parameters(fix_values)
         syst = self.systematics
-        return LikelihoodCalculator(data, pred, syst)
+        return LikelihoodCalculator(data, pred, syst, self.max_memory, self.cache_size)
 
     def compose(self, predictor):
         """Return a new LikelihoodCalculator with the composed Predictor.
@@ -941,25 +2343,124 @@ class LikelihoodCalculator(object):
         data = self.data_model
         pred = self.predictor.compose(predictor)
         syst = self.systematics
-        return LikelihoodCalculator(data, pred, syst)
+        return LikelihoodCalculator(data, pred, syst, self.max_memory, self.cache_size)
+
+    def subsample_systematics(self, n):
+        """Return a new LikelihoodCalculator that uses only some of the systematics.
+
+        The systematics axis is split into `n` strata of consecutive
+        variations. From each stratum, one variation is chosen randomly
+        according to the systematics weights. It gets the total weight of its
+        stratum. The average likelihood of the subsample is thus an unbiased
+        estimate of the marginal likelihood of all variations.
+
+        Parameters
+        ----------
+
+        n : int
+            The number of variations in the subsample.
+
+        Returns
+        -------
+
+        likelihood_calculator : LikelihoodCalculator
+            Calculator with the same data and a predictor with only the
+            subsample of variations. If `n` is not smaller than the number of
+            systematics, this calculator is returned.
+
+        Notes
+        -----
+
+        The subsample is fixed for the returned calculator. This can be used
+        for fast exploratory fits or the burn-in phase of MCMC chains, before
+        refining the result with the full set of systematics. Requires a
+        :class:`LinearPredictor`.
+
+        """
+
+        predictor = self.predictor
+        if not isinstance(predictor, LinearPredictor):
+            raise TypeError("Subsampling the systematics requires a LinearPredictor!")
+        weights = np.asfarray(predictor.weights)
+        n_systematics = len(weights)
+        if n >= n_systematics:
+            return self
+        edges = np.linspace(0, n_systematics, n+1).astype(int)
+        cumulative = np.concatenate([[0.], np.cumsum(weights)])
+        low = cumulative[edges[:-1]]
+        high = cumulative[edges[1:]]
+        # Draw one variation per stratum proportional to its weight
+        u = low + np.random.uniform(size=n) * (high - low)
+        indices = np.searchsorted(cumulative, u, side='right') - 1
+        indices = np.clip(indices, edges[:-1], edges[1:] - 1)
+        pred = predictor.select_systematics(indices, weights=high - low)
+        return LikelihoodCalculator(self.data_model, pred, self.systematics, self.max_memory, self.cache_size)
+
+    def compile(self):
+        """Return a new LikelihoodCalculator with a compiled Predictor.
+
+        See :meth:`Predictor.compile`.
+
+        """
+
+        data = self.data_model
+        pred = self.predictor.compile()
+        syst = self.systematics
+        return LikelihoodCalculator(data, pred, syst, self.max_memory, self.cache_size)
 
     def __call__(self, *args, **kwargs):
         return self.log_likelihood(*args, **kwargs)
 
 class LikelihoodMaximizer(object):
-    """Class to maximise the likelihood over a parameter space."""
+    """Class to maximise the likelihood over a parameter space.
+
+    If the likelihood calculator supports it, the analytic gradient of the
+    likelihood is passed to the minimisation function as ``jac``.
+
+    Attributes
+    ----------
+
+    use_gradient : bool
+        Whether to use the analytic gradient if it is available.
+
+    """
+
+    use_gradient = True
+
+    # Whether `maximize_log_likelihood_batch` fits all data sets at once
+    batched = False
 
-    def minimize(self, fun, x0, bounds, **kwargs):
-        """General minimisation function."""
+    def minimize(self, fun, x0, bounds, jac=None, **kwargs):
+        """General minimisation function.
+
+        If `jac` is ``True``, `fun` returns both the function value and its
+        gradient.
+
+        """
         raise NotImplementedError("Must be implemented in a subclass!")
 
-    def maximize_log_likelihood(self, likelihood_calculator, **kwargs):
-        """Maximise the likelihood"""
-        def fun(x):
-            fun = -likelihood_calculator(x)
-            return fun
+    def maximize_log_likelihood(self, likelihood_calculator, x0=None, **kwargs):
+        """Maximise the likelihood
+
+        Parameters
+        ----------
+
+        likelihood_calculator : LikelihoodCalculator
+            The likelihood to be maximised.
+        x0 : ndarray, optional
+            The starting point of the maximisation.
+            Default: The default parameters of the predictor.
+        **kwargs : optional
+            Additional keyword arguments are passed to :meth:`minimize`.
+
+        """
         bounds = likelihood_calculator.predictor.bounds
-        x0 = likelihood_calculator.predictor.defaults
+        if x0 is None:
+            x0 = likelihood_calculator.predictor.defaults
+        elif len(x0) > 0 and not np.isfinite(likelihood_calculator(x0)):
+            # Explicit starting points with impossible data cannot be used
+            x0 = likelihood_calculator.predictor.defaults
+        x0 = np.asfarray(x0)
         if len(x0) == 0:
             # Nothing to optimise, return dummy result
             opt = optimize.OptimizeResult()
@@ -967,13 +2468,73 @@ class LikelihoodMaximizer(object):
             opt.fun = -likelihood_calculator(opt.x)
             opt.log_likelihood = -opt.fun
         else:
+            use_gradient = self.use_gradient and likelihood_calculator.has_gradient
+            fun = _NegativeLogLikelihood(likelihood_calculator, use_gradient)
+            if use_gradient:
+                kwargs['jac'] = True
             opt = self.minimize(fun, x0, bounds, **kwargs)
             opt.log_likelihood = -opt.fun
         return opt
 
+    def maximize_log_likelihood_batch(self, likelihood_calculator, x0=None, **kwargs):
+        """Maximise the likelihoods of many data sets independently.
+
+        Parameters
+        ----------
+
+        likelihood_calculator : LikelihoodCalculator
+            The data model of the calculator must contain data of shape
+            ``(n_data_sets,n_reco_bins)``. Each data set is fitted on its own.
+        x0 : ndarray, optional
+            The starting point of the maximisations. Either one for all data
+            sets, or one for each with shape ``(n_data_sets,n_parameters)``.
+            Default: The default parameters of the predictor.
+        **kwargs : optional
+            Additional keyword arguments are passed to
+            :meth:`maximize_log_likelihood`.
+
+        Returns
+        -------
+
+        opt : OptimizeResult
+            The attributes ``x``, ``fun``, ``log_likelihood`` and ``success``
+            are arrays with the results of the single data sets.
+
+        """
+
+        data = likelihood_calculator.data_model.data_vector
+        if x0 is None:
+            x0 = likelihood_calculator.predictor.defaults
+        x0 = np.broadcast_to(np.asfarray(x0), (len(data), len(likelihood_calculator.predictor.defaults)))
+        results = [ self.maximize_log_likelihood(likelihood_calculator.with_data(d), x0=x, **kwargs) for d, x in zip(data, x0) ]
+        opt = optimize.OptimizeResult()
+        opt.x = np.array([ r.x for r in results ]).reshape((len(data), -1))
+        opt.fun = np.array([ r.fun for r in results ], dtype=float)
+        opt.log_likelihood = -opt.fun
+        opt.success = np.array([ r.get('success', True) for r in results ], dtype=bool)
+        return opt
+
     def __call__(self, *args, **kwargs):
         return self.maximize_log_likelihood(*args, **kwargs)
 
+class _NegativeLogLikelihood(object):
+    """Picklable objective function for the minimisers.
+
+    Returns the negative log likelihood, and its gradient if requested.
+
+    """
+
+    def __init__(self, likelihood_calculator, gradient=False):
+        self.likelihood_calculator = likelihood_calculator
+        self.gradient = gradient
+
+    def __call__(self, x):
+        if self.gradient:
+            L, grad = self.likelihood_calculator.log_likelihood_and_gradient(x)
+            return -L, -np.asfarray(grad)
+        else:
+            return -self.likelihood_calculator(x)
+
 class BasinHoppingMaximizer(LikelihoodMaximizer):
     """Class to maximise the likelihood over a parameter space.
 
@@ -982,18 +2543,24 @@ class BasinHoppingMaximizer(LikelihoodMaximizer):
     Parameters
     ----------
 
+    use_gradient : bool, optional
+        Whether to use the analytic gradient of the likelihood in the local
+        minimisations, if it is available.
     **kwargs : optional
         Arguments to be passed to the basin hopping function.
 
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, use_gradient=True, **kwargs):
+        self.use_gradient = use_gradient
         self.kwargs = kwargs
 
-    def minimize(self, fun, x0, bounds, **kwargs):
+    def minimize(self, fun, x0, bounds, jac=None, **kwargs):
         minimizer_kwargs = {
             'bounds' : bounds,
             }
+        if jac is not None:
+            minimizer_kwargs['jac'] = jac
         # expected log likelihood variation in the order of degrees of freedom
         args = {
             'T': len(x0),
@@ -1003,16 +2570,928 @@ class BasinHoppingMaximizer(LikelihoodMaximizer):
         args.update(self.kwargs)
         return optimize.basinhopping(fun, x0, **args)
 
+class MultiStartMaximizer(LikelihoodMaximizer):
+    """Class to maximise the likelihood with local fits from several starting points.
+
+    Runs rounds of local minimisations with SciPy's :func:`scipy.optimize.minimize`.
+    The first round starts at the default parameters of the predictor and at
+    random points within the bounds, the later rounds only at random points.
+    The rounds stop as soon as the best results of `n_agree` starts agree
+    within the `tolerance`. The local fits of a round can be run in parallel
+    by an :class:`Executor`.
+
+    This is much faster than :class:`BasinHoppingMaximizer` for smooth
+    likelihoods with analytic gradients, e.g. of a :class:`LinearPredictor`
+    with :class:`PoissonData`.
+
+    Parameters
+    ----------
+
+    n_starts : int, optional
+        Number of starting points per round.
+    max_rounds : int, optional
+        Maximum number of rounds.
+    n_agree : int, optional
+        Number of starts that must agree with the best result to stop.
+    tolerance : float, optional
+        Maximum difference of the log likelihood of agreeing fits.
+    spread : float, optional
+        Relative spread of random starting points around the defaults for
+        parameters without finite bounds.
+    executor : Executor, optional
+        The executor that runs the local fits of each round.
+        Default: :class:`SerialExecutor`
+    use_gradient : bool, optional
+        Whether to use the analytic gradient of the likelihood, if it is
+        available.
+    **kwargs : optional
+        Arguments to be passed to :func:`scipy.optimize.minimize`.
+
+    Notes
+    -----
+
+    The returned result has two additional attributes: ``n_starts``, the
+    total number of local fits, and ``agreed``, whether the stopping
+    criterion was met.
+
+    """
+
+    def __init__(self, n_starts=4, max_rounds=5, n_agree=2, tolerance=1e-3, spread=0.5, executor=None, use_gradient=True, **kwargs):
+        self.n_starts = n_starts
+        self.max_rounds = max_rounds
+        self.n_agree = n_agree
+        self.tolerance = tolerance
+        self.spread = spread
+        if executor is None:
+            executor = SerialExecutor()
+        self.executor = executor
+        self.use_gradient = use_gradient
+        self.kwargs = kwargs
+
+    def _random_starts(self, x0, bounds, n):
+        """Generate random starting points within the bounds."""
+        x0 = np.asfarray(x0)
+        bounds = np.asfarray(bounds)
+        low, high = bounds[:,0], bounds[:,1]
+        finite = np.isfinite(low) & np.isfinite(high)
+        scale = self.spread * np.maximum(np.abs(x0), 1.)
+        starts = x0 + scale * np.random.uniform(-1., 1., size=(n, len(x0)))
+        starts[:,finite] = np.random.uniform(low[finite], high[finite], size=(n, np.sum(finite)))
+        return np.clip(starts, low, high)
+
+    def minimize(self, fun, x0, bounds, jac=None, **kwargs):
+        minimize_kwargs = {
+            'bounds' : bounds,
+            'jac' : jac,
+            }
+        minimize_kwargs.update(self.kwargs)
+        minimize_kwargs.update(kwargs)
+        context = (fun, minimize_kwargs)
+
+        results = []
+        agreed = False
+        for i in range(self.max_rounds):
+            if i == 0:
+                starts = np.concatenate([[x0], self._random_starts(x0, bounds, self.n_starts-1)], axis=0)
+            else:
+                starts = self._random_starts(x0, bounds, self.n_starts)
+            results.extend(self.executor.map(_local_minimize, starts, context=context))
+            results.sort(key=lambda opt: opt.fun if np.isfinite(opt.fun) else np.inf)
+            best = results[0].fun
+            n_agree = sum(1 for opt in results if opt.fun - best <= self.tolerance)
+            if n_agree >= self.n_agree:
+                agreed = True
+                break
+
+        opt = results[0]
+        opt.n_starts = len(results)
+        opt.agreed = agreed
+        return opt
+
+def _local_minimize(context, x0):
+    """Run a local minimisation from a single starting point."""
+    fun, kwargs = context
+    return optimize.minimize(fun, x0, **kwargs)
+
+class ProjectedLBFGSMaximizer(LikelihoodMaximizer):
+    """Class to maximise many likelihoods at once with a projected L-BFGS method.
+
+    The fits of all data sets in :meth:`maximize_log_likelihood_batch` are
+    advanced together, with one vectorized evaluation of the likelihoods and
+    their gradients per step. Each fit keeps its own history of the
+    limited-memory BFGS approximation of the Hessian. Parameters that sit at
+    their bounds with the gradient pointing outwards are held fixed in the
+    step. Fits that have converged are removed from the batch.
+
+    Single likelihoods are maximised as a batch of one, so that fits of the
+    actual data and toy data sets are treated the same way. The method
+    requires the analytic gradient of the likelihood. If it is not available,
+    the likelihoods are maximised with SciPy's L-BFGS-B one by one instead.
+
+    Parameters
+    ----------
+
+    maxiter : int, optional
+        Maximum number of iterations.
+    ftol : float, optional
+        The iteration stops when the relative change of the log likelihood
+        ``(L1 - L0) / max(|L0|, |L1|, 1)`` is smaller than this.
+    gtol : float, optional
+        The iteration stops when the largest component of the projected
+        gradient is smaller than this.
+    memory : int, optional
+        Number of steps that are used for the Hessian approximation.
+
+    """
+
+    batched = True
+
+    def __init__(self, maxiter=1000, ftol=2.2e-9, gtol=1e-5, memory=10):
+        self.maxiter = maxiter
+        self.ftol = ftol
+        self.gtol = gtol
+        self.memory = memory
+
+    def minimize(self, fun, x0, bounds, jac=None, **kwargs):
+        # Only used for likelihoods without analytic gradient
+        return optimize.minimize(fun, x0, bounds=bounds, jac=jac, method='L-BFGS-B', **kwargs)
+
+    def maximize_log_likelihood(self, likelihood_calculator, **kwargs):
+        data = likelihood_calculator.data_model.data_vector
+        if (not likelihood_calculator.has_gradient or data.ndim != 1
+                or len(likelihood_calculator.predictor.defaults) == 0):
+            return LikelihoodMaximizer.maximize_log_likelihood(self, likelihood_calculator, **kwargs)
+        opt = self.maximize_log_likelihood_batch(likelihood_calculator.with_data(data[np.newaxis,:]), **kwargs)
+        for key in ('x', 'fun', 'log_likelihood', 'success', 'nit'):
+            opt[key] = opt[key][0]
+        return opt
+
+    @staticmethod
+    def _evaluate(likelihood_calculator, x):
+        """Return the negative log likelihoods and their gradients."""
+        fun, grad = likelihood_calculator.log_likelihood_and_gradient(x, paired=True)
+        return -fun, -np.asfarray(grad)
+
+    @staticmethod
+    def _direction(grad, free, S, Y, rho, newest):
+        """Calculate the quasi-Newton step with the two-loop recursion."""
+        q = grad * free
+        m = len(rho)
+        order = [ (newest - i) % m for i in range(m) ]
+        alpha = np.zeros((m, len(q)))
+        for i in order:
+            alpha[i] = rho[i] * np.sum(S[i] * q, axis=-1)
+            q -= alpha[i][:,np.newaxis] * Y[i]
+        # Initial Hessian approximation from the newest step
+        yy = np.sum(Y[newest] * Y[newest], axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gamma = np.where(yy > 0, 1. / (rho[newest] * yy), 1.)
+        gamma[~np.isfinite(gamma)] = 1.
+        r = gamma[:,np.newaxis] * q
+        for i in reversed(order):
+            beta = rho[i] * np.sum(Y[i] * r, axis=-1)
+            r += (alpha[i] - beta)[:,np.newaxis] * S[i]
+        return -r * free
+
+    def maximize_log_likelihood_batch(self, likelihood_calculator, x0=None, **kwargs):
+        if (not likelihood_calculator.has_gradient
+                or len(likelihood_calculator.predictor.defaults) == 0):
+            return LikelihoodMaximizer.maximize_log_likelihood_batch(self, likelihood_calculator, x0=x0, **kwargs)
+
+        data = likelihood_calculator.data_model.data_vector
+        bounds = np.asfarray(likelihood_calculator.predictor.bounds)
+        low, high = bounds[:,0], bounds[:,1]
+        n_data, n_par = len(data), len(low)
+        if x0 is None:
+            x0 = likelihood_calculator.predictor.defaults
+        x = np.array(np.clip(np.broadcast_to(np.asfarray(x0), (n_data, n_par)), low, high))
+
+        # Minimise the negative log likelihood
+        fun, grad = self._evaluate(likelihood_calculator, x)
+        bad = ~np.isfinite(fun)
+        if np.any(bad):
+            # Start fits with impossible data at the default parameters instead
+            x[bad] = np.clip(likelihood_calculator.predictor.defaults, low, high)
+            fun[bad], grad[bad] = self._evaluate(likelihood_calculator.with_data(data[bad]), x[bad])
+        nit = np.zeros(n_data, dtype=int)
+        success = np.zeros(n_data, dtype=bool)
+
+        # L-BFGS history of the running fits, unused entries have rho == 0
+        m = self.memory
+        S = np.zeros((m, n_data, n_par))
+        Y = np.zeros((m, n_data, n_par))
+        rho = np.zeros((m, n_data))
+        newest = 0
+
+        # Indices of the fits that are still running
+        active = np.arange(n_data)
+        LC = likelihood_calculator
+        for i in range(self.maxiter):
+            xa, fa, ga = x[active], fun[active], grad[active]
+
+            # Converged if the projected gradient vanishes
+            converged = np.max(np.abs(np.clip(xa - ga, low, high) - xa), axis=-1) <= self.gtol
+
+            # Variables at the bounds that would be pushed outwards are fixed
+            free = ~(((xa <= low) & (ga > 0)) | ((xa >= high) & (ga < 0)))
+            direction = self._direction(ga, free, S, Y, rho, newest)
+            # Fall back to steepest descent if it is not a descent direction
+            no_descent = np.sum(direction * ga, axis=-1) >= 0
+            first = np.all(rho == 0, axis=0)
+            steepest = no_descent | first
+            direction[steepest] = -(ga * free)[steepest]
+            scale = np.ones(len(active))
+            max_step = np.max(np.abs(direction), axis=-1)
+            scale[first] = 1. / np.maximum(max_step[first], 1.)
+
+            # Backtracking line search along the projected path
+            lam = scale
+            searching = ~converged
+            x_new, f_new, g_new = xa.copy(), fa.copy(), ga.copy()
+            for j in range(40):
+                index = np.flatnonzero(searching)
+                if len(index) == 0:
+                    break
+                # Only evaluate the fits that are still searching
+                if len(index) == len(active):
+                    LC_search = LC
+                else:
+                    LC_search = LC.with_data(data[active[index]])
+                trial = np.clip(xa[index] + lam[index,np.newaxis] * direction[index], low, high)
+                f_trial, g_trial = self._evaluate(LC_search, trial)
+                decrease = np.sum(ga[index] * (trial - xa[index]), axis=-1)
+                accept = np.isfinite(f_trial) & (f_trial <= fa[index] + 1e-4 * decrease)
+                accepted = index[accept]
+                x_new[accepted], f_new[accepted], g_new[accepted] = trial[accept], f_trial[accept], g_trial[accept]
+                searching[accepted] = False
+                lam[searching] *= 0.5
+            moved = ~converged & ~searching
+
+            # Relative change of the function value
+            f_scale = np.maximum(np.maximum(np.abs(fa), np.abs(f_new)), 1.)
+            converged |= moved & ((fa - f_new) <= self.ftol * f_scale)
+            # Line search failure: Try again without history, give up otherwise
+            failed = ~converged & searching
+            stuck = failed & first
+
+            # Update the history
+            s = x_new - xa
+            y = g_new - ga
+            sy = np.sum(s * y, axis=-1)
+            newest = (newest + 1) % m
+            S[newest] = s
+            Y[newest] = y
+            with np.errstate(divide='ignore'):
+                rho[newest] = np.where(moved & (sy > 1e-10 * np.sum(y * y, axis=-1)), 1. / sy, 0.)
+            rho[:,failed] = 0.
+
+            x[active], fun[active], grad[active] = x_new, f_new, g_new
+            nit[active] += 1
+            success[active[converged]] = True
+
+            done = converged | stuck
+            if np.any(done):
+                active = active[~done]
+                if len(active) == 0:
+                    break
+                S, Y, rho = S[:,~done], Y[:,~done], rho[:,~done]
+                LC = likelihood_calculator.with_data(data[active])
+
+        opt = optimize.OptimizeResult()
+        opt.x = x
+        opt.fun = fun
+        opt.log_likelihood = -fun
+        opt.success = success
+        opt.nit = nit
+        return opt
+
+class EMMaximizer(LikelihoodMaximizer):
+    """Class to maximise non-negative linear Poisson likelihoods with EM.
+
+    For a :class:`LinearPredictor` with non-negative matrices, constants and
+    parameters, and :class:`PoissonData`, the expectation-maximisation
+    algorithm (also known as Richardson-Lucy deconvolution) turns into
+    simple multiplicative updates of the parameters::
+
+        theta_j <- theta_j * sum_s(p_s * sum_i(M_sij * k_i / mu_si))
+                           / sum_s(p_s * sum_i(M_sij))
+
+        p_s = w_s * exp(L_s) / sum_t(w_t * exp(L_t))
+
+    where ``p_s`` are the posterior probabilities of the systematic
+    variations for :class:`MarginalLikelihoodSystematics`, or 1 for the
+    best variation with :class:`ProfileLikelihoodSystematics`. Every update
+    increases the likelihood and only needs matrix-vector products. The
+    parameters are clipped to their lower and upper bounds.
+
+    The updates are accelerated with the SQUAREM method. All data sets in
+    :meth:`maximize_log_likelihood_batch` are fitted together.
+
+    The EM updates converge to a local maximum of the likelihood. With a
+    single systematic variation the likelihood is concave, so this is the
+    global maximum. With several variations, the marginal likelihood is a
+    mixture of Poisson likelihoods, which can have more than one local
+    maximum. The convergence can be slow for strongly smearing response
+    matrices, i.e. for badly conditioned unfolding problems.
+    :class:`ProjectedLBFGSMaximizer` might be faster in that case.
+
+    Likelihoods that do not fulfil the requirements are maximised with the
+    `fallback` maximizer instead.
+
+    Parameters
+    ----------
+
+    maxiter : int, optional
+        Maximum number of (accelerated) iterations.
+    ftol : float, optional
+        The iteration stops when the relative change of the log likelihood
+        ``(L1 - L0) / max(|L0|, |L1|, 1)`` is smaller than this.
+    accelerate : bool, optional
+        Whether to use the SQUAREM acceleration.
+    fallback : LikelihoodMaximizer, optional
+        Default: :class:`BasinHoppingMaximizer`
+
+    """
+
+    batched = True
+
+    def __init__(self, maxiter=10000, ftol=1e-10, accelerate=True, fallback=None):
+        self.maxiter = maxiter
+        self.ftol = ftol
+        self.accelerate = accelerate
+        if fallback is None:
+            fallback = BasinHoppingMaximizer()
+        self.fallback = fallback
+
+    @staticmethod
+    def is_applicable(likelihood_calculator):
+        """Check whether the likelihood can be maximised with EM updates."""
+        predictor = likelihood_calculator.predictor
+        systematics = likelihood_calculator.systematics
+        if not isinstance(systematics, type):
+            systematics = type(systematics)
+        if not (isinstance(likelihood_calculator.data_model, PoissonData)
+                and isinstance(predictor, LinearPredictor)
+                and issubclass(systematics, (MarginalLikelihoodSystematics, ProfileLikelihoodSystematics))
+                and len(predictor.defaults) > 0):
+            return False
+        return bool(np.all(np.asarray(predictor.bounds)[:,0] >= 0)) and predictor.is_non_negative()
+
+    def maximize_log_likelihood(self, likelihood_calculator, **kwargs):
+        data = likelihood_calculator.data_model.data_vector
+        if data.ndim != 1 or not self.is_applicable(likelihood_calculator):
+            return self.fallback.maximize_log_likelihood(likelihood_calculator, **kwargs)
+        opt = self.maximize_log_likelihood_batch(likelihood_calculator.with_data(data[np.newaxis,:]), **kwargs)
+        for key in ('x', 'fun', 'log_likelihood', 'success', 'nit'):
+            opt[key] = opt[key][0]
+        return opt
+
+    @staticmethod
+    def _update(likelihood_calculator, x, denominator, low, high):
+        """Do one EM update and return the log likelihood before it."""
+        predictor = likelihood_calculator.predictor
+        data_model = likelihood_calculator.data_model
+        systematics = likelihood_calculator.systematics
+        prediction, weights = predictor.prediction(x)
+        weights = likelihood_calculator._consumer_weights(weights)
+        log_likelihood = data_model.log_likelihood(prediction, paired=True)
+        # k/mu = gradient + 1
+        ratio = data_model.log_likelihood_gradient(prediction, paired=True) + 1.
+        numerator = predictor.vector_jacobian_product(x, ratio)
+        numerator = systematics.consume_gradient(log_likelihood, numerator, weights)
+        denom = np.broadcast_to(denominator, numerator.shape[:-1] + denominator.shape[-2:])
+        denom = systematics.consume_gradient(log_likelihood, denom, weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(denom > 0, numerator / denom, 1.)
+        x_new = np.clip(x * factor, low, high)
+        return x_new, systematics.consume_axis(log_likelihood, weights)
+
+    def maximize_log_likelihood_batch(self, likelihood_calculator, x0=None, **kwargs):
+        if not self.is_applicable(likelihood_calculator):
+            return self.fallback.maximize_log_likelihood_batch(likelihood_calculator, x0=x0, **kwargs)
+
+        data = likelihood_calculator.data_model.data_vector
+        predictor = likelihood_calculator.predictor
+        bounds = np.asfarray(predictor.bounds)
+        low, high = bounds[:,0], bounds[:,1]
+        n_data, n_par = len(data), len(low)
+        if x0 is None:
+            x0 = predictor.defaults
+        x = np.array(np.broadcast_to(np.asfarray(x0), (n_data, n_par)))
+        # Parameters that are 0 would never change
+        x[x <= 0] = (np.minimum(high, 1.) / 2.)[np.nonzero(x <= 0)[1]]
+        x = np.clip(x, low, high)
+
+        # The column sums of the matrices do not change
+        prediction, _ = predictor.prediction(x[0])
+        denominator = predictor.vector_jacobian_product(x[0], np.ones_like(prediction))
+
+        fun = np.full(n_data, np.inf)
+        nit = np.zeros(n_data, dtype=int)
+        success = np.zeros(n_data, dtype=bool)
+
+        # Indices of the fits that are still running
+        active = np.arange(n_data)
+        LC = likelihood_calculator
+        for i in range(self.maxiter):
+            x0 = x[active]
+            x1, L0 = self._update(LC, x0, denominator, low, high)
+            if self.accelerate:
+                x2, L1 = self._update(LC, x1, denominator, low, high)
+                r = x1 - x0
+                v = x2 - x1 - r
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    alpha = -np.sqrt(np.sum(r**2, axis=-1) / np.sum(v**2, axis=-1))
+                alpha[~np.isfinite(alpha)] = -1.
+                alpha = np.minimum(alpha, -1.)[:,np.newaxis]
+                x_acc = np.clip(x0 - 2*alpha*r + alpha**2 * v, low, high)
+                x3, L_acc = self._update(LC, x_acc, denominator, low, high)
+                # Only accept the extrapolation if it does not decrease the likelihood
+                good = L_acc >= L1
+                x_new = np.where(good[:,np.newaxis], x3, x2)
+            else:
+                x_new = x1
+
+            # L0 is the likelihood of the previous iteration's result
+            previous = -fun[active]
+            scale = np.maximum(np.maximum(np.abs(L0), np.abs(previous)), 1.)
+            converged = np.isfinite(previous) & ((L0 - previous) <= self.ftol * scale)
+
+            # Keep the state of converged fits, so the returned likelihood matches x
+            x[active[~converged]] = x_new[~converged]
+            fun[active] = -L0
+            nit[active] += 1
+            success[active[converged]] = True
+
+            if np.any(converged):
+                active = active[~converged]
+                if len(active) == 0:
+                    break
+                LC = likelihood_calculator.with_data(data[active])
+
+        # Make sure the function values match the parameters of unfinished fits
+        if len(active) > 0:
+            L, _ = LC.log_likelihood_and_gradient(x[active], paired=True)
+            fun[active] = -L
+
+        opt = optimize.OptimizeResult()
+        opt.x = x
+        opt.fun = fun
+        opt.log_likelihood = -fun
+        opt.success = success
+        opt.nit = nit
+        return opt
+
+class Executor(object):
+    """Base class for objects that evaluate a function for many arguments.
+
+    Executors are used by the :class:`HypothesisTester` to evaluate the toy
+    data sets, possibly in parallel.
+
+    Parameters
+    ----------
+
+    chunksize : int, optional
+        Number of tasks that are sent to a worker at once.
+        Default: Split the tasks into about 4 chunks per worker.
+    progress : function, optional
+        Function that is called after each finished chunk of tasks with the
+        number of finished and total tasks::
+
+            progress(n_done, n_total)
+
+    """
+
+    def __init__(self, chunksize=None, progress=None):
+        self.chunksize = chunksize
+        self.progress = progress
+
+    def map(self, function, iterable, context=None):
+        """Evaluate the function for all elements of `iterable`.
+
+        Parameters
+        ----------
+
+        function : function
+            The function to be evaluated.
+        iterable : iterable
+            The arguments of the function.
+        context : object, optional
+            If this is provided, the function is called with it as first
+            argument. Executors can use this to transfer data that is the same
+            for all tasks, e.g. a large predictor, only once to each worker.
+
+        Returns
+        -------
+
+        results : list
+            The return values of the function in the same order as the
+            arguments.
+
+        """
+
+        raise NotImplementedError("Must be implemented in a subclass!")
+
+    def _get_chunksize(self, n_tasks, n_workers):
+        """Determine the size of chunks of tasks."""
+        if self.chunksize is not None:
+            return self.chunksize
+        chunksize, extra = divmod(n_tasks, n_workers * 4)
+        if extra:
+            chunksize += 1
+        return max(chunksize, 1)
+
+    def _get_n_workers(self):
+        """Number of tasks that are evaluated in parallel."""
+        return 1
+
+    def _collect(self, results, n_tasks, chunksize):
+        """Collect the results from an iterator and report the progress."""
+        ret = []
+        for result in results:
+            ret.append(result)
+            if self.progress is not None and (len(ret) % chunksize == 0 or len(ret) == n_tasks):
+                self.progress(len(ret), n_tasks)
+        return ret
+
+    def close(self):
+        """Free all resources, e.g. worker processes, of the executor."""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SerialExecutor(Executor):
+    """Executor that evaluates the tasks with a map function.
+
+    Parameters
+    ----------
+
+    mapper : function, optional
+        The map function to use. Default: The module level ``mapper`` of
+        :mod:`remu.likelihood`, i.e. the builtin ``map`` unless it has been
+        replaced.
+    **kwargs : optional
+        Additional keyword arguments are passed to :class:`Executor`.
+
+    """
+
+    def __init__(self, mapper=None, **kwargs):
+        Executor.__init__(self, **kwargs)
+        self.mapper = mapper
+
+    def map(self, function, iterable, context=None):
+        items = list(iterable)
+        if context is not None:
+            function = _ContextTask(function, context)
+        map_function = self.mapper or mapper
+        return self._collect(map_function(function, items), len(items), 1)
+
+    def _get_n_workers(self):
+        if (self.mapper or mapper) is map:
+            return 1
+        # A replaced map function, e.g. ``pool.map``, probably runs in parallel
+        from multiprocessing import cpu_count
+        return cpu_count()
+
+class ThreadExecutor(Executor):
+    """Executor that evaluates the tasks in a pool of threads.
+
+    This is only useful if the heavy lifting in the tasks releases Python's
+    global interpreter lock, as most large NumPy operations do.
+
+    Parameters
+    ----------
+
+    threads : int, optional
+        Number of threads. Default: ``os.cpu_count()``
+    **kwargs : optional
+        Additional keyword arguments are passed to :class:`Executor`.
+
+    """
+
+    def __init__(self, threads=None, **kwargs):
+        Executor.__init__(self, **kwargs)
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(threads)
+        self.threads = self.pool._processes
+
+    def map(self, function, iterable, context=None):
+        items = list(iterable)
+        if context is not None:
+            function = _ContextTask(function, context)
+        chunksize = self._get_chunksize(len(items), self.threads)
+        return self._collect(self.pool.imap(function, items, chunksize), len(items), chunksize)
+
+    def _get_n_workers(self):
+        return self.threads
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ProcessExecutor(Executor):
+    """Executor that evaluates the tasks in a pool of worker processes.
+
+    Parameters
+    ----------
+
+    processes : int, optional
+        Number of worker processes. Default: ``os.cpu_count()``
+    initializer : function, optional
+        Function that is called once in every worker process when it starts.
+    initargs : tuple, optional
+        Arguments of the `initializer`.
+    **kwargs : optional
+        Additional keyword arguments are passed to :class:`Executor`.
+
+    Notes
+    -----
+
+    The functions and arguments must be picklable. Lambda functions do not
+    work with the standard library :mod:`multiprocessing`.
+
+    If a `context` is passed to :meth:`map`, a pool of worker processes is
+    started, which receive the context once when they are initialized. The
+    tasks themselves then only carry the (small) varying arguments, e.g. the
+    toy data vectors. This pool is reused by further calls with the same
+    context, e.g. in the rounds of a :class:`MultiStartMaximizer`, until a
+    different context is passed or the executor is closed. Tuples are the
+    same context if all their elements are identical. Without a context, a
+    persistent pool is used.
+
+    See also
+    --------
+
+    Predictor.share_memory
+
+    """
+
+    def __init__(self, processes=None, initializer=None, initargs=(), **kwargs):
+        Executor.__init__(self, **kwargs)
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+        self._context_pool = None
+        self._context = None
+
+    def _new_pool(self, context=None):
+        from multiprocessing import Pool
+        return Pool(self.processes, _initialize_worker, (self.initializer, self.initargs, context))
+
+    def map(self, function, iterable, context=None):
+        items = list(iterable)
+        if context is None:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            pool = self._pool
+        else:
+            if self._context_pool is None or not _is_same_context(context, self._context):
+                self._close_context_pool()
+                self._context_pool = self._new_pool(context)
+                self._context = context
+            pool = self._context_pool
+            function = _WorkerContextTask(function)
+        chunksize = self._get_chunksize(len(items), pool._processes)
+        return self._collect(pool.imap(function, items, chunksize), len(items), chunksize)
+
+    def _get_n_workers(self):
+        if self.processes is not None:
+            return self.processes
+        from multiprocessing import cpu_count
+        return cpu_count()
+
+    def _close_context_pool(self):
+        if self._context_pool is not None:
+            self._context_pool.close()
+            self._context_pool.join()
+            self._context_pool = None
+            self._context = None
+
+    def close(self):
+        self._close_context_pool()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def _is_same_context(a, b):
+    """Check whether two task contexts consist of the same objects."""
+    if a is b:
+        return True
+    if isinstance(a, tuple) and isinstance(b, tuple) and len(a) == len(b):
+        return all(x is y for x, y in zip(a, b))
+    return False
+
+class _ContextTask(object):
+    """Picklable function that passes a context as first argument."""
+
+    def __init__(self, function, context):
+        self.function = function
+        self.context = context
+
+    def __call__(self, item):
+        return self.function(self.context, item)
+
+# Context of the tasks in a worker process of a `ProcessExecutor`
+_worker_context = None
+
+def _initialize_worker(initializer, initargs, context):
+    """Initialize a worker process of a `ProcessExecutor`."""
+    global _worker_context
+    _worker_context = context
+    if initializer is not None:
+        initializer(*initargs)
+
+class _WorkerContextTask(object):
+    """Picklable function that passes the worker's context as first argument."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, item):
+        return self.function(_worker_context, item)
+
+def _toy_log_likelihood(context, data):
+    """Calculate the likelihoods of a batch of toy data sets."""
+    likelihood_calculator, parameters, kwargs = context
+    return likelihood_calculator.with_data(data)(parameters, **kwargs)
+
+def _toy_max_log_likelihood(context, data):
+    """Calculate the maximum likelihoods of a batch of toy data sets."""
+    likelihood_calculator, maximizer, x0 = context
+    return maximizer.maximize_log_likelihood_batch(likelihood_calculator.with_data(data), x0=x0).log_likelihood
+
+def _alternative_start(LC0, parameters, alternative_fix_parameters):
+    """Turn the best fit parameters of H0 into a starting point for H1."""
+    full_parameters = LC0.predictor.insert_fixed_parameters(parameters)
+    if alternative_fix_parameters is None:
+        return full_parameters
+    free = np.isnan(np.array(alternative_fix_parameters, dtype=float))
+    return full_parameters[...,free]
+
+def _toy_max_log_likelihood_ratio(context, data):
+    """Calculate the maximum log likelihood ratios of a batch of toy data sets."""
+    likelihood_calculator, maximizer, fix_parameters, alternative_fix_parameters, x0 = context
+    LC = likelihood_calculator.with_data(data)
+    LC0 = LC.fix_parameters(fix_parameters)
+    if alternative_fix_parameters is None:
+        LC1 = LC
+    else:
+        LC1 = LC.fix_parameters(alternative_fix_parameters)
+    opt0 = maximizer.maximize_log_likelihood_batch(LC0, x0=x0)
+    if x0 is None:
+        opt1 = maximizer.maximize_log_likelihood_batch(LC1)
+    else:
+        # Warm start H1 from the H0 fit of each toy
+        opt1 = maximizer.maximize_log_likelihood_batch(LC1, x0=_alternative_start(LC0, opt0.x, alternative_fix_parameters))
+    return opt0.log_likelihood - opt1.log_likelihood
+
+def _split_toy_batches(toy_data, batch_size):
+    """Split the toy data into batches."""
+    return [ toy_data[i:i+batch_size] for i in range(0, len(toy_data), batch_size) ]
+
+def _binomial_interval(n, N, confidence):
+    """Clopper-Pearson confidence interval of a binomial probability."""
+    alpha = (1. - confidence) / 2.
+    lower = stats.beta.ppf(alpha, n, N - n + 1) if n > 0 else 0.
+    upper = stats.beta.ppf(1. - alpha, n + 1, N - n) if n < N else 1.
+    return lower, upper
+
+def _sequential_p_value(evaluate, N, thresholds, precision, confidence, toys_per_round):
+    """Estimate a p-value from toys, drawn in rounds until the result is decided.
+
+    `evaluate(n)` must return a boolean array of `n` toys being as bad as,
+    or worse than the actual data. Returns the p-value and the half width of
+    its confidence interval.
+
+    The intervals are calculated at the Bonferroni corrected confidence level
+    ``1 - (1 - confidence) / n_rounds``, so that the intervals of all possible
+    rounds hold simultaneously with the requested `confidence`.
+
+    """
+
+    adaptive = thresholds is not None or precision is not None
+    step = toys_per_round if adaptive else N
+    n_rounds = -(-N // step)
+    round_confidence = 1. - (1. - confidence) / n_rounds
+    thresholds = np.atleast_1d(thresholds if thresholds is not None else [])
+    n = n_toys = 0
+    while n_toys < N:
+        size = min(step, N - n_toys)
+        n += np.sum(evaluate(size))
+        n_toys += size
+        lower, upper = _binomial_interval(n, n_toys, round_confidence)
+        if precision is not None and (upper - lower) / 2. <= precision:
+            break
+        if thresholds.size > 0 and not np.any((lower < thresholds) & (thresholds < upper)):
+            break
+    return n / n_toys, (upper - lower) / 2.
+
 class HypothesisTester(object):
     """Class for statistical tests of hypotheses.
 
+    Parameters
+    ----------
+
+    likelihood_calculator : LikelihoodCalculator
+        The calculator of the likelihoods of the hypotheses.
+    maximizer : LikelihoodMaximizer, optional
+        The maximizer used to fit composite hypotheses.
+    executor : Executor, optional
+        The executor used to evaluate the toy data sets.
+        Default: :class:`SerialExecutor`
+    warm_start : bool, optional
+        Start the fits of the toy data sets at the best fit parameters of the
+        actual data, and the fits of alternative hypotheses at the best fit
+        parameters of the tested hypothesis, instead of the predictor's
+        default parameters.
+    fit_cache_size : int, optional
+        Remember the fits of the actual data for this many configurations of
+        fixed parameters. The methods then do not repeat the fits of the same
+        hypotheses, e.g. :meth:`max_likelihood_p_value` and
+        :meth:`max_likelihood_ratio_p_value` both fit the tested hypothesis.
+        See :meth:`fit_cache_info`.
+        Default: Do not cache the fits.
+
     """
 
-    def __init__(self, likelihood_calculator, maximizer=BasinHoppingMaximizer()):
+    # Memory budget for the intermediate arrays of batched toy evaluations
+    toy_batch_bytes = 2**26
+    # Minimum number of toy batches per worker of the executor
+    toy_batches_per_worker = 4
+
+    def __init__(self, likelihood_calculator, maximizer=BasinHoppingMaximizer(), executor=None, warm_start=True, fit_cache_size=None):
         self.likelihood_calculator = likelihood_calculator
         self.maximizer = maximizer
+        if executor is None:
+            executor = SerialExecutor()
+        self.executor = executor
+        self.warm_start = warm_start
+        if fit_cache_size is None:
+            self._fit_cache = None
+        else:
+            self._fit_cache = _LRUCache(fit_cache_size)
+
+    def fit_cache_info(self):
+        """Return the statistics of the cache of best fits.
+
+        See :meth:`LikelihoodCalculator.cache_info`.
+
+        """
+
+        if self._fit_cache is None:
+            return CacheInfo(0, 0, 0, 0)
+        return self._fit_cache.info()
+
+    def _best_fit(self, LC, fix_parameters, x0=None):
+        """Fit the data of `LC` with the given parameters fixed.
+
+        Returns the calculator with the fixed parameters and the result of
+        the maximizer.
+
+        """
+
+        key = (LC.data_model, LC.predictor, self.maximizer)
+        if fix_parameters is not None:
+            key += _cache_key(np.array(fix_parameters, dtype=float))
+            LC = LC.fix_parameters(fix_parameters)
+        if x0 is None:
+            fit = lambda: self.maximizer(LC)
+        else:
+            fit = lambda: self.maximizer(LC, x0=x0)
+        if self._fit_cache is None:
+            return LC, fit()
+        return LC, self._fit_cache.get(key, fit)
+
+    def _toy_batch_size(self, likelihood_calculator, parameters, **kwargs):
+        """Number of toys whose intermediate arrays fit into the memory budget."""
+        prediction_size = likelihood_calculator.predictor(parameters, **kwargs)[0].size
+        return max(self.toy_batch_bytes // (prediction_size * 8), 1)
+
+    def _worker_batch_size(self, executor, n_toys, batch):
+        """Limit the batch size, so every worker of the executor gets several batches."""
+        n_workers = executor._get_n_workers()
+        if n_workers > 1:
+            batch = min(batch, -(-n_toys // (n_workers * self.toy_batches_per_worker)))
+        return max(batch, 1)
+
+    def _toy_fit_batches(self, likelihood_calculator, parameters, toy_data, executor):
+        """Split toy data into batches for the maximizer."""
+        if getattr(self.maximizer, 'batched', False):
+            batch = self._toy_batch_size(likelihood_calculator, parameters)
+            batch = self._worker_batch_size(executor, len(toy_data), batch)
+        else:
+            # Fits are done one by one anyway, let the executor distribute them
+            batch = 1
+        return _split_toy_batches(toy_data, batch)
 
-    def likelihood_p_value(self, parameters, N=2500, **kwargs):
+    def likelihood_p_value(self, parameters, N=2500, executor=None, batch_size=None, thresholds=None,
+                           precision=None, confidence=0.95, toys_per_round=50, return_uncertainty=False, **kwargs):
         """Calculate the likelihood p-value of a set of parameters.
 
         The likelihood p-value is the probability of hypothetical alternative
@@ -1030,6 +3509,40 @@ class HypothesisTester(object):
         N : int, optional
             The number of MC evaluations of the hypothesis.
 
+        executor : Executor, optional
+            Use this executor instead of the tester's default one.
+
+        batch_size : int, optional
+            The number of toy data sets whose likelihoods are calculated in a
+            single vectorized call. Default: As many as fit into
+            ``toy_batch_bytes`` of intermediate arrays, but small enough that
+            every worker of a parallel executor gets at least
+            ``toy_batches_per_worker`` batches.
+
+        thresholds : float or array like, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the
+            confidence interval of the p-value does not contain any of these
+            decision thresholds, e.g. ``0.05``. `N` is the maximum number of
+            toys.
+
+        precision : float, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the half
+            width of the confidence interval of the p-value is smaller than
+            or equal to this.
+
+        confidence : float, optional
+            The confidence level of the (Clopper-Pearson) interval of the
+            p-value used for the stopping criteria and the reported
+            uncertainty. In the adaptive mode, it is split over the rounds
+            (see Notes).
+
+        toys_per_round : int, optional
+            The number of toys drawn in each round of the adaptive mode.
+
+        return_uncertainty : bool, optional
+            Also return the half width of the confidence interval of the
+            p-value.
+
         **kwargs : optional
             Additional keyword arguments will be passed to the likelihood
             calculator.
@@ -1040,6 +3553,10 @@ class HypothesisTester(object):
         p : float or ndarray
             The likelihood p-value.
 
+        uncertainty : float or ndarray
+            The half width of the confidence interval of `p`.
+            Only returned if `return_uncertainty` is `True`.
+
         Notes
         -----
 
@@ -1061,6 +3578,15 @@ class HypothesisTester(object):
         The expected uncertainty can thus be directly influenced by choosing an
         appropriate number of toy data sets.
 
+        In the adaptive mode, clearly excluded or clearly allowed hypotheses
+        are decided after only a few rounds of toys. Since the stopping
+        criteria are checked after every round, the intervals are calculated
+        at the Bonferroni corrected confidence level ``1 - (1 - confidence) /
+        R``, where ``R = ceil(N / toys_per_round)`` is the maximum number of
+        rounds. This keeps the rate of wrong decisions below ``1 -
+        confidence``, at the cost of wider intervals and thus more rounds than
+        a single fixed-size test would need.
+
         See also
         --------
 
@@ -1074,23 +3600,41 @@ class HypothesisTester(object):
         parameters.shape = (np.prod(shape, dtype=int), parameters.shape[-1])
 
         LC = self.likelihood_calculator # Calculator
+        executor = executor or self.executor
 
         p_values = []
+        uncertainties = []
 
         for par in parameters:
             L0 = LC(par, **kwargs) # Likelihood given data
 
-            toy_LC = LC.generate_toy_likelihood_calculators(par, N=N, **kwargs)
-            toy_L = list(mapper(lambda C, par=par, kwargs=kwargs: C(par, **kwargs), toy_LC))
-            toy_L = np.array(toy_L)
+            # Evaluate the toys in batches of data
+            if batch_size is None:
+                max_batch = self._toy_batch_size(LC, par, **kwargs)
+                batch = lambda n: self._worker_batch_size(executor, n, max_batch)
+            else:
+                batch = lambda n: batch_size
+
+            def evaluate(n):
+                toy_data = LC.generate_toy_data(par, N=n, **kwargs)
+                batches = _split_toy_batches(toy_data, batch(n))
+                toy_L = executor.map(_toy_log_likelihood, batches, context=(LC, par, kwargs))
+                return L0 >= np.concatenate(toy_L, axis=0)
 
-            p_values.append(np.sum(L0 >= toy_L, axis=-1) / N)
+            p, uncertainty = _sequential_p_value(evaluate, N, thresholds, precision, confidence, toys_per_round)
+            p_values.append(p)
+            uncertainties.append(uncertainty)
 
         p_values = np.array(p_values, dtype=float)
         p_values.shape = shape
+        if return_uncertainty:
+            uncertainties = np.array(uncertainties, dtype=float)
+            uncertainties.shape = shape
+            return p_values, uncertainties
         return p_values
 
-    def max_likelihood_p_value(self, fix_parameters=None, N=250):
+    def max_likelihood_p_value(self, fix_parameters=None, N=250, executor=None, thresholds=None,
+                               precision=None, confidence=0.95, toys_per_round=50, return_uncertainty=False):
         """Calculate the maximum-likelihood p-value.
 
         The maximum-likelihood p-value is the probability of the data yielding
@@ -1108,6 +3652,33 @@ class HypothesisTester(object):
         N : int, optional
             The number of MC evaluations of the hypothesis.
 
+        executor : Executor, optional
+            Use this executor instead of the tester's default one.
+
+        thresholds : float or array like, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the
+            confidence interval of the p-value does not contain any of these
+            decision thresholds, e.g. ``0.05``. `N` is the maximum number of
+            toys.
+
+        precision : float, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the half
+            width of the confidence interval of the p-value is smaller than
+            or equal to this.
+
+        confidence : float, optional
+            The confidence level of the (Clopper-Pearson) interval of the
+            p-value used for the stopping criteria and the reported
+            uncertainty. In the adaptive mode, it is split over the rounds
+            (see Notes).
+
+        toys_per_round : int, optional
+            The number of toys drawn in each round of the adaptive mode.
+
+        return_uncertainty : bool, optional
+            Also return the half width of the confidence interval of the
+            p-value.
+
         **kwargs : optional
             Additional keyword arguments will be passed to the maximiser.
 
@@ -1117,6 +3688,10 @@ class HypothesisTester(object):
         p : float or ndarray
             The maximum-likelihood p-value.
 
+        uncertainty : float or ndarray
+            The half width of the confidence interval of `p`.
+            Only returned if `return_uncertainty` is `True`.
+
         Notes
         -----
 
@@ -1142,6 +3717,15 @@ class HypothesisTester(object):
         The expected uncertainty can thus be directly influenced by choosing an
         appropriate number of evaluations.
 
+        In the adaptive mode, clearly excluded or clearly allowed hypotheses
+        are decided after only a few rounds of toys. Since the stopping
+        criteria are checked after every round, the intervals are calculated
+        at the Bonferroni corrected confidence level ``1 - (1 - confidence) /
+        R``, where ``R = ceil(N / toys_per_round)`` is the maximum number of
+        rounds. This keeps the rate of wrong decisions below ``1 -
+        confidence``, at the cost of wider intervals and thus more rounds than
+        a single fixed-size test would need.
+
         See also
         --------
 
@@ -1151,50 +3735,52 @@ class HypothesisTester(object):
 
         """
 
-        if fix_parameters is None:
-            LC = self.likelihood_calculator # Calculator
-        else:
-            LC = self.likelihood_calculator.fix_parameters(fix_parameters) # Calculator
+        LC, opt = self._best_fit(self.likelihood_calculator, fix_parameters)
         maxer = self.maximizer # Maximiser
-
-        opt = maxer(LC)
         opt_par = opt.x
         L0 = opt.log_likelihood
 
-        toy_LC = LC.generate_toy_likelihood_calculators(opt_par, N=N)
-        toy_opt = list(mapper(lambda C, maxer=maxer: maxer(C), toy_LC))
-        toy_L = np.asfarray([ O.log_likelihood for O in toy_opt ])
+        executor = executor or self.executor
+        x0 = opt_par if self.warm_start else None
+
+        def evaluate(n):
+            toy_data = LC.generate_toy_data(opt_par, N=n)
+            batches = self._toy_fit_batches(LC, opt_par, toy_data, executor)
+            toy_L = np.concatenate(executor.map(_toy_max_log_likelihood, batches, context=(LC, maxer, x0)), axis=0)
+            return L0 >= toy_L
 
-        p_value = np.sum(L0 >= toy_L, axis=-1) / N
+        p_value, uncertainty = _sequential_p_value(evaluate, N, thresholds, precision, confidence, toys_per_round)
 
+        if return_uncertainty:
+            return p_value, uncertainty
         return p_value
 
     def _max_log_likelihood_ratio(self, LC, fix_parameters, alternative_fix_parameters, return_parameters=False):
-        # Calculator 0
-        LC0 = LC.fix_parameters(fix_parameters)
+        """Calculate the maximum log likelihood ratio of two hypotheses.
 
-        # Calculator 1
-        if alternative_fix_parameters is None:
-            LC1 = LC
-        else:
-            LC1 = LC.fix_parameters(alternative_fix_parameters)
+        With `warm_start`, the fit of H1 starts from the best fit of H0.
 
-        maxer = self.maximizer # Maximiser
+        """
 
-        opt0 = maxer(LC0)
-        opt1 = maxer(LC1)
+        LC0, opt0 = self._best_fit(LC, fix_parameters)
+        if self.warm_start:
+            x1 = _alternative_start(LC0, opt0.x, alternative_fix_parameters)
+        else:
+            x1 = None
+        LC1, opt1 = self._best_fit(LC, alternative_fix_parameters, x0=x1)
 
         L0 = opt0.log_likelihood
         L1 = opt1.log_likelihood
 
         if return_parameters:
-            # "Unfix" the parameters and generate toy calculators
+            # "Unfix" the parameters
             full_parameters = LC0.predictor.insert_fixed_parameters(opt0.x)
-            return L0 - L1, full_parameters
+            return L0 - L1, full_parameters, opt0.x
         else:
             return L0 - L1
 
-    def max_likelihood_ratio_p_value(self, fix_parameters, alternative_fix_parameters=None, N=250, **kwargs):
+    def max_likelihood_ratio_p_value(self, fix_parameters, alternative_fix_parameters=None, N=250, executor=None, thresholds=None,
+                                     precision=None, confidence=0.95, toys_per_round=50, return_uncertainty=False, **kwargs):
         """Calculate the maximum-likelihood-ratio p-value.
 
         The maximum-likelihood-ratio p-value is the probability of the data
@@ -1220,6 +3806,33 @@ class HypothesisTester(object):
         N : int, optional
             The number of MC evaluations of the hypothesis.
 
+        executor : Executor, optional
+            Use this executor instead of the tester's default one.
+
+        thresholds : float or array like, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the
+            confidence interval of the p-value does not contain any of these
+            decision thresholds, e.g. ``0.05``. `N` is the maximum number of
+            toys.
+
+        precision : float, optional
+            Adaptive mode: Draw toys in rounds and stop as soon as the half
+            width of the confidence interval of the p-value is smaller than
+            or equal to this.
+
+        confidence : float, optional
+            The confidence level of the (Clopper-Pearson) interval of the
+            p-value used for the stopping criteria and the reported
+            uncertainty. In the adaptive mode, it is split over the rounds
+            (see Notes).
+
+        toys_per_round : int, optional
+            The number of toys drawn in each round of the adaptive mode.
+
+        return_uncertainty : bool, optional
+            Also return the half width of the confidence interval of the
+            p-value.
+
         **kwargs : optional
             Additional keyword arguments will be passed to the maximiser.
 
@@ -1229,6 +3842,10 @@ class HypothesisTester(object):
         p : float or ndarray
             The maximum-likelihood-ratio p-value.
 
+        uncertainty : float or ndarray
+            The half width of the confidence interval of `p`.
+            Only returned if `return_uncertainty` is `True`.
+
         Notes
         -----
 
@@ -1254,6 +3871,15 @@ class HypothesisTester(object):
         The expected uncertainty can thus be directly influenced by choosing an
         appropriate number of evaluations.
 
+        In the adaptive mode, clearly excluded or clearly allowed hypotheses
+        are decided after only a few rounds of toys. Since the stopping
+        criteria are checked after every round, the intervals are calculated
+        at the Bonferroni corrected confidence level ``1 - (1 - confidence) /
+        R``, where ``R = ceil(N / toys_per_round)`` is the maximum number of
+        rounds. This keeps the rate of wrong decisions below ``1 -
+        confidence``, at the cost of wider intervals and thus more rounds than
+        a single fixed-size test would need.
+
         See also
         --------
 
@@ -1264,20 +3890,26 @@ class HypothesisTester(object):
         """
 
         LC = self.likelihood_calculator
-        ratio0, parameters = self._max_log_likelihood_ratio(LC, fix_parameters, alternative_fix_parameters, return_parameters=True)
+        ratio0, parameters, x0 = self._max_log_likelihood_ratio(LC, fix_parameters, alternative_fix_parameters, return_parameters=True)
 
-        # Generate toy data
-        toy_LC = LC.generate_toy_likelihood_calculators(parameters, N=N)
+        executor = executor or self.executor
+        x0 = x0 if self.warm_start else None
+        context = (LC, self.maximizer, fix_parameters, alternative_fix_parameters, x0)
 
-        # Calculate ratios for toys
-        def fun(LC, fix_parameters=fix_parameters, alternative_fix_parameters=alternative_fix_parameters):
-            return self._max_log_likelihood_ratio(LC, fix_parameters, alternative_fix_parameters)
+        def evaluate(n):
+            # Generate toy data
+            toy_data = LC.generate_toy_data(parameters, N=n)
 
-        toy_ratios = np.array(list(mapper(fun, toy_LC)))
+            # Calculate ratios for toys
+            batches = self._toy_fit_batches(LC, parameters, toy_data, executor)
+            toy_ratios = np.concatenate(executor.map(_toy_max_log_likelihood_ratio, batches, context=context), axis=0)
+            return ratio0 >= toy_ratios
 
         # Callculate p-value
-        p_value = np.sum(ratio0 >= toy_ratios, axis=-1) / N
+        p_value, uncertainty = _sequential_p_value(evaluate, N, thresholds, precision, confidence, toys_per_round)
 
+        if return_uncertainty:
+            return p_value, uncertainty
         return p_value
 
     def wilks_max_likelihood_ratio_p_value(self, fix_parameters, alternative_fix_parameters=None, **kwargs):
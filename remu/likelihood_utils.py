@@ -3,7 +3,43 @@ import numpy as np
 from matplotlib import pyplot as plt
 from remu import likelihood
 
-def emcee_sampler(likelihood_calculator, nwalkers=None):
+class _ChunkedLogProbability(object):
+        """Evaluate a batch of parameter vectors in chunks, optionally with a pool."""
+
+        def __init__(self, likelihood_calculator, pool=None, chunk_size=None):
+            self.likelihood_calculator = likelihood_calculator
+            self.pool = pool
+            self.chunk_size = chunk_size or 1
+
+        def __call__(self, parameters):
+            parameters = np.asarray(parameters)
+            n = self.chunk_size
+            chunks = [parameters[i:i+n] for i in range(0, len(parameters), n)]
+            if self.pool is None:
+                results = map(self.likelihood_calculator, chunks)
+            else:
+                results = self.pool.map(self.likelihood_calculator, chunks)
+            return np.concatenate(list(results))
+
+def emcee_sampler(likelihood_calculator, nwalkers=None, pool=None, chunk_size=None):
+        """Create an ``emcee.EnsembleSampler`` for the given LikelihoodCalculator.
+
+        All walkers are evaluated in one vectorized call of the calculator.
+
+        Parameters
+        ----------
+
+        likelihood_calculator : LikelihoodCalculator
+        nwalkers : int, optional
+            Default: ``2 * ndim``
+        pool : optional
+            Object with a ``map`` method to evaluate chunks of walkers in parallel.
+        chunk_size : int, optional
+            Maximum number of walkers per calculator call. Default: All walkers
+            at once without a pool, one walker per task with a pool.
+
+        """
+
         import emcee
 
         defaults = likelihood_calculator.predictor.defaults
@@ -11,17 +47,15 @@ def emcee_sampler(likelihood_calculator, nwalkers=None):
         if nwalkers is None:
             nwalkers = 2*ndim
 
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, likelihood_calculator)
+        if pool is None and chunk_size is None:
+            log_prob = likelihood_calculator
+        else:
+            log_prob = _ChunkedLogProbability(likelihood_calculator, pool, chunk_size)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, log_prob, vectorize=True)
 
         return sampler
 
-def emcee_initial_guess(likelihood_calculator, nwalkers=None):
-        bounds = likelihood_calculator.predictor.bounds
-        defaults = likelihood_calculator.predictor.defaults
-        ndim = len(defaults)
-        if nwalkers is None:
-            nwalkers = 2*ndim
-
+def _draw_guess(bounds, defaults, nwalkers):
         guess = []
         for i, b in enumerate(bounds):
             fin = np.isfinite(b)
@@ -52,9 +86,346 @@ def emcee_initial_guess(likelihood_calculator, nwalkers=None):
                     scale = 1.
                 guess.append(np.random.normal(loc=loc, scale=scale, size=nwalkers))
 
-        # Reorder things
-        guess = np.array(guess).T
+        return np.array(guess).T
+
+def emcee_initial_guess(likelihood_calculator, nwalkers=None, max_tries=100):
+        """Draw random starting points for emcee walkers.
+
+        Points with a non-finite likelihood are redrawn, evaluating all
+        walkers in one batch per try.
+
+        Parameters
+        ----------
+
+        likelihood_calculator : LikelihoodCalculator
+        nwalkers : int, optional
+            Default: ``2 * ndim``
+        max_tries : int, optional
+            Maximum number of draws. A `RuntimeError` is raised if some
+            walkers still have a non-finite likelihood afterwards.
+
+        """
+
+        bounds = likelihood_calculator.predictor.bounds
+        defaults = likelihood_calculator.predictor.defaults
+        ndim = len(defaults)
+        if nwalkers is None:
+            nwalkers = 2*ndim
+
+        guess = _draw_guess(bounds, defaults, nwalkers)
+        for i in range(max_tries):
+            impossible = ~np.isfinite(likelihood_calculator(guess))
+            if not np.any(impossible):
+                return guess
+            if i < max_tries - 1:
+                guess[impossible] = _draw_guess(bounds, defaults, np.sum(impossible))
+
+        raise RuntimeError("Could not find finite starting points for %d of %d walkers in %d tries!"%(np.sum(impossible), nwalkers, max_tries))
+
+def _autocorr_function(x):
+        """Normalised autocorrelation function along the first axis."""
+        n = len(x)
+        size = 2**int(np.ceil(np.log2(2*n)))
+        x = x - np.mean(x, axis=0)
+        f = np.fft.rfft(x, n=size, axis=0)
+        acf = np.fft.irfft(f * np.conj(f), n=size, axis=0)[:n]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return acf / acf[0]
+
+def integrated_autocorr_time(chain, c=5):
+        """Estimate the integrated autocorrelation time of an ensemble chain.
+
+        The autocorrelation functions of the single walkers are averaged and
+        summed up to the smallest window ``M >= c * tau(M)``.
+
+        Parameters
+        ----------
+
+        chain : ndarray
+            Shape: ``(n_steps, n_walkers, n_parameters)``
+        c : float, optional
+            Window factor.
+
+        Returns
+        -------
+
+        tau : ndarray
+            The autocorrelation time of each parameter in units of steps.
+            Parameters that do not vary are `nan`.
+
+        """
+
+        chain = np.asarray(chain, dtype=float)
+        n = len(chain)
+        acf = np.mean(_autocorr_function(chain), axis=1)
+        taus = 2.*np.cumsum(acf, axis=0) - 1.
+        with np.errstate(invalid='ignore'):
+            in_window = np.arange(n)[:,np.newaxis] < c * taus
+        window = np.where(np.all(in_window, axis=0), n-1, np.argmin(in_window, axis=0))
+        return taus[window, np.arange(taus.shape[1])]
+
+def _truncate_npy(filename, length):
+        """Shrink the first axis of an array stored in a `.npy` file in place."""
+        with open(filename, 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            header_start = f.tell()
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            shape = (length,) + shape[1:]
+            header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % (
+                np.lib.format.dtype_to_descr(dtype), fortran_order, shape)
+            length_bytes = 2 if version == (1, 0) else 4
+            header = header.ljust(offset - header_start - length_bytes - 1) + '\n'
+            f.seek(header_start + length_bytes)
+            f.write(header.encode('latin1'))
+            f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+def _open_array(filename, shape):
+        """Allocate an array in memory, or memory mapped in a new `.npy` file."""
+        if filename is None:
+            return np.empty(shape)
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=shape)
+
+def _close_array(array, filename, length):
+        """Return the first `length` entries of an array from `_open_array`.
+
+        Memory mapped arrays are flushed, truncated on disk and opened again
+        read-only.
+
+        """
+        if filename is None:
+            return array[:length]
+        array.flush()
+        allocated = len(array)
+        del array
+        if length < allocated:
+            _truncate_npy(filename, length)
+        return np.load(filename, mmap_mode='r')
+
+def _log_prob_filename(filename):
+        """Name of the file that stores the log probabilities of a chain."""
+        if filename is None:
+            return None
+        if filename.endswith('.npy'):
+            filename = filename[:-4]
+        return filename + '_log_prob.npy'
+
+class EnsembleSampler(object):
+        """Ensemble MCMC sampler that evaluates all walkers in batches.
+
+        The walkers are split into two halves. Each half is moved with
+        proposals based on the other half, and all its proposals are evaluated
+        in one call of the LikelihoodCalculator.
+
+        Parameters
+        ----------
+
+        likelihood_calculator : LikelihoodCalculator
+        nwalkers : int, optional
+            Default: ``2 * ndim``
+        prior : function, optional
+            Log prior probability that is added to the likelihood, e.g. a
+            :class:`.JeffreysPrior`. It is called with arrays of parameter
+            vectors and must return an array of log probabilities.
+        move : {'stretch', 'de'}, optional
+            Affine-invariant stretch move or differential-evolution move.
+        scale : float, optional
+            Scale parameter ``a`` of the stretch move.
+
+        Attributes
+        ----------
+
+        chain : ndarray
+            The chain of the last run. A memory mapped ``.npy`` file if a
+            filename was given to :meth:`run`.
+            Shape: ``(n_stored, nwalkers, ndim)``
+        log_prob : ndarray
+            The log probabilities of the chain. Memory mapped like `chain`.
+            Shape: ``(n_stored, nwalkers)``
+        acceptance_fraction : ndarray
+            The acceptance fraction of each walker in the last run.
+        autocorr_time : ndarray
+            The last autocorrelation time estimate of the run in steps, or
+            `None` if it was not estimated.
+
+        """
+
+        def __init__(self, likelihood_calculator, nwalkers=None, prior=None, move='stretch', scale=2.):
+            self.likelihood_calculator = likelihood_calculator
+            self.ndim = len(likelihood_calculator.predictor.defaults)
+            if nwalkers is None:
+                nwalkers = 2*self.ndim
+            if nwalkers < 4:
+                raise ValueError("Need at least 4 walkers!")
+            if move not in ('stretch', 'de'):
+                raise ValueError("Unknown move: %s"%(move,))
+            self.nwalkers = nwalkers
+            self.prior = prior
+            self.move = move
+            self.scale = scale
+            self.chain = None
+            self.log_prob = None
+            self.acceptance_fraction = None
+            self.autocorr_time = None
+
+        def log_probability(self, positions):
+            """Calculate the log probabilities of an array of parameter vectors."""
+            positions = np.asarray(positions)
+            log_prob = np.asfarray(self.likelihood_calculator(positions))
+            if self.prior is not None:
+                finite = np.isfinite(log_prob)
+                if np.any(finite):
+                    log_prob[finite] += self.prior(positions[finite])
+            log_prob[np.isnan(log_prob)] = -np.inf
+            return log_prob
+
+        def _propose(self, walkers, others):
+            n = len(walkers)
+            if self.move == 'stretch':
+                z = ((self.scale - 1.) * np.random.uniform(size=n) + 1.)**2 / self.scale
+                partners = others[np.random.randint(len(others), size=n)]
+                proposal = partners + z[:,np.newaxis] * (walkers - partners)
+                return proposal, (self.ndim - 1.) * np.log(z)
+            else:
+                gamma = 2.38 / np.sqrt(2. * self.ndim)
+                i = np.random.randint(len(others), size=n)
+                j = (i + np.random.randint(1, len(others), size=n)) % len(others)
+                gamma = gamma * (1. + 1e-4 * np.random.normal(size=(n,1)))
+                proposal = walkers + gamma * (others[i] - others[j])
+                return proposal, np.zeros(n)
+
+        def step(self, positions, log_prob):
+            """Move all walkers once and return the new positions and log probabilities.
+
+            Returns
+            -------
+
+            positions, log_prob, accepted : ndarray
+
+            """
+            positions = np.array(positions, dtype=float)
+            log_prob = np.array(log_prob, dtype=float)
+            accepted = np.zeros(len(positions), dtype=bool)
+            half = len(positions) // 2
+            for active, other in ((slice(None, half), slice(half, None)),
+                                  (slice(half, None), slice(None, half))):
+                proposal, log_factor = self._propose(positions[active], positions[other])
+                new_log_prob = self.log_probability(proposal)
+                with np.errstate(invalid='ignore'):
+                    log_ratio = log_factor + new_log_prob - log_prob[active]
+                    accept = np.log(np.random.uniform(size=len(proposal))) < log_ratio
+                positions[active][accept] = proposal[accept]
+                log_prob[active][accept] = new_log_prob[accept]
+                accepted[active] = accept
+            return positions, log_prob, accepted
+
+        def run(self, initial, nsteps, filename=None, thin=1, chunk_size=100,
+                check_interval=None, autocorr_factor=50, tolerance=0.01, autocorr_window=10000):
+            """Run the sampler for a number of steps, or until it converged.
+
+            Parameters
+            ----------
+
+            initial : ndarray
+                Starting positions of the walkers. Shape: ``(nwalkers, ndim)``
+            nsteps : int
+                Maximum number of steps.
+            filename : str, optional
+                Store the chain in this ``.npy`` file instead of memory. Steps
+                are written in chunks, so the chain does not have to fit into
+                memory. The log probabilities are stored the same way in a
+                second file, with ``_log_prob.npy`` replacing the ``.npy``
+                extension.
+            thin : int, optional
+                Only store every `thin`-th step.
+            chunk_size : int, optional
+                The number of stored steps that are buffered before they are
+                written to the chain.
+            check_interval : int, optional
+                Estimate the autocorrelation time every `check_interval` steps
+                and stop when the chain is longer than `autocorr_factor` times
+                the estimate and the estimate changed by less than the relative
+                `tolerance`. Default: Always run all steps.
+            autocorr_window : int, optional
+                Estimate the autocorrelation time only from this many of the
+                last stored steps, so every check needs a bounded amount of
+                memory and time, even if the chain is stored on disk. Only the
+                steps in this window count as chain length for the
+                convergence criterion.
+
+            Returns
+            -------
+
+            positions, log_prob : ndarray
+                The final state. It can be used as `initial` of the next run.
+
+            """
+
+            positions = np.array(initial, dtype=float)
+            if positions.shape != (self.nwalkers, self.ndim):
+                raise ValueError("Initial positions must have shape %s!"%((self.nwalkers, self.ndim),))
+            log_prob = self.log_probability(positions)
+            n_stored = nsteps // thin
+            shape = (n_stored, self.nwalkers, self.ndim)
+            log_prob_filename = _log_prob_filename(filename)
+            chain = _open_array(filename, shape)
+            chain_log_prob = _open_array(log_prob_filename, shape[:2])
+            self.autocorr_time = None
+            buffer = np.empty((chunk_size,) + shape[1:])
+            log_prob_buffer = np.empty((chunk_size,) + shape[1:2])
+            accepted = np.zeros(self.nwalkers)
+            steps = stored = buffered = 0
+            old_tau = None
+            while steps < n_stored * thin:
+                positions, log_prob, accept = self.step(positions, log_prob)
+                accepted += accept
+                steps += 1
+                if steps % thin != 0:
+                    continue
+                buffer[buffered] = positions
+                log_prob_buffer[buffered] = log_prob
+                buffered += 1
+                if buffered == chunk_size:
+                    chain[stored:stored+buffered] = buffer
+                    chain_log_prob[stored:stored+buffered] = log_prob_buffer
+                    stored += buffered
+                    buffered = 0
+                if check_interval is not None and steps % check_interval == 0:
+                    chain[stored:stored+buffered] = buffer[:buffered]
+                    window = chain[max(stored + buffered - autocorr_window, 0):stored+buffered]
+                    tau = integrated_autocorr_time(window) * thin
+                    self.autocorr_time = tau
+                    with np.errstate(invalid='ignore'):
+                        converged = (old_tau is not None
+                                     and np.all(len(window) * thin > autocorr_factor * tau)
+                                     and np.all(np.abs(old_tau - tau) < tolerance * tau))
+                    old_tau = tau
+                    if converged:
+                        break
+            chain[stored:stored+buffered] = buffer[:buffered]
+            chain_log_prob[stored:stored+buffered] = log_prob_buffer[:buffered]
+            stored += buffered
+            self.acceptance_fraction = accepted / max(steps, 1)
+            self.chain = _close_array(chain, filename, stored)
+            self.log_prob = _close_array(chain_log_prob, log_prob_filename, stored)
+            return positions, log_prob
+
+        def get_chain(self, flat=False, discard=0):
+            """Return the stored chain of the last run.
+
+            Parameters
+            ----------
 
-        # TODO: Get rid off impossible guesses w/ logL = -inf
+            flat : bool, optional
+                Merge the steps and walkers axes.
+            discard : int, optional
+                Number of stored steps to discard at the start.
 
-        return guess
+            """
+            chain = self.chain[discard:]
+            if flat:
+                chain = chain.reshape((-1, self.ndim))
+            return chain
@@ -689,15 +689,15 @@ def improve_stats(response_matrix, data_index=None):
     arr = response_matrix.get_response_values_as_ndarray(shape=shape)
     arr = np.transpose(arr)
     arr = fun(arr)
-    new_response_matrix.response_binning.set_values_from_ndarray(arr.T)
+    new_response_matrix.set_response_values_from_ndarray(arr.T)
     arr = response_matrix.get_response_entries_as_ndarray(shape=shape)
     arr = np.transpose(arr)
     arr = fun(arr)
-    new_response_matrix.response_binning.set_entries_from_ndarray(arr.T)
+    new_response_matrix.set_response_entries_from_ndarray(arr.T)
     arr = response_matrix.get_response_sumw2_as_ndarray(shape=shape)
     arr = np.transpose(arr)
     arr = fun(arr)
-    new_response_matrix.response_binning.set_sumw2_from_ndarray(arr.T)
+    new_response_matrix.set_response_sumw2_from_ndarray(arr.T)
 
     return new_response_matrix
 
@@ -1,10 +1,13 @@
 """Module handling the creation and use of migration matrices."""
 
 from __future__ import division
+import os
 import numpy as np
 from scipy import stats
 from scipy import linalg
+from scipy import sparse
 from copy import copy, deepcopy
+from collections import OrderedDict
 from warnings import warn
 
 from .binning import Binning, CartesianProductBinning
@@ -65,6 +68,9 @@ class ResponseMatrix(object):
 
     """
 
+    # Number of parameter sets kept by `_get_stat_error_parameters`
+    _stat_error_cache_size = 8
+
     def __init__(self, reco_binning, truth_binning, nuisance_indices=[], impossible_indices=[], response_binning=None):
         self.truth_binning = truth_binning
         self.reco_binning = reco_binning
@@ -74,17 +80,23 @@ class ResponseMatrix(object):
             self.response_binning = response_binning
         self.nuisance_indices=nuisance_indices
         self.impossible_indices=impossible_indices
+        self._stat_error_cache = OrderedDict()
         self._update_filled_indices()
 
     def _update_filled_indices(self):
         """Update the list of filled truth indices."""
         self.filled_truth_indices = np.argwhere(self.get_truth_entries_as_ndarray() > 0).flatten()
 
+    def _invalidate_cache(self):
+        """Forget all cached information derived from the bin contents."""
+        self._stat_error_cache = OrderedDict()
+
     def fill(self, *args, **kwargs):
         """Fill events into the binnings."""
         self.truth_binning.fill(*args, **kwargs)
         self.reco_binning.fill(*args, **kwargs)
         self.response_binning.fill(*args, **kwargs)
+        self._invalidate_cache()
         self._update_filled_indices()
 
     def _fix_rounding_errors(self):
@@ -107,6 +119,7 @@ class ResponseMatrix(object):
         if np.any(diff < 0.): # But make sure truth is >= reco
             fixed_truth = np.where(diff < 0, resp, truth)
             self.truth_binning.set_values_from_ndarray(fixed_truth)
+            self._invalidate_cache()
 
     def fill_from_csv_file(self, *args, **kwargs):
         """Fill binnings from csv file.
@@ -122,6 +135,7 @@ class ResponseMatrix(object):
 
         """
         Binning.fill_multiple_from_csv_file([self.truth_binning, self.reco_binning, self.response_binning], *args, **kwargs)
+        self._invalidate_cache()
         self._fix_rounding_errors()
         self._update_filled_indices()
 
@@ -243,6 +257,7 @@ class ResponseMatrix(object):
         self.truth_binning.set_entries_from_ndarray(np.where(where, new_entries, old_entries))
         self.truth_binning.set_sumw2_from_ndarray(np.where(where, new_sumw2, old_sumw2))
 
+        self._invalidate_cache()
         self._fix_rounding_errors()
         self._update_filled_indices()
 
@@ -251,44 +266,54 @@ class ResponseMatrix(object):
         self.truth_binning.reset()
         self.reco_binning.reset()
         self.response_binning.reset()
+        self._invalidate_cache()
         self._update_filled_indices()
 
     def set_truth_values_from_ndarray(self, *args, **kwargs):
         """Set the values of the truth binning as `ndarray`."""
         self.truth_binning.set_values_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_truth_entries_from_ndarray(self, *args, **kwargs):
         """Set the number of entries in the truth binning as `ndarray`."""
         self.truth_binning.set_entries_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
         self._update_filled_indices()
 
     def set_truth_sumw2_from_ndarray(self, *args, **kwargs):
         """Set the sum of squared weights in the truth binning as `ndarray`."""
         self.truth_binning.set_sumw2_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_reco_values_from_ndarray(self, *args, **kwargs):
         """Set the values of the reco binning as `ndarray`."""
         self.reco_binning.set_values_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_reco_entries_from_ndarray(self, *args, **kwargs):
         """Set the number of entries in the reco binning as `ndarray`."""
         self.reco_binning.set_entries_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_reco_sumw2_from_ndarray(self, *args, **kwargs):
         """Set the sum of squared weights in the reco binning as `ndarray`."""
         self.reco_binning.set_sumw2_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_response_values_from_ndarray(self, *args, **kwargs):
         """Set the values of the response binning as `ndarray`."""
         self.response_binning.set_values_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_response_entries_from_ndarray(self, *args, **kwargs):
         """Set the number of entries in the response binning as `ndarray`."""
         self.response_binning.set_entries_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def set_response_sumw2_from_ndarray(self, *args, **kwargs):
         """Set the sum of squared weights in the response binning as `ndarray`."""
         self.response_binning.set_sumw2_from_ndarray(*args, **kwargs)
+        self._invalidate_cache()
 
     def get_truth_values_as_ndarray(self, *args, **kwargs):
         """Get the values of the truth binning as `ndarray`."""
@@ -399,6 +424,10 @@ class ResponseMatrix(object):
 
         If `truth_indices` are provided, a sliced matrix with only the given
         columns will be returned.
+
+        The results of the last `_stat_error_cache_size` distinct calls are
+        cached until the contents of the binnings change. The returned arrays
+        are read-only.
         """
 
         if nuisance_indices is None:
@@ -407,6 +436,30 @@ class ResponseMatrix(object):
         if impossible_indices is None:
             impossible_indices = self.impossible_indices
 
+        def as_key(indices):
+            if indices is None:
+                return None
+            return tuple(np.asarray(indices).flatten().tolist())
+
+        key = (float(expected_weight), as_key(nuisance_indices), as_key(impossible_indices), as_key(truth_indices))
+        cache = self._stat_error_cache
+        if key in cache:
+            # Move to the most recently used position
+            parameters = cache.pop(key)
+            cache[key] = parameters
+            return parameters
+
+        parameters = self._calculate_stat_error_parameters(expected_weight, nuisance_indices, impossible_indices, truth_indices)
+        for par in parameters:
+            par.setflags(write=False)
+        cache[key] = parameters
+        while len(cache) > self._stat_error_cache_size:
+            cache.popitem(last=False)
+        return parameters
+
+    def _calculate_stat_error_parameters(self, expected_weight, nuisance_indices, impossible_indices, truth_indices):
+        """Calculate the parameters returned by `_get_stat_error_parameters`."""
+
         if truth_indices is None:
             truth_indices = slice(None, None, None)
         else:
@@ -715,7 +768,8 @@ class ResponseMatrix(object):
             Return a sliced matrix with only the given columns.
 
         normalize : bool, optional
-            Divide the variation by the statistical variance
+            Divide the variation by the statistical variance.
+            Truth bins without any adjacent bins have a variation of 0.
 
         **kwargs : optional
             Additional keyword arguments are passed to
@@ -737,17 +791,24 @@ class ResponseMatrix(object):
         if normalize:
             variance = self.get_statistical_variance_as_ndarray(**kwargs)
         adjacent = self.truth_binning.get_adjacent_data_indices()
-        variation = np.zeros_like(response)
-        for reco_index in range(response.shape[0]):
-            for truth_index in range(response.shape[1]):
-                diff = response[reco_index, truth_index]
-                diff = diff - response[reco_index, adjacent[truth_index]]
-                diff = diff**2
-                if normalize:
-                    var = variance[reco_index, truth_index]
-                    var = var + variance[reco_index, adjacent[truth_index]]
-                    diff = diff/var
-                variation[reco_index, truth_index] = np.sqrt(np.max(diff))
+
+        # Pad the lists of adjacent indices to a common length,
+        # so all differences can be calculated in one go
+        n_adjacent = max([ len(adj) for adj in adjacent ] + [1])
+        padded = np.zeros((len(adjacent), n_adjacent), dtype=int)
+        valid = np.zeros((len(adjacent), n_adjacent), dtype=bool)
+        for truth_index, adj in enumerate(adjacent):
+            padded[truth_index, :len(adj)] = adj
+            valid[truth_index, :len(adj)] = True
+
+        # Shape: (n_reco, n_truth, n_adjacent)
+        diff = response[:,:,np.newaxis] - response[:,padded]
+        diff = diff**2
+        if normalize:
+            diff /= variance[:,:,np.newaxis] + variance[:,padded]
+        # Padding entries (and bins without neighbours) yield 0
+        diff = np.where(valid, diff, 0.)
+        variation = np.sqrt(np.max(diff, axis=-1))
 
         if truth_indices is not None:
             variation = variation[:,truth_indices]
@@ -758,13 +819,14 @@ class ResponseMatrix(object):
         return variation
 
     @staticmethod
-    def _dirichlet(alpha, size=None):
+    def _dirichlet(alpha, size=None, random_state=None):
         """Reimplements np.random.dirichlet.
 
         The original implementation is not suitable for very low alphas.
 
         """
 
+        random = np.random if random_state is None else random_state
         params = np.asfarray(alpha)
 
         if size is None:
@@ -781,9 +843,9 @@ class ResponseMatrix(object):
 
         xs = np.zeros(total_size)
 
-        xs[...,0] = np.random.beta(params[0], np.sum(params[1:]), size=size)
+        xs[...,0] = random.beta(params[0], np.sum(params[1:]), size=size)
         for j in range(1,len(params)-1):
-            phi = np.random.beta(params[j], sum(params[j+1:]), size=size)
+            phi = random.beta(params[j], sum(params[j+1:]), size=size)
             xs[...,j] = (1-np.sum(xs, axis=-1)) * phi
         xs[...,-1] = (1-np.sum(xs, axis=-1))
 
@@ -792,7 +854,7 @@ class ResponseMatrix(object):
 
         return xs
 
-    def generate_random_response_matrices(self, size=None, shape=None, **kwargs):
+    def generate_random_response_matrices(self, size=None, shape=None, random_state=None, **kwargs):
         """Generate random response matrices according to the estimated variance.
 
         Parameters
@@ -803,6 +865,9 @@ class ResponseMatrix(object):
         shape : tuple of ints, optional
             The shape of the returned matrices.
             Defaults to ``(#(reco bins), #(truth bins))``.
+        random_state : numpy.random.RandomState, optional
+            Draw the random numbers from this state instead of NumPy's global
+            random state.
         kwargs : optional
             See :meth:`get_mean_response_matrix_as_ndarray` for a description
             of more optional `kwargs`.
@@ -836,6 +901,7 @@ class ResponseMatrix(object):
         """
 
         beta1, beta2, alpha, mu, sigma = self._get_stat_error_parameters(**kwargs)
+        random = np.random if random_state is None else random_state
 
         # Generate efficiencies
         if size is None:
@@ -846,7 +912,7 @@ class ResponseMatrix(object):
             except TypeError:
                 eff_size = (size,)
             eff_size = eff_size + beta1.shape
-        effj = np.random.beta(beta1, beta2, eff_size)
+        effj = random.beta(beta1, beta2, eff_size)
 
         # Transpose so we have an array of dirichlet parameters
         alpha = alpha.T
@@ -854,7 +920,7 @@ class ResponseMatrix(object):
         # Generate truth bin by truth bin
         pij = []
         for j in range(alpha.shape[0]):
-            pij.append(self._dirichlet(alpha[j], size=size))
+            pij.append(self._dirichlet(alpha[j], size=size, random_state=random_state))
         pij = np.array(pij)
 
         # Reorganise axes
@@ -869,7 +935,7 @@ class ResponseMatrix(object):
             size.extend(mu.shape)
 
         # Generate random weights
-        wij = np.abs(np.random.normal(mu, sigma, size=size))
+        wij = np.abs(random.normal(mu, sigma, size=size))
         wj = wij[...,-1,:]
         wij = wij[...,:-1,:]
         mij = (wij / wj[...,np.newaxis,:])
@@ -895,11 +961,12 @@ class ResponseMatrix(object):
         ret.truth_binning = self.truth_binning + other.truth_binning
         ret.reco_binning = self.reco_binning + other.reco_binning
         ret.response_binning = self.response_binning + other.response_binning
+        ret._invalidate_cache()
         ret._fix_rounding_errors()
         ret._update_filled_indices()
         return ret
 
-    def export(self, filename, compress=False, nstat=None, sparse=True):
+    def export(self, filename, compress=False, nstat=None, sparse=True, csc=False, dtype=None, directory=False, low_rank=None):
         """Save all necessary information for using the response matrix.
 
         Saves all necessary information for using the response matrix`
@@ -917,6 +984,24 @@ class ResponseMatrix(object):
             Default: Export mean matrix, no random variation
         sparse : bool, optional
             Should a sparse version be exported, or the full matrix.
+        csc : bool, optional
+            Store only the non-zero matrix elements in compressed sparse
+            column (CSC) format, rather than the dense matrices.
+        dtype : numpy.dtype, optional
+            The data type of the stored matrices, e.g. ``numpy.float32`` to
+            halve the size of the file. The statistical uncertainties of the
+            matrix elements are much larger than the rounding errors.
+            Default: ``float``
+        directory : bool, optional
+            Store the arrays as separate ``.npy`` files in the directory
+            `filename` instead of a ``.npz`` archive. These files can be
+            memory mapped when they are loaded, so several processes can share
+            the same matrices in memory. Cannot be combined with `compress`.
+        low_rank : float, optional
+            Store a low-rank decomposition of the random variations with
+            this tolerance instead of the full matrices. See
+            :meth:`.likelihood.LinearPredictor.decompose_systematics`. Cannot
+            be combined with `csc`.
 
         See also
         --------
@@ -930,26 +1015,25 @@ class ResponseMatrix(object):
         else:
             matrices = self.generate_random_response_matrices(size=nstat)
         truth_entries = self.get_truth_entries_as_ndarray()
+        if dtype is not None:
+            matrices = matrices.astype(dtype)
 
         if sparse:
             sparse_indices = np.flatnonzero(truth_entries)
             matrices = matrices[...,sparse_indices]
             data = {
-                'matrices': matrices,
                 'truth_entries': truth_entries,
                 'sparse_indices': sparse_indices,
                 'is_sparse': True,
                 }
         else:
             data = {
-                'matrices': matrices,
                 'truth_entries': truth_entries,
                 }
 
-        if compress:
-            np.savez_compressed(filename, **data)
-        else:
-            np.savez(filename, **data)
+        _store_matrices(data, matrices, csc=csc, low_rank=low_rank)
+
+        _save_arrays(filename, data, compress=compress, directory=directory)
 
     def clone(self):
         """Create a functioning copy of the response matrix."""
@@ -1050,25 +1134,39 @@ class ResponseMatrixArrayBuilder(object):
         --------
 
         ResponseMatrix.generate_random_response_matrices
+        add_toy_matrices
 
         """
 
-        # Check that the nuisance indices are identical
-        nuisance_indices = response_matrix.nuisance_indices
-        if self._nuisance_indices is None:
-            self._nuisance_indices = nuisance_indices
-        elif set(self._nuisance_indices) != set(nuisance_indices):
-            raise RuntimeError("Matrices have different nuisance indices!")
+        self._add_matrix_blocks(self._get_matrix_blocks(response_matrix, self.nstat), weight)
 
+    @staticmethod
+    def _get_matrix_blocks(response_matrix, nstat, random_state=None):
+        """Extract the compact information that is stored for each matrix."""
+
+        nuisance_indices = response_matrix.nuisance_indices
         filled_indices = response_matrix.filled_truth_indices
-        if self.nstat > 0:
-            matrix = response_matrix.generate_random_response_matrices(self.nstat, truth_indices=filled_indices)
+        if nstat > 0:
+            matrix = response_matrix.generate_random_response_matrices(nstat, truth_indices=filled_indices, random_state=random_state)
         else:
             matrix = response_matrix.get_response_matrix_as_ndarray(truth_indices=filled_indices)[np.newaxis,...]
         mean_matrix = response_matrix.get_mean_response_matrix_as_ndarray(truth_indices=filled_indices)
         truth_values = response_matrix.get_truth_values_as_ndarray(indices=filled_indices)
         truth_entries = response_matrix.get_truth_entries_as_ndarray() # We need *all* entries
 
+        return nuisance_indices, filled_indices, matrix, mean_matrix, truth_values, truth_entries
+
+    def _add_matrix_blocks(self, blocks, weight):
+        """Store the information extracted by `_get_matrix_blocks`."""
+
+        nuisance_indices, filled_indices, matrix, mean_matrix, truth_values, truth_entries = blocks
+
+        # Check that the nuisance indices are identical
+        if self._nuisance_indices is None:
+            self._nuisance_indices = nuisance_indices
+        elif set(self._nuisance_indices) != set(nuisance_indices):
+            raise RuntimeError("Matrices have different nuisance indices!")
+
         self._filled_indices.append(filled_indices)
         self._matrices.append(matrix)
         self._weights.append(weight)
@@ -1080,6 +1178,80 @@ class ResponseMatrixArrayBuilder(object):
             self._truth_entries = np.maximum(self._truth_entries, truth_entries)
         self.nmatrices += 1
 
+    def add_toy_matrices(self, response_matrix, toys, weights=1., processes=None, pool=None):
+        """Fill and add toy matrices in parallel worker processes.
+
+        Parameters
+        ----------
+
+        response_matrix : :class:`ResponseMatrix`
+            The template for the toy matrices. It is cloned and reset before
+            each toy is filled, so its own contents are not used.
+        toys : list of dict or str
+            Each element describes one toy. It is either a filename, or a dict
+            of keyword arguments for :meth:`ResponseMatrix.fill_from_csv_file`,
+            e.g.::
+
+                {'filename': 'toy_0.csv', 'weightfield': 'w',
+                 'rename': {'a': 'x_reco'}, 'cut_function': my_cut}
+
+        weights : float or list of float, optional
+            The weights of the toys. A single number applies to all of them.
+        processes : int, optional
+            Number of worker processes to start. Default: ``os.cpu_count()``
+        pool : object with a ``map`` method, optional
+            Use this pool instead of creating a new :class:`multiprocessing.Pool`.
+
+        Notes
+        -----
+
+        Each task fills its own clone of `response_matrix`, generates the `nstat`
+        random variations and only sends back the compact filled-column
+        blocks that the builder stores. The toys are added in the order they
+        are listed, regardless of the order in which the workers finish.
+
+        Everything in the toy descriptions must be picklable. Lambda functions
+        as `cut_function` will not work with the standard library
+        :class:`multiprocessing.Pool`. Use module level functions instead, or
+        provide a `pool` that can handle them, e.g. from the ``multiprocess``
+        package.
+
+        Every toy gets its own :class:`numpy.random.RandomState`, seeded from
+        NumPy's global random state. Seeding that state makes the results
+        reproducible, independent of the kind of pool.
+
+        See also
+        --------
+
+        add_matrix
+
+        """
+
+        template = response_matrix.clone()
+        template.reset()
+        try:
+            weights = list(weights)
+        except TypeError:
+            weights = [weights] * len(toys)
+        if len(weights) != len(toys):
+            raise ValueError("Number of weights does not match number of toys!")
+        seeds = np.random.randint(2**31, size=len(toys))
+        tasks = [ (template, toy, self.nstat, seed) for toy, seed in zip(toys, seeds) ]
+
+        if pool is None:
+            from multiprocessing import Pool
+            own_pool = Pool(processes)
+            try:
+                results = own_pool.map(_build_toy_matrix_blocks, tasks)
+            finally:
+                own_pool.close()
+                own_pool.join()
+        else:
+            results = list(pool.map(_build_toy_matrix_blocks, tasks))
+
+        for blocks, weight in zip(results, weights):
+            self._add_matrix_blocks(blocks, weight)
+
     def _get_filled_truth_indices_set(self):
         """Return the set of filled truth indices."""
         all_indices = set()
@@ -1257,7 +1429,7 @@ class ResponseMatrixArrayBuilder(object):
 
         return M, weights
 
-    def export(self, filename, compress=False):
+    def export(self, filename, compress=False, csc=False, dtype=None, directory=False, low_rank=None):
         """Save all necessary information for using the response matrix.
 
         Saves all necessary information for using the response matrix
@@ -1270,6 +1442,24 @@ class ResponseMatrixArrayBuilder(object):
             Where to store the arrays
         compress : bool, optional
             Whether to use compression
+        csc : bool, optional
+            Store only the non-zero matrix elements in compressed sparse
+            column (CSC) format, rather than the dense matrices.
+        dtype : numpy.dtype, optional
+            The data type of the stored matrices, e.g. ``numpy.float32`` to
+            halve the size of the file. The statistical uncertainties of the
+            matrix elements are much larger than the rounding errors.
+            Default: ``float``
+        directory : bool, optional
+            Store the arrays as separate ``.npy`` files in the directory
+            `filename` instead of a ``.npz`` archive. These files can be
+            memory mapped when they are loaded, so several processes can share
+            the same matrices in memory. Cannot be combined with `compress`.
+        low_rank : float, optional
+            Store a low-rank decomposition of the random variations with
+            this tolerance instead of the full matrices. See
+            :meth:`.likelihood.LinearPredictor.decompose_systematics`. Cannot
+            be combined with `csc`.
 
         See also
         --------
@@ -1280,16 +1470,87 @@ class ResponseMatrixArrayBuilder(object):
 
         matrices, weights =  self.get_random_response_matrices_as_ndarray()
         truth_entries = self.get_truth_entries_as_ndarray()
+        if dtype is not None:
+            matrices = matrices.astype(dtype)
 
         data = {
-            'matrices': matrices,
             'weights': weights,
             'truth_entries': truth_entries,
             'sparse_indices': np.flatnonzero(truth_entries),
             'is_sparse': True,
             }
 
+        _store_matrices(data, matrices, csc=csc, low_rank=low_rank)
+
+        _save_arrays(filename, data, compress=compress, directory=directory)
+
+def _save_arrays(filename, data, compress=False, directory=False):
+    """Save the exported arrays in a ``.npz`` archive or a directory."""
+
+    if directory:
         if compress:
-            np.savez_compressed(filename, **data)
-        else:
-            np.savez(filename, **data)
+            raise ValueError("Directory exports cannot be compressed!")
+        if not os.path.isdir(filename):
+            os.makedirs(filename)
+        for key, value in data.items():
+            np.save(os.path.join(filename, key + '.npy'), value)
+    elif compress:
+        np.savez_compressed(filename, **data)
+    else:
+        np.savez(filename, **data)
+
+def _store_matrices(data, matrices, csc=False, low_rank=None):
+    """Add the matrices to the exported arrays in the requested format."""
+
+    if low_rank is not None:
+        if csc:
+            raise ValueError("Low-rank decompositions cannot be stored in CSC format!")
+        from .likelihood import LinearPredictor
+        mean, basis, coefficients = LinearPredictor.decompose_systematics(matrices, low_rank)
+        dtype = matrices.dtype
+        data['low_rank_mean'] = mean.astype(dtype)
+        data['low_rank_basis'] = basis.astype(dtype)
+        data['low_rank_coefficients'] = coefficients.astype(dtype)
+    elif csc:
+        data.update(_matrices_to_csc(matrices))
+    else:
+        data['matrices'] = matrices
+
+def _matrices_to_csc(matrices):
+    """Convert a stack of matrices to the arrays of the CSC export format.
+
+    The matrices of shape ``(n_systematics, n_reco, n_truth)`` are stored as
+    a single compressed sparse column matrix of shape ``(n_reco, n_systematics
+    * n_truth)``, i.e. the columns of systematic variation ``i`` start at
+    column ``i * n_truth``.
+
+    """
+
+    matrices = np.asarray(matrices)
+    shape = matrices.shape
+    stacked = np.moveaxis(matrices, 0, -2).reshape((shape[1], shape[0]*shape[2]))
+    csc = sparse.csc_matrix(stacked)
+    return {
+        'csc_data': csc.data,
+        'csc_indices': csc.indices,
+        'csc_indptr': csc.indptr,
+        'csc_shape': np.array(shape),
+        }
+
+def _build_toy_matrix_blocks(task):
+    """Fill a single toy matrix and return the blocks stored by the builder.
+
+    Used by :meth:`ResponseMatrixArrayBuilder.add_toy_matrices` in the worker
+    processes or threads.
+
+    """
+
+    template, toy, nstat, seed = task
+    # Never fill the shared template, tasks may run in threads of one process
+    response_matrix = template.clone()
+    random_state = np.random.RandomState(seed)
+    if isinstance(toy, dict):
+        response_matrix.fill_from_csv_file(**toy)
+    else:
+        response_matrix.fill_from_csv_file(toy)
+    return ResponseMatrixArrayBuilder._get_matrix_blocks(response_matrix, nstat, random_state)
@@ -11,6 +11,7 @@ from remu.likelihood_utils import *
 import numpy as np
 from numpy import array, inf
 import pandas as pd
+from scipy import sparse
 
 if __name__ == '__main__':
     # Parse arguments for skipping tests
@@ -958,6 +959,29 @@ class TestResponseMatrices(unittest.TestCase):
         mean = self.rm.get_mean_response_matrix_as_ndarray(truth_indices=[0,1])
         self.assertEqual(mean.shape, (4,2))
 
+    def test_stat_error_cache(self):
+        """Test the caching of the statistical error parameters."""
+        self.rm.fill_from_csv_file('testdata/test-data.csv', weightfield='w')
+        par0 = self.rm._get_stat_error_parameters(truth_indices=[0,1])
+        par1 = self.rm._get_stat_error_parameters(truth_indices=np.array([0,1]))
+        self.assertTrue(par0 is par1)
+        par2 = self.rm._get_stat_error_parameters(truth_indices=[0,2])
+        self.assertFalse(par0 is par2)
+        # Only the most recently used parameters are kept
+        for i in range(2 * self.rm._stat_error_cache_size):
+            self.rm._get_stat_error_parameters(truth_indices=[i % 4])
+            self.assertTrue(self.rm._get_stat_error_parameters(truth_indices=[0,1]) is par0)
+        self.assertEqual(len(self.rm._stat_error_cache), 6)
+        for i in range(self.rm._stat_error_cache_size):
+            self.rm._get_stat_error_parameters(expected_weight=2.+i, truth_indices=[0,1])
+        self.assertEqual(len(self.rm._stat_error_cache), self.rm._stat_error_cache_size)
+        self.assertFalse(self.rm._get_stat_error_parameters(truth_indices=[0,1]) is par0)
+        mean = self.rm.get_mean_response_matrix_as_ndarray()
+        self.rm.fill({'x_reco':1, 'y_reco':0, 'x_truth':1, 'y_truth':0})
+        par3 = self.rm._get_stat_error_parameters(truth_indices=[0,1])
+        self.assertFalse(par0 is par3)
+        self.assertFalse(np.all(mean == self.rm.get_mean_response_matrix_as_ndarray()))
+
     def test_in_bin_variation(self):
         """Test the in-bin variation calculation."""
         self.rm.fill_from_csv_file('testdata/test-data.csv', weightfield='w')
@@ -968,6 +992,43 @@ class TestResponseMatrices(unittest.TestCase):
         self.assertAlmostEqual(var[3,3], 0.8583145)
         var = self.rm.get_in_bin_variation_as_ndarray(shape=(2,2,2,1), truth_indices=[0,-1])
         self.assertEqual(var.shape, (2,2,2,1))
+        # Compare with a straightforward loop over all matrix elements
+        response = self.rm.get_mean_response_matrix_as_ndarray()
+        variance = self.rm.get_statistical_variance_as_ndarray()
+        adjacent = self.rm.truth_binning.get_adjacent_data_indices()
+        for normalize in (True, False):
+            var = self.rm.get_in_bin_variation_as_ndarray(normalize=normalize)
+            for i in range(response.shape[0]):
+                for j in range(response.shape[1]):
+                    diff = (response[i,j] - response[i,adjacent[j]])**2
+                    if normalize:
+                        diff = diff / (variance[i,j] + variance[i,adjacent[j]])
+                    self.assertAlmostEqual(var[i,j], np.sqrt(np.max(diff, initial=0.)))
+
+    def test_export_round_trip(self):
+        """Test reading exported matrices back in."""
+        import tempfile, shutil
+        from tempfile import TemporaryFile
+        self.rm.fill_from_csv_file('testdata/test-data.csv', weightfield='w')
+        mean = self.rm.get_mean_response_matrix_as_ndarray()
+        variation = self.rm.get_in_bin_variation_as_ndarray()
+        par = np.array([1.,2.,3.,4.])
+        for kwargs in ({}, {'sparse': False}, {'csc': True}, {'dtype': np.float32}):
+            with TemporaryFile() as f:
+                self.rm.export(f, **kwargs)
+                f.seek(0)
+                pred = ResponseMatrixPredictor(f)
+            self.assertTrue(np.allclose(pred(par)[0], mean.dot(par)))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.rm.export(tmpdir, directory=True)
+            pred = ResponseMatrixPredictor(tmpdir)
+            self.assertTrue(np.allclose(pred(par)[0], mean.dot(par)))
+        finally:
+            del pred
+            shutil.rmtree(tmpdir)
+        # Exporting does not change the in-memory matrix
+        self.assertTrue(np.all(self.rm.get_in_bin_variation_as_ndarray() == variation))
 
     def test_random_generation(self):
         """Test generation of randomly varied matrices."""
@@ -1045,6 +1106,31 @@ class TestResponseMatrixArrayBuilders(unittest.TestCase):
         M = self.builder.get_truth_entries_as_ndarray()
         self.assertEqual(tuple(M), (2,3,3,2))
 
+    def test_toy_matrices(self):
+        """Test parallel building of toy matrices."""
+        toys = ['testdata/test-data.csv', {'filename': 'testdata/test-data.csv', 'weightfield': 'w'}]
+        self.builder.add_toy_matrices(self.rm, toys, weights=[1., 0.5], processes=2)
+        self.assertEqual(self.builder.nmatrices, 2)
+        M, weights = self.builder.get_random_response_matrices_as_ndarray()
+        self.assertEqual(M.shape, (10,4,4))
+        self.assertEqual(weights.tolist(), [1.]*5 + [0.5]*5)
+        from multiprocessing.dummy import Pool
+        self.builder.add_toy_matrices(self.rm, toys[:1], pool=Pool(2))
+        self.assertEqual(self.builder.nmatrices, 3)
+        # Threads must not share histograms or random states
+        toys = toys * 4
+        serial = ResponseMatrixArrayBuilder(5)
+        np.random.seed(1)
+        serial.add_toy_matrices(self.rm, toys, pool=SerialExecutor())
+        threaded = ResponseMatrixArrayBuilder(5)
+        np.random.seed(1)
+        threaded.add_toy_matrices(self.rm, toys, pool=Pool(4))
+        M0, w0 = serial.get_random_response_matrices_as_ndarray()
+        M1, w1 = threaded.get_random_response_matrices_as_ndarray()
+        self.assertTrue(np.all(M0 == M1))
+        self.assertTrue(np.any(M0[:5] != M0[10:15]))
+        self.assertEqual(self.rm.get_truth_values_as_ndarray().sum(), 0.)
+
 class TestPoissonData(unittest.TestCase):
     def setUp(self):
         self.data = np.arange(4, dtype=int)
@@ -1060,6 +1146,57 @@ class TestPoissonData(unittest.TestCase):
         self.assertAlmostEqual(ret[0,0], -3.8027754226637804)
         self.assertAlmostEqual(ret[1,2], -6.484906649788)
 
+    def test_special_values(self):
+        calc = PoissonData([[0,1,2,3], [1,0,0,2]])
+        for dtype in (float, np.float32):
+            ret = calc(np.array([[0,1,2,3], [1,0,1,1], [-1,1,1,1], [0,1,np.inf,1]], dtype=dtype))
+            self.assertEqual(ret.shape, (2,4))
+            self.assertAlmostEqual(ret[0,0], -3.8027754226637804, places=5)
+            self.assertTrue(np.isfinite(ret[1,1]))
+            self.assertTrue(np.all(ret[[1,0],[0,1]] == -np.inf))
+            self.assertTrue(np.all(ret[:,2:] == -np.inf))
+
+    @unittest.skipIf(sys.version_info < (3,4), "Memory tracing requires Python 3.4")
+    def test_float32(self):
+        import tracemalloc
+        calc = PoissonData(np.random.poisson(5., size=(50,200)))
+        mu = np.random.uniform(1., 10., size=(100,200))
+        expected = calc(mu)
+        mu = mu.astype(np.float32)
+        calc(mu)
+        tracemalloc.start()
+        try:
+            ret = calc(mu)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(ret.dtype, np.float64)
+        self.assertTrue(np.allclose(ret, expected, rtol=1e-5))
+        # The full-size work buffer is single precision
+        full_size = 50 * 100 * 200
+        self.assertTrue(4 * full_size <= peak < 5 * full_size)
+        # No other temporary arrays of the size of the predictions
+        calc = PoissonData(np.random.poisson(5., size=200))
+        mu = np.random.uniform(1., 10., size=(5000,200)).astype(np.float32)
+        calc(mu)
+        tracemalloc.start()
+        try:
+            calc(mu)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(peak < 5 * mu.size)
+
+    def test_paired(self):
+        calc = PoissonData([self.data, [1]*4])
+        ret = calc([[self.data]*3, [[1]*4]*3], paired=True)
+        self.assertEqual(ret.shape, (2,3))
+        self.assertAlmostEqual(ret[0,0], -3.8027754226637804)
+        self.assertAlmostEqual(ret[1,2], calc.log_likelihood([1]*4)[1])
+        ret = calc.log_likelihood_gradient([self.data, [1]*4], paired=True)
+        self.assertEqual(ret.shape, (2,4))
+        self.assertTrue(np.all(ret == [[-1.,0.,0.,0.], [0.,0.,0.,0.]]))
+
     def test_toy_data(self):
         ret = self.calc.generate_toy_data(self.data)
         self.assertEqual(ret.shape, (4,))
@@ -1091,6 +1228,66 @@ class TestLinearPredictors(unittest.TestCase):
         self.assertEqual(pred.tolist(), [[1.1,10.7,10.3]]*2)
         self.assertEqual(weights.tolist(), [1., 0.5])
 
+    def test_low_rank(self):
+        np.random.seed(0)
+        mean = np.random.uniform(size=(5,3))
+        basis = np.random.normal(size=(2,5,3))
+        matrices = mean + np.tensordot(np.random.normal(size=(20,2)) * [1., 0.01], basis, axes=1)
+        dense = LinearPredictor(matrices, [0.1]*5, weights=np.arange(20))
+        pred = LinearPredictor(matrices, [0.1]*5, weights=np.arange(20), low_rank=1e-6)
+        self.assertEqual(pred.low_rank_basis.shape, (2,5,3))
+        self.assertEqual(pred.low_rank_coefficients.shape, (20,2))
+        par = [[1.,2.,3.], [0.,1.,5.]]
+        for index in (slice(None), 3, [1,2]):
+            y0, w0 = dense(par, systematics_index=index)
+            y1, w1 = pred(par, systematics_index=index)
+            self.assertEqual(y0.shape, y1.shape)
+            self.assertTrue(np.allclose(y0, y1))
+            self.assertEqual(w0.tolist(), w1.tolist())
+        vector = np.random.normal(size=(2,20,5))
+        self.assertTrue(np.allclose(pred.vector_jacobian_product(par, vector), dense.vector_jacobian_product(par, vector)))
+        for index in (3, [1,2]):
+            v = vector[:,index]
+            self.assertTrue(np.allclose(pred.vector_jacobian_product(par, v, systematics_index=index),
+                                        dense.vector_jacobian_product(par, v, systematics_index=index)))
+        self.assertEqual(pred.is_non_negative(), dense.is_non_negative())
+        calc = LikelihoodCalculator(PoissonData([1,2,3,4,5]), pred)
+        L, grad = calc.log_likelihood_and_gradient(np.array([1.,2.,3.]))
+        self.assertTrue(np.allclose(grad, LikelihoodCalculator(PoissonData([1,2,3,4,5]), dense).gradient(np.array([1.,2.,3.]))))
+        # The full matrices are never reconstructed
+        self.assertTrue(pred._matrices is None)
+        fixed = pred.fix_parameters([None, 2., None])
+        self.assertTrue(fixed.low_rank_basis is not None)
+        self.assertTrue(np.allclose(fixed([1.,3.])[0], dense([1.,2.,3.])[0]))
+        # Compositions keep the decomposition
+        templates = TemplatePredictor([[1.,0.,1.],[0.,1.,1.]], constants=[0.,0.5,1.])
+        variations = TemplatePredictor([[[1.,0.,1.],[0.,1.,1.]], [[1.,0.,0.],[0.,1.,0.]]], weights=[1.,2.])
+        low_rank = LinearPredictor(np.random.uniform(size=(4,3,2)), constants=[1.,2.,3.], weights=[1.,2.,3.,4.], low_rank=1e-9)
+        for inner in (templates, variations, low_rank, low_rank.fix_parameters([None, 3.])):
+            for outer in (pred, dense):
+                composed = outer.compose(inner)
+                reference = ComposedPredictor([outer, inner])
+                self.assertEqual(composed.low_rank_basis is not None, outer is pred)
+                par = np.random.uniform(size=(2, len(inner.defaults)))
+                y0, w0 = reference(par)
+                y1, w1 = composed(par)
+                self.assertTrue(np.allclose(y0, y1))
+                self.assertEqual(w0.tolist(), w1.tolist())
+                vector = np.random.normal(size=y0.shape)
+                reference = LinearPredictor(composed.matrices, composed.constants, weights=composed.weights)
+                self.assertTrue(np.allclose(composed.vector_jacobian_product(par, vector),
+                                            reference.vector_jacobian_product(par, vector)))
+        composed = pred.compose(templates)
+        self.assertTrue(np.all(composed.low_rank_coefficients == pred.low_rank_coefficients))
+        # A decomposition with more components than matrices is not kept
+        composed = pred.select_systematics([0]).compose(templates)
+        self.assertTrue(composed.low_rank_basis is None)
+        self.assertTrue(np.allclose(composed([1.,2.])[0], dense.select_systematics([0]).compose(templates)([1.,2.])[0]))
+        self.assertTrue(pred._matrices is None)
+        self.assertTrue(fixed._matrices is None)
+        pred = LinearPredictor(matrices, low_rank=0.5)
+        self.assertEqual(pred.low_rank_basis.shape[0], 1)
+
 class TestTemplatePredictors(unittest.TestCase):
     def setUp(self):
         self.pred = TemplatePredictor([[[1.,0.],[0.5,1.],[0.,1.]]]*2, [0.1,0.2,0.3], weights=[1.,0.5])
@@ -1161,6 +1358,16 @@ class TestFixedParameterLinearPredictors(unittest.TestCase):
         self.assertEqual(pred.shape, (5,2,3))
         self.assertEqual(weights.shape, (5,2))
 
+    def test_sparse_indices(self):
+        matrices = [[[1.,0.],[0.5,1.],[0.,1.]]]*2
+        for M in (matrices, [sparse.csr_matrix(m) for m in matrices]):
+            pred = LinearPredictor(M, [0.1,0.2,0.3], weights=[1.,0.5], sparse_indices=[0,2], bounds=[(0,np.inf)]*3, defaults=[1.]*3)
+            fixed = pred.fix_parameters([None, 5., 10.])
+            self.assertEqual(fixed.sparse_matrix is None, M is matrices)
+            pred, weights = fixed([1])
+            self.assertTrue(np.allclose(pred, [[1.1,10.7,10.3]]*2))
+            self.assertEqual(weights.tolist(), [1., 0.5])
+
 class TestComposedPredictors(unittest.TestCase):
     def setUp(self):
         self.w0 = np.array([1,2])
@@ -1207,6 +1414,41 @@ class TestComposedLinearPredictors(unittest.TestCase):
         self.assertEqual(pred.shape, (2,24,3))
         self.assertEqual(weights.shape, (2,24))
 
+    def test_compile(self):
+        sparse_pred = LinearPredictor([sparse.csr_matrix([[1.,1.]])]*2, weights=self.w0, sparse_indices=[0,2], bounds=[(0,np.inf)]*3, defaults=[1.]*3)
+        chain = ComposedPredictor([self.pred2, ComposedPredictor([self.pred1, sparse_pred.fix_parameters([None, 2., None])])])
+        compiled = chain.compile()
+        self.assertTrue(isinstance(compiled, ComposedLinearPredictor))
+        par = np.array([[1.,3.],[0.5,2.]])
+        pred, weights = chain(par)
+        cpred, cweights = compiled(par)
+        self.assertTrue(np.allclose(pred, cpred))
+        self.assertTrue(np.allclose(weights, cweights))
+        compiled = sparse_pred.compile()
+        self.assertEqual(compiled.sparse_indices, slice(None))
+        self.assertTrue(np.allclose(compiled([1.,2.,3.])[0], sparse_pred([1.,2.,3.])[0]))
+
+    def test_sparse(self):
+        matrices = [ sparse.csc_matrix(np.eye(20) * i) for i in range(1, 4) ]
+        pred = LinearPredictor(matrices, weights=[1.,2.,3.], sparse_indices=np.arange(1, 21), bounds=[(0,np.inf)]*21, defaults=[1.]*21)
+        dense = LinearPredictor(pred._folded_matrices()[0].toarray()[np.newaxis] * np.arange(1, 4)[:,np.newaxis,np.newaxis],
+                                weights=[1.,2.,3.], bounds=[(0,np.inf)]*21, defaults=[1.]*21)
+        templates = np.zeros((2, 2, 21))
+        templates[0,0,:11] = 1.
+        templates[:,1,11:] = 2.
+        templates = TemplatePredictor(templates, constants=np.arange(21), weights=[1.,0.5])
+        full = TemplatePredictor(np.ones((2, 21)))
+        # Compositions stay sparse, unless dense matrices are smaller
+        for inner in (templates, templates.fix_parameters([None, 3.]), full):
+            composed = pred.compose(inner)
+            self.assertEqual(composed.sparse_matrix is not None, inner is not full)
+            par = np.random.uniform(size=(2, len(inner.defaults)))
+            y0, w0 = dense.compose(inner)(par)
+            y1, w1 = composed(par)
+            self.assertTrue(np.allclose(y0, y1))
+            self.assertEqual(w0.tolist(), w1.tolist())
+        self.assertTrue(pred._matrices is None)
+
 class TestResponseMatrixPredictors(unittest.TestCase):
     def setUp(self):
         with open('testdata/test-truth-binning.yml', 'r') as f:
@@ -1241,6 +1483,93 @@ class TestResponseMatrixPredictors(unittest.TestCase):
         self.assertEqual(y.shape, (1, 4))
         self.assertEqual(y[0,0], 0.)
 
+    def test_csc_matrix(self):
+        with TemporaryFile() as f:
+            self.builder.export(f, csc=True)
+            f.seek(0)
+            pred = ResponseMatrixPredictor(f)
+        self.assertTrue(pred.sparse_matrix is not None)
+        par = [[1,2,3,4], [0,1,0,1]]
+        y0, w0 = self.pred(par)
+        y1, w1 = pred(par)
+        self.assertEqual(y1.shape, (2, 10, 4))
+        self.assertTrue(np.allclose(y0, y1))
+        self.assertEqual(w0.tolist(), w1.tolist())
+        y0, w0 = self.pred(par, systematics_index=3)
+        y1, w1 = pred(par, systematics_index=3)
+        self.assertEqual(y1.shape, (2, 4))
+        self.assertTrue(np.allclose(y0, y1))
+        self.assertTrue(np.allclose(self.pred.matrices, pred.matrices))
+        with TemporaryFile() as f:
+            self.rm.export(f, csc=True, nstat=3)
+            f.seek(0)
+            pred = ResponseMatrixPredictor(f)
+        y, w = pred([1,0,0,0])
+        self.assertEqual(y.shape, (3, 4))
+
+    def test_low_rank(self):
+        with TemporaryFile() as f:
+            self.builder.export(f, low_rank=1e-9)
+            f.seek(0)
+            pred = ResponseMatrixPredictor(f)
+        self.assertTrue(pred.low_rank_basis is not None)
+        y0, w0 = self.pred([[1,2,3,4], [0,1,0,1]])
+        y1, w1 = pred([[1,2,3,4], [0,1,0,1]])
+        self.assertTrue(np.allclose(y0, y1))
+        self.assertEqual(w0.tolist(), w1.tolist())
+        with TemporaryFile() as f:
+            self.builder.export(f)
+            f.seek(0)
+            pred = ResponseMatrixPredictor(f, low_rank=1e-9)
+        self.assertTrue(np.allclose(y0, pred([[1,2,3,4], [0,1,0,1]])[0]))
+        with TemporaryFile() as f:
+            self.assertRaises(ValueError, self.builder.export, f, csc=True, low_rank=1e-3)
+
+    def test_float32(self):
+        for csc in (False, True):
+            with TemporaryFile() as f:
+                self.builder.export(f, csc=csc, dtype=np.float32)
+                f.seek(0)
+                pred = ResponseMatrixPredictor(f)
+            self.assertEqual(pred.dtype, np.float32)
+            y, w = pred([1,2,3,4])
+            self.assertEqual(y.dtype, np.float32)
+            y0, w0 = self.pred([1,2,3,4])
+            self.assertTrue(np.allclose(y, y0, rtol=1e-6))
+            data = PoissonData([1,2,3,4])
+            self.assertAlmostEqual(np.sum(data(y)), np.sum(data(y0)), places=4)
+            # Compositions keep the precision of the response matrix
+            templates = TemplatePredictor([[1.,0.,1.,0.],[0.,1.,0.,1.]])
+            for composed in (pred.compose(templates), ComposedPredictor([pred, templates]).compile(),
+                             pred.compose(templates.fix_parameters([None, 2.]))):
+                self.assertEqual(composed.dtype, np.float32)
+                y, w = composed([1.,2.][:len(composed.defaults)])
+                self.assertEqual(y.dtype, np.float32)
+                self.assertTrue(np.allclose(y, self.pred.compose(templates)([1.,2.])[0], rtol=1e-6))
+        with TemporaryFile() as f:
+            self.builder.export(f)
+            f.seek(0)
+            pred = ResponseMatrixPredictor(f, dtype=np.float32)
+        self.assertEqual(pred.matrices.dtype, np.float32)
+
+    def test_directory_export(self):
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.builder.export(tmpdir, directory=True)
+            pred = ResponseMatrixPredictor(tmpdir)
+            self.assertFalse(pred.matrices.flags.writeable)
+            self.assertTrue(np.all(pred.matrices == self.pred.matrices))
+            y0, w0 = self.pred([1,2,3,4])
+            y1, w1 = pred([1,2,3,4])
+            self.assertTrue(np.all(y0 == y1))
+            self.assertEqual(w0.tolist(), w1.tolist())
+            pred = ResponseMatrixPredictor(tmpdir, mmap_mode=None)
+            self.assertTrue(pred.matrices.flags.writeable)
+            self.assertRaises(ValueError, self.builder.export, tmpdir, compress=True, directory=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
 class TestSystematics(unittest.TestCase):
     def setUp(self):
         self.data = np.log(np.arange(2*3*5)+1)
@@ -1253,6 +1582,16 @@ class TestSystematics(unittest.TestCase):
                         np.mean(np.exp(self.data), axis=-1).flat):
             self.assertAlmostEqual(A,B)
 
+    def test_marginal_weights(self):
+        weights = np.broadcast_to(np.arange(5) + 1., (3,5))
+        ret = MarginalLikelihoodSystematics.consume_axis(self.data, weights)
+        expected = np.sum(np.exp(self.data) * weights, axis=-1) / np.sum(weights, axis=-1)
+        self.assertTrue(np.allclose(np.exp(ret), expected))
+        ret = MarginalLikelihoodSystematics.consume_axis(self.data, np.ones((3,5)))
+        self.assertTrue(np.allclose(ret, MarginalLikelihoodSystematics.consume_axis(self.data)))
+        ret = MarginalLikelihoodSystematics.consume_axis(self.data, np.broadcast_to(1., (3,5)))
+        self.assertTrue(np.allclose(ret, MarginalLikelihoodSystematics.consume_axis(self.data)))
+
     def test_profile_systematics(self):
         ret = ProfileLikelihoodSystematics.consume_axis(self.data)
 
@@ -1296,6 +1635,142 @@ class TestLikelihoodCalculators(unittest.TestCase):
             stats.poisson(test_reco).logpmf(self.data).sum())
         self.assertEqual(ret.shape, (2,5))
 
+    def test_max_memory(self):
+        np.random.seed(0)
+        pred = LinearPredictor(np.random.uniform(0.5, 1.5, size=(7,4,4)), weights=np.arange(7)+1., bounds=[(0, np.inf)]*4)
+        par = np.random.uniform(0, 4, size=(3,5,4))
+        par[1,2,0] = -1.
+        for syst in ('marginal', 'profile'):
+            calc = LikelihoodCalculator(self.data_model, pred, syst)
+            expected = calc(par)
+            for max_memory in (1, 1000, 2000, 10**6):
+                chunked = LikelihoodCalculator(self.data_model, pred, syst, max_memory=max_memory)
+                ret = chunked(par)
+                self.assertEqual(ret.shape, (2,3,5))
+                self.assertTrue(np.allclose(ret, expected, rtol=1e-12))
+                self.assertEqual(ret[0,1,2], -np.inf)
+                self.assertTrue(np.allclose(chunked(par[0,0]), expected[:,0,0]))
+            self.assertEqual(chunked.fix_parameters([None, None, None, 1.]).max_memory, 10**6)
+        # Default uniform weights
+        pred = LinearPredictor(pred.matrices, bounds=[(0, np.inf)]*4)
+        par = par[0,0]
+        prediction, weights = pred(par)
+        log_likelihood = self.data_model(prediction)
+        expected = np.log(np.mean(np.exp(log_likelihood), axis=-1))
+        self.assertTrue(np.allclose(LikelihoodCalculator(self.data_model, pred)(par), expected))
+        self.assertTrue(np.allclose(LikelihoodCalculator(self.data_model, pred, max_memory=200)(par), expected))
+        self.assertTrue(np.allclose(MarginalLikelihoodSystematics.consume_axis(log_likelihood, weights), expected))
+        calc = LikelihoodCalculator(self.data_model, pred, NoSystematics)
+        chunked = LikelihoodCalculator(self.data_model, pred, NoSystematics, max_memory=1000)
+        self.assertTrue(np.allclose(chunked(par, systematics_index=2), calc(par, systematics_index=2)))
+
+    def test_cache(self):
+        calc = LikelihoodCalculator(self.data_model, self.predictor, cache_size=2)
+        par = np.array([0.5,1.,2.,3.])
+        for i in range(5):
+            calc.data_model = PoissonData([self.data + i]*2)
+            self.assertTrue(np.all(calc(par) == LikelihoodCalculator(calc.data_model, self.predictor)(par)))
+        calc = LikelihoodCalculator(self.data_model, self.predictor, cache_size=2)
+        par = np.array([0.5,1.,2.,3.])
+        ret = calc(par)
+        self.assertEqual(calc.cache_info(), (0, 1, 2, 1))
+        ret[0] = 0.
+        self.assertTrue(np.all(calc(par) == self.calc(par)))
+        self.assertEqual(calc.cache_info().hits, 1)
+        calc(par + 1.)
+        calc(par + 2.)
+        calc(par)
+        self.assertEqual(calc.cache_info(), (1, 4, 2, 2))
+        ll, grad = calc.log_likelihood_and_gradient(par)
+        ll, grad = calc.log_likelihood_and_gradient(list(par))
+        self.assertEqual(calc.cache_info().hits, 2)
+        self.assertTrue(np.all(grad == self.calc.gradient(par)))
+        self.assertEqual(calc.with_data(self.data).cache_info(), (0, 0, 2, 0))
+        calc.clear_cache()
+        self.assertEqual(calc.cache_info(), (0, 0, 2, 0))
+        self.assertEqual(self.calc.cache_info(), (0, 0, 0, 0))
+
+    def test_subsample_systematics(self):
+        np.random.seed(0)
+        matrices = np.random.uniform(0.5, 1.5, size=(10,4,4))
+        weights = np.arange(10) % 3
+        pred = LinearPredictor(matrices, weights=weights, sparse_indices=[0,1,3,4], bounds=[(0,np.inf)]*5, defaults=[1.]*5)
+        calc = LikelihoodCalculator(self.data_model, pred)
+        self.assertTrue(calc.subsample_systematics(10) is calc)
+        sub = calc.subsample_systematics(4)
+        self.assertEqual(sub.predictor.weights.shape, (4,))
+        self.assertEqual(np.sum(sub.predictor.weights), np.sum(weights))
+        par = [1.,2.,0.,3.,4.]
+        prediction = sub.predictor(par)[0]
+        full = pred(par)[0]
+        for p, i, j in zip(prediction, [0, 2, 5, 7], [2, 5, 7, 10]):
+            # One non-zero weight variation per stratum
+            self.assertTrue(np.any([np.allclose(p, full[k]) for k in range(i, j) if weights[k] > 0]))
+        self.assertEqual(sub(par).shape, (2,))
+        low_rank = LinearPredictor(matrices, low_rank=1e-9).select_systematics([2, 5])
+        self.assertTrue(np.allclose(low_rank([1.,2.,3.,4.])[0], matrices[[2,5]].dot([1.,2.,3.,4.])))
+        sparse_pred = LinearPredictor([sparse.csr_matrix(m) for m in matrices]).select_systematics([2, 5])
+        self.assertTrue(np.allclose(sparse_pred([1.,2.,3.,4.])[0], matrices[[2,5]].dot([1.,2.,3.,4.])))
+
+    def test_gradient(self):
+        from scipy.sparse import csr_matrix
+        np.random.seed(0)
+        matrices = np.random.uniform(0.1, 1., size=(3,4,4))
+        predictors = [LinearPredictor(matrices, weights=[1,2,3]),
+                      LinearPredictor([csr_matrix(m[:,:3]) for m in matrices], sparse_indices=[0,2,3], defaults=[1.]*4, bounds=[(0,np.inf)]*4),
+                      LinearPredictor(matrices).compose(TemplatePredictor([[1,0,1,0],[0,1,0,1]])),
+                      LinearPredictor(matrices).fix_parameters([None, 2., None, None])]
+        for pred in predictors:
+            for syst in ('marginal', 'profile'):
+                calc = LikelihoodCalculator(self.data_model, pred, syst)
+                self.assertTrue(calc.has_gradient)
+                par = np.random.uniform(1., 3., size=(5,len(pred.defaults)))
+                L, grad = calc.log_likelihood_and_gradient(par)
+                self.assertTrue(np.allclose(L, calc(par)))
+                self.assertEqual(grad.shape, (2,5,len(pred.defaults)))
+                for i in range(len(pred.defaults)):
+                    eps = np.zeros_like(par)
+                    eps[:,i] = 1e-6
+                    diff = (calc(par+eps) - calc(par-eps)) / 2e-6
+                    self.assertTrue(np.allclose(grad[...,i], diff, rtol=1e-4, atol=1e-5))
+        composed = self.calc.compose(Predictor([(-np.inf,np.inf)], [1.]))
+        self.assertFalse(composed.has_gradient)
+
+    def test_gradient_impossible_variation(self):
+        # The second variation can never describe the data in the second bin
+        pred = LinearPredictor([np.eye(2), [[1.,0.],[0.,0.]]], bounds=[(0,np.inf)]*2, defaults=[1.,1.])
+        calc = LikelihoodCalculator(PoissonData([2,3]), pred)
+        L, grad = calc.log_likelihood_and_gradient(np.array([1.,1.]))
+        self.assertTrue(np.isfinite(L))
+        self.assertTrue(np.allclose(grad, [1.,2.]))
+        opt = BasinHoppingMaximizer()(calc)
+        self.assertTrue(np.allclose(opt.x, [2.,3.], atol=1e-3))
+
+    @unittest.skipIf(sys.version_info < (3,8), "Shared memory requires Python 3.8")
+    def test_shared_memory(self):
+        import pickle
+        from multiprocessing import Pool
+        from scipy.sparse import csr_matrix
+        test_reco = np.array([0.5,0.5,0.5,0.5])
+        sparse_calc = LikelihoodCalculator(self.data_model, LinearPredictor([csr_matrix(np.eye(4))]*3))
+        for calc in (self.calc, sparse_calc, self.calc.fix_parameters([None, None, None, 0.5])):
+            expected = calc([test_reco[:len(calc.predictor.defaults)]]*3)
+            size = len(pickle.dumps(calc))
+            calc.share_memory()
+            try:
+                self.assertTrue(len(pickle.dumps(calc)) < size)
+                self.assertTrue(np.all(pickle.loads(pickle.dumps(calc))([test_reco[:len(calc.predictor.defaults)]]*3) == expected))
+                pool = Pool(2)
+                try:
+                    ret = pool.map(calc, [test_reco[:len(calc.predictor.defaults)]]*3)
+                finally:
+                    pool.close()
+                    pool.join()
+                self.assertTrue(np.all(np.array(ret).T == expected))
+            finally:
+                calc.release_shared_memory()
+            self.assertTrue(np.all(calc([test_reco[:len(calc.predictor.defaults)]]*3) == expected))
+
 class TestLikelihoodMaximizers(unittest.TestCase):
     def setUp(self):
         self.data = np.arange(4, dtype=int)
@@ -1308,6 +1783,100 @@ class TestLikelihoodMaximizers(unittest.TestCase):
         opt = maxer(self.calc)
         for i in range(4):
             self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+        maxer = BasinHoppingMaximizer(use_gradient=False)
+        opt = maxer(self.calc)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+
+    def test_projected_lbfgs(self):
+        maxer = ProjectedLBFGSMaximizer()
+        opt = maxer(self.calc)
+        self.assertTrue(opt.success)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+        data = np.array([[0,1,2,3], [5,0,4,8], [3,3,3,3]])
+        opt = maxer.maximize_log_likelihood_batch(self.calc.with_data(data))
+        self.assertEqual(opt.x.shape, (3,4))
+        self.assertTrue(np.all(opt.success))
+        self.assertTrue(np.allclose(opt.x, data, atol=1e-3))
+        calc = self.calc.with_data(data).fix_parameters([None, None, None, 3.])
+        opt = maxer.maximize_log_likelihood_batch(calc)
+        ref = BasinHoppingMaximizer().maximize_log_likelihood_batch(calc)
+        self.assertTrue(np.allclose(opt.log_likelihood, ref.log_likelihood, atol=1e-3))
+
+    def test_start_parameters(self):
+        maxer = ProjectedLBFGSMaximizer(maxiter=0)
+        opt = maxer(self.calc, x0=[1., 2., 3., 5.])
+        self.assertTrue(np.all(opt.x == [1., 2., 3., 5.]))
+        opt = maxer(self.calc.with_data([1,1,1,1]), x0=[0., 2., 3., 5.])
+        self.assertTrue(np.all(opt.x == self.predictor.defaults))
+        for maxer in (BasinHoppingMaximizer(), ProjectedLBFGSMaximizer(), EMMaximizer()):
+            opt = maxer(self.calc, x0=[1., 2., 3., 5.])
+            for i in range(4):
+                self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+
+    def test_em(self):
+        maxer = EMMaximizer()
+        self.assertTrue(maxer.is_applicable(self.calc))
+        opt = maxer(self.calc)
+        self.assertTrue(opt.success)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+        np.random.seed(0)
+        matrices = np.random.uniform(0.5, 1., size=(2,6,4))
+        data = np.array([[1,5,2,3,4,6], [3,0,2,8,4,1]])
+        for syst in ('marginal', 'profile'):
+            pred = TemplatePredictor(matrices.swapaxes(-1,-2))
+            calc = LikelihoodCalculator(PoissonData(data), pred, syst).fix_parameters([None, None, 1., None])
+            opt = maxer.maximize_log_likelihood_batch(calc)
+            ref = ProjectedLBFGSMaximizer().maximize_log_likelihood_batch(calc)
+            self.assertTrue(np.all(opt.success))
+            self.assertTrue(np.all(opt.log_likelihood >= ref.log_likelihood - 1e-4))
+        # Lower limits are enforced
+        pred = LinearPredictor(np.eye(4), bounds=[(2.,np.inf), (0,np.inf), (0,1.), (0,np.inf)])
+        calc = LikelihoodCalculator(PoissonData(self.data), pred)
+        self.assertTrue(maxer.is_applicable(calc))
+        opt = maxer(calc)
+        self.assertTrue(np.allclose(opt.x, [2.,1.,1.,3.], atol=1e-3))
+        calc = LikelihoodCalculator(PoissonData(self.data + 1), LinearPredictor(np.eye(4)))
+        self.assertFalse(maxer.is_applicable(calc))
+        opt = maxer(calc)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i] + 1, places=2)
+
+    def test_multistart(self):
+        maxer = MultiStartMaximizer()
+        opt = maxer(self.calc)
+        self.assertTrue(opt.agreed)
+        self.assertTrue(opt.n_starts >= 2)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
+        with ProcessExecutor(2) as executor:
+            maxer = MultiStartMaximizer(n_starts=2, executor=executor, use_gradient=False)
+            opt = maxer(self.calc)
+            # The worker pool is reused in the following calls with the same context
+            pool = executor._context_pool
+            self.assertTrue(pool is not None)
+            from remu.likelihood import _local_minimize
+            context = executor._context
+            executor.map(_local_minimize, [self.calc.predictor.defaults], context=tuple(context))
+            self.assertTrue(executor._context_pool is pool)
+        self.assertTrue(executor._context_pool is None)
+
+    def test_multistart_pool_reuse(self):
+        class CountingExecutor(ProcessExecutor):
+            n_pools = 0
+            def _new_pool(self, context=None):
+                CountingExecutor.n_pools += 1
+                return ProcessExecutor._new_pool(self, context)
+        with CountingExecutor(2) as executor:
+            # Never agree, so all rounds are run
+            maxer = MultiStartMaximizer(n_starts=2, max_rounds=3, n_agree=10, executor=executor, use_gradient=False)
+            opt = maxer(self.calc)
+        self.assertEqual(opt.n_starts, 6)
+        self.assertEqual(CountingExecutor.n_pools, 1)
+        for i in range(4):
+            self.assertAlmostEqual(opt.x[i], self.data[i], places=3)
 
 class TestHypothesisTesters(unittest.TestCase):
     def setUp(self):
@@ -1327,6 +1896,50 @@ class TestHypothesisTesters(unittest.TestCase):
         ret = self.test.likelihood_p_value([[[1,1,1,1]]*2]*3)
         self.assertEqual(ret.shape, (3,2))
 
+    def test_adaptive_p_value(self):
+        ret, err = self.test.likelihood_p_value(self.data, thresholds=0.05, toys_per_round=20, return_uncertainty=True)
+        self.assertEqual(ret, 1.)
+        self.assertTrue(err > 0.05)
+        ret, err = self.test.likelihood_p_value([1,1,1,0], thresholds=[0.01, 0.05], toys_per_round=20, return_uncertainty=True)
+        self.assertEqual(ret, 0.)
+        self.assertTrue(0.001 < err < 0.005)
+        ret, err = self.test.likelihood_p_value([1,1,1,1], precision=0.05, return_uncertainty=True)
+        self.assertTrue(0.03 < err <= 0.05)
+        ret, err = self.test.likelihood_p_value([[[1,1,1,1]]*2]*3, N=20, return_uncertainty=True)
+        self.assertEqual(ret.shape, (3,2))
+        self.assertEqual(err.shape, (3,2))
+        ret, err = self.test.max_likelihood_p_value(fix_parameters=(None, None, None, 20), N=20,
+                                                    thresholds=0.5, toys_per_round=5, return_uncertainty=True)
+        self.assertEqual(ret, 0.)
+        self.assertTrue(err > 0.1)
+        ret, err = self.test.max_likelihood_ratio_p_value((None, None, 2, 30), alternative_fix_parameters=(None, None, None, 3), N=20,
+                                                          thresholds=0.5, toys_per_round=5, return_uncertainty=True)
+        self.assertEqual(ret, 0.)
+        self.assertTrue(err > 0.1)
+
+    def test_sequential_p_value_correction(self):
+        from remu.likelihood import _binomial_interval, _sequential_p_value
+        never = lambda n: np.zeros(n, dtype=bool)
+        # A single round uses the nominal confidence
+        p, err = _sequential_p_value(never, 100, None, None, 0.95, 50)
+        lower, upper = _binomial_interval(0, 100, 0.95)
+        self.assertEqual(p, 0.)
+        self.assertAlmostEqual(err, (upper - lower) / 2.)
+        # Ten possible rounds split the error rate ten ways
+        p, err = _sequential_p_value(never, 100, None, 1e-6, 0.95, 10)
+        lower, upper = _binomial_interval(0, 100, 0.995)
+        self.assertAlmostEqual(err, (upper - lower) / 2.)
+        # The stopping criterion includes the precision itself
+        rounds = []
+        evaluate = lambda n: rounds.append(n) or np.zeros(n, dtype=bool)
+        lower, upper = _binomial_interval(0, 100, 0.9975)
+        p, err = _sequential_p_value(evaluate, 200, None, (upper - lower) / 2., 0.95, 10)
+        self.assertEqual(sum(rounds), 100)
+        # The corrected intervals need more toys to exclude a threshold
+        rounds = []
+        _sequential_p_value(evaluate, 1000, 0.05, None, 0.95, 10)
+        self.assertEqual(sum(rounds), 170)
+
     def test_max_likelihood_p_value(self):
         ret = self.test.max_likelihood_p_value(N=2)
         self.assertTrue(0. <= ret <= 1.)
@@ -1347,6 +1960,106 @@ class TestHypothesisTesters(unittest.TestCase):
         ret = self.test.wilks_max_likelihood_ratio_p_value((0, 1, 2, 3))
         self.assertAlmostEqual(ret, 1., places=3)
 
+    def test_executors(self):
+        progress = []
+        np.random.seed(1)
+        expected = self.test.likelihood_p_value([[1,1,1,1],[1,1,1,2]], N=100)
+        for executor in (SerialExecutor(progress=lambda i, n: progress.append((i, n))),
+                         ThreadExecutor(2, chunksize=10), ProcessExecutor(2)):
+            with executor:
+                np.random.seed(1)
+                ret = self.test.likelihood_p_value([[1,1,1,1],[1,1,1,2]], N=100, executor=executor)
+                self.assertTrue(np.all(ret == expected))
+                test = HypothesisTester(self.calc, executor=executor)
+                ret = test.max_likelihood_p_value(N=2)
+                self.assertTrue(0. <= ret <= 1.)
+                ret = test.max_likelihood_ratio_p_value((None, None, None, 3), N=2)
+                self.assertTrue(ret >= 0.5)
+        self.assertEqual(progress[-1], (2, 2))
+        self.assertEqual(len(progress), 1 + 1 + 2 + 2)
+
+    def test_parallel_toy_batches(self):
+        items = []
+        def parallel_map(function, iterable):
+            iterable = list(iterable)
+            items.append(len(iterable))
+            return list(map(function, iterable))
+        from multiprocessing import cpu_count
+        executor = SerialExecutor(mapper=parallel_map)
+        self.assertEqual(executor._get_n_workers(), cpu_count())
+        progress = []
+        with ThreadExecutor(2, progress=lambda i, n: progress.append(n)) as threads:
+            self.assertEqual(threads._get_n_workers(), 2)
+            test = HypothesisTester(self.calc, executor=threads)
+            ret = test.likelihood_p_value([1,1,1,1], N=2000)
+            self.assertTrue(0. < ret < 1.)
+        self.assertEqual(progress[-1], 2 * test.toy_batches_per_worker)
+        self.assertEqual(ProcessExecutor(3)._get_n_workers(), 3)
+        self.assertEqual(SerialExecutor()._get_n_workers(), 1)
+        # Replacing the module level mapper is parallel, too
+        import remu.likelihood
+        old_mapper = remu.likelihood.mapper
+        remu.likelihood.mapper = parallel_map
+        try:
+            self.test.likelihood_p_value([1,1,1,1], N=2000)
+        finally:
+            remu.likelihood.mapper = old_mapper
+        self.assertTrue(items[-1] > 1 or cpu_count() == 1)
+        # Explicit batch sizes are respected
+        self.test.likelihood_p_value([1,1,1,1], N=2000, batch_size=2000, executor=executor)
+        self.assertEqual(items[-1], 1)
+
+    def test_batched_maximizer(self):
+        test = HypothesisTester(self.calc, maximizer=ProjectedLBFGSMaximizer())
+        ret = test.max_likelihood_p_value(N=20)
+        self.assertTrue(0. <= ret <= 1.)
+        ret = test.max_likelihood_p_value(fix_parameters=(None, None, None, 20), N=20)
+        self.assertAlmostEqual(ret, 0., places=3)
+        ret = test.max_likelihood_ratio_p_value((None, None, None, 3), N=20)
+        self.assertTrue(ret >= 0.5)
+        ret = test.max_likelihood_ratio_p_value((None, None, 2, 30), alternative_fix_parameters=(None, None, None, 3), N=20)
+        self.assertAlmostEqual(ret, 0., places=3)
+        test = HypothesisTester(self.calc, maximizer=ProjectedLBFGSMaximizer(), warm_start=False)
+        ret = test.max_likelihood_ratio_p_value((None, None, None, 3), N=20)
+        self.assertTrue(ret >= 0.5)
+        # The batches of toy fits are distributed over the workers
+        progress = []
+        with ThreadExecutor(2, progress=lambda i, n: progress.append(n)) as threads:
+            test = HypothesisTester(self.calc, maximizer=ProjectedLBFGSMaximizer(), executor=threads)
+            test.max_likelihood_p_value(N=200)
+            self.assertEqual(progress[-1], 2 * test.toy_batches_per_worker)
+            test.max_likelihood_ratio_p_value((None, None, None, 3), N=200)
+            self.assertEqual(progress[-1], 2 * test.toy_batches_per_worker)
+
+    def test_fit_cache(self):
+        test = HypothesisTester(self.calc, fit_cache_size=10)
+        test.max_likelihood_p_value((None, None, None, 3), N=2)
+        self.assertEqual(test.fit_cache_info().misses, 1)
+        test.max_likelihood_ratio_p_value((None, None, None, 3), N=2)
+        self.assertEqual(test.fit_cache_info()[:2], (1, 2))
+        ret = test.wilks_max_likelihood_ratio_p_value((None, None, None, 3))
+        self.assertEqual(test.fit_cache_info()[:2], (3, 2))
+        self.assertAlmostEqual(ret, 1., places=3)
+        self.assertEqual(self.test.fit_cache_info(), (0, 0, 0, 0))
+        # Cached results are copies
+        LC, opt = test._best_fit(self.calc, (None, None, None, 3))
+        x = opt.x.copy()
+        opt.x[:] = -1.
+        self.assertTrue(np.all(test._best_fit(self.calc, (None, None, None, 3))[1].x == x))
+        # New data models never hit stale entries
+        for i in range(5):
+            calc = LikelihoodCalculator(PoissonData(self.data + i), self.predictor)
+            opt = test._best_fit(calc, (None, None, None, 3))
+            self.assertAlmostEqual(opt[1].x[0], i, places=2)
+
+    def test_toy_batches(self):
+        np.random.seed(1)
+        expected = self.test.likelihood_p_value([[1,1,1,1],[1,1,1,2]], N=100)
+        for batch_size in (1, 7, 100, 1000):
+            np.random.seed(1)
+            ret = self.test.likelihood_p_value([[1,1,1,1],[1,1,1,2]], N=100, batch_size=batch_size)
+            self.assertTrue(np.all(ret == expected))
+
 class TestPlotting(unittest.TestCase):
     def setUp(self):
         pass
@@ -1501,6 +2214,43 @@ class TestMatrixUtils(unittest.TestCase):
         self.assertEqual(self.rm.reco_binning.value_array.sum(),
                          rm1.reco_binning.value_array.sum())
 
+class TestJeffreysPrior(unittest.TestCase):
+    def setUp(self):
+        self.response = np.array([[1.,0.],[0.5,0.5],[0.,1.],[0.,0.]])
+        self.translation = np.array([[1.,1.],[0.,2.]])
+        self.translate = lambda x: np.asarray(x).dot(self.translation.T)
+        self.prior = JeffreysPrior(self.response, self.translate, [(0,None), (0,10)], [1.,1.])
+
+    def test_fisher_matrix(self):
+        par = np.array([1.,2.])
+        mu = self.response.dot(self.translate(par))
+        diff = self.response.dot(self.translation)
+        fish = np.einsum('ri,rj->ij', diff[:3], diff[:3] / mu[:3,np.newaxis])
+        self.assertTrue(np.allclose(self.prior.fisher_matrix(par), fish))
+        self.assertTrue(np.allclose(self.prior.fisher_matrix([par, par]), [fish, fish]))
+        self.assertAlmostEqual(self.prior(par), 0.5*np.log(np.linalg.det(fish)))
+
+    def test_batch(self):
+        par = np.array([[1.,2.], [-1.,2.], [1.,11.], [3.,0.5]])
+        ret = self.prior(par)
+        self.assertEqual(ret.shape, (4,))
+        self.assertEqual(ret[1], -np.inf)
+        self.assertEqual(ret[2], -np.inf)
+        self.assertAlmostEqual(ret[0], self.prior(par[0]))
+        self.assertAlmostEqual(ret[3], self.prior(par[3]))
+        self.assertEqual(self.prior(par.reshape((2,2,2))).shape, (2,2))
+
+    def test_jacobian(self):
+        par = np.random.uniform(0.5, 2., size=(10,2))
+        constant = JeffreysPrior(self.response, self.translate, [(0,None), (0,10)], [1.,1.], jacobian=self.translation)
+        function = JeffreysPrior(self.response, self.translate, [(0,None), (0,10)], [1.,1.],
+            jacobian=lambda x: np.broadcast_to(self.translation, np.shape(x)[:-1]+(2,2)))
+        self.assertTrue(np.allclose(constant(par), self.prior(par)))
+        self.assertTrue(np.allclose(function(par), self.prior(par)))
+        limited = JeffreysPrior(self.response, self.translate, [(0,None), (0,10)], [1.,1.], total_truth_limit=5.)
+        self.assertEqual(limited([1.,2.]), -np.inf)
+        self.assertTrue(np.isfinite(limited([1.,1.])))
+
 class TestLikelihoodUtils(unittest.TestCase):
     def setUp(self):
         self.data = np.arange(4)
@@ -1518,6 +2268,77 @@ class TestLikelihoodUtils(unittest.TestCase):
         chain = sampler.get_chain(flat=True)
         np.mean(chain, axis=0)
 
+    def test_emcee_chunks(self):
+        pred = TemplatePredictor([np.eye(4)], bounds=[(-1,1)]*4)
+        calc = LikelihoodCalculator(self.data_model, pred)
+        guess = emcee_initial_guess(calc, nwalkers=10)
+        self.assertEqual(guess.shape, (10,4))
+        self.assertTrue(np.all(np.isfinite(calc(guess))))
+        impossible = LikelihoodCalculator(PoissonData([1,1,1,1]), TemplatePredictor([np.eye(4)], bounds=[(-1,0)]*4))
+        self.assertRaises(RuntimeError, emcee_initial_guess, impossible, nwalkers=10, max_tries=3)
+        sampler = emcee_sampler(calc, nwalkers=10, chunk_size=3)
+        sampler.run_mcmc(guess, 10)
+        self.assertTrue(np.all(np.isfinite(sampler.get_log_prob())))
+        sampler = emcee_sampler(calc, nwalkers=10, pool=SerialExecutor())
+        sampler.run_mcmc(guess, 10)
+        self.assertTrue(np.all(np.isfinite(sampler.get_log_prob())))
+
+    def test_ensemble_sampler(self):
+        import os, tempfile, shutil
+        np.random.seed(0)
+        guess = emcee_initial_guess(self.calc, nwalkers=8)
+        for move in ('stretch', 'de'):
+            sampler = EnsembleSampler(self.calc, nwalkers=8, move=move)
+            state = sampler.run(guess, 200, thin=2, chunk_size=7)
+            self.assertEqual(sampler.get_chain().shape, (100,8,4))
+            self.assertEqual(sampler.get_chain(flat=True, discard=10).shape, (720,4))
+            self.assertEqual(sampler.log_prob.shape, (100,8))
+            self.assertTrue(np.all(np.isfinite(sampler.log_prob)))
+            self.assertTrue(np.all(sampler.acceptance_fraction > 0))
+            self.assertTrue(np.allclose(state[1], self.calc(state[0])))
+        prior = lambda x: -np.sum(x, axis=-1)
+        sampler = EnsembleSampler(self.calc, nwalkers=8, prior=prior)
+        self.assertTrue(np.allclose(sampler.log_probability(guess), self.calc(guess) - np.sum(guess, axis=-1)))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'chain.npy')
+            sampler.run(state[0], 100000, filename=filename, check_interval=100)
+            n = len(sampler.chain)
+            self.assertTrue(n < 100000)
+            self.assertTrue(np.all(np.isfinite(sampler.autocorr_time)))
+            chain = np.load(filename)
+            self.assertEqual(chain.shape, (n,8,4))
+            self.assertTrue(np.all(chain == sampler.get_chain()))
+            log_prob = np.load(os.path.join(tmpdir, 'chain_log_prob.npy'))
+            self.assertEqual(log_prob.shape, (n,8))
+            self.assertTrue(isinstance(sampler.log_prob, np.memmap))
+            self.assertTrue(np.all(log_prob == sampler.log_prob))
+            self.assertTrue(np.allclose(log_prob[-1], sampler.log_probability(chain[-1])))
+        finally:
+            del sampler
+            shutil.rmtree(tmpdir)
+        # The convergence checks only read a window of the chain
+        import remu.likelihood_utils
+        lengths = []
+        def autocorr_time(chain, c=5):
+            lengths.append(len(chain))
+            return integrated_autocorr_time(chain, c)
+        remu.likelihood_utils.integrated_autocorr_time = autocorr_time
+        try:
+            sampler = EnsembleSampler(self.calc, nwalkers=8)
+            sampler.run(state[0], 3000, check_interval=100, autocorr_factor=1e6, autocorr_window=500)
+        finally:
+            remu.likelihood_utils.integrated_autocorr_time = integrated_autocorr_time
+        self.assertEqual(len(sampler.chain), 3000)
+        self.assertEqual(lengths, [100, 200, 300, 400] + [500]*26)
+
+    def test_autocorr_time(self):
+        np.random.seed(0)
+        chain = np.random.normal(size=(5000,4,2))
+        self.assertTrue(np.allclose(integrated_autocorr_time(chain)[0], 1., atol=0.2))
+        chain[:,:,1] = np.cumsum(chain[:,:,1], axis=0)
+        self.assertTrue(integrated_autocorr_time(chain)[1] > 10.)
+
 if __name__ == '__main__':
     np.seterr(all='raise')
     unittest.main(argv=testargs)